@@ -0,0 +1,425 @@
+"""
+Process-wide scheduler for OpenAI and Gemini calls.
+
+Every API call in the pipeline goes through scheduler.call(provider, model, fn, ...):
+  - token buckets per (provider, model) for requests/minute and tokens/minute
+  - retries with full-jitter exponential backoff on 429, 5xx and connection errors,
+    honouring Retry-After when the server sends it
+  - a circuit breaker per (provider, model) that fails fast while the API is down
+
+scheduler.hedged(...) additionally hedges slow calls (when API_HEDGING=1): if a call
+has not returned after the API_HEDGE_PERCENTILE latency of recent calls to that model,
+a duplicate is sent and the first success wins. Hedges are capped at API_HEDGE_BUDGET
+extra requests per call; the loser stops retrying and its late result is discarded.
+
+Limits default to {PROVIDER}_RPM / {PROVIDER}_TPM (0 = unlimited) and can be set per
+model with API_RATE_LIMITS, e.g. '{"openai:gpt-4o": {"rpm": 500, "tpm": 30000}}'.
+Budgets are shared by all threads of one process, not across processes; a process that
+is one of N workers sets scheduler.limit_share = 1 / N before its first call.
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMITS = {
+    "openai": {"rpm": int(os.getenv("OPENAI_RPM", "500")), "tpm": int(os.getenv("OPENAI_TPM", "200000"))},
+    "gemini": {"rpm": int(os.getenv("GEMINI_RPM", "60")), "tpm": int(os.getenv("GEMINI_TPM", "0"))},
+    "local": {"rpm": int(os.getenv("LOCAL_RPM", "0")), "tpm": int(os.getenv("LOCAL_TPM", "0"))},
+}
+API_RATE_LIMITS = json.loads(os.getenv("API_RATE_LIMITS", "{}") or "{}")
+
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "5"))
+API_BACKOFF_BASE = float(os.getenv("API_BACKOFF_BASE", "1.0"))
+API_BACKOFF_MAX = float(os.getenv("API_BACKOFF_MAX", "60"))
+# Seconds of budget a bucket may spend at once (bursts above the per-second rate)
+API_BURST_SECONDS = float(os.getenv("API_BURST_SECONDS", "10"))
+# Consecutive transient failures that open a circuit, and how long it stays open
+API_BREAKER_THRESHOLD = int(os.getenv("API_BREAKER_THRESHOLD", "8"))
+API_BREAKER_RESET = float(os.getenv("API_BREAKER_RESET", "30"))
+
+API_HEDGING = os.getenv("API_HEDGING", "0") == "1"
+API_HEDGE_PERCENTILE = float(os.getenv("API_HEDGE_PERCENTILE", "95"))
+# Extra requests hedging may add, as a fraction of hedged calls (0.05 = at most 5% more spend)
+API_HEDGE_BUDGET = float(os.getenv("API_HEDGE_BUDGET", "0.05"))
+# Latency samples kept per model, and how many are needed before hedging starts
+API_HEDGE_WINDOW = int(os.getenv("API_HEDGE_WINDOW", "200"))
+API_HEDGE_MIN_SAMPLES = int(os.getenv("API_HEDGE_MIN_SAMPLES", "20"))
+API_HEDGE_MIN_DELAY = float(os.getenv("API_HEDGE_MIN_DELAY", "0.1"))
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+# Transport-level errors of the OpenAI, google-api-core and requests/httpx stacks
+RETRYABLE_ERROR_NAMES = {
+    "APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError",
+    "ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded", "TooManyRequests",
+    "ConnectionError", "Timeout", "TimeoutError", "ConnectError", "ReadTimeout",
+}
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised without calling the API while the circuit for a provider/model is open.
+    probing is set while a half-open probe call is in flight; its outcome is worth waiting for.
+    """
+
+    def __init__(self, message: str, retry_in: float = 0.0, probing: bool = False):
+        super().__init__(message)
+        self.retry_in = retry_in
+        self.probing = probing
+
+
+class HedgeCancelled(RuntimeError):
+    """Raised inside the losing copy of a hedged call once the other copy has succeeded."""
+
+
+def error_status(error: Exception):
+    """HTTP status of an API error, if it carries one."""
+    for attr in ("status_code", "code", "http_status"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (CircuitOpenError, HedgeCancelled)):
+        return False
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+
+def retry_after_seconds(error: Exception):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        value = headers.get("retry-after")
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_tokens(text: str = "", images: int = 0, max_output: int = 1000) -> int:
+    """Rough request size for the tokens/minute budget: ~4 chars per token, a fixed cost per image."""
+    return len(text) // 4 + images * 1100 + max_output
+
+
+class TokenBucket:
+    """Refills at rate_per_minute; holds at most API_BURST_SECONDS worth of budget."""
+
+    def __init__(self, rate_per_minute: float, burst_seconds: float = API_BURST_SECONDS):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0) -> float:
+        """Blocks until `amount` is available; returns the seconds spent waiting."""
+        amount = min(float(amount), self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) / self.rate
+            delay = min(delay, 1.0)
+            time.sleep(delay)
+            waited += delay
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `threshold` consecutive transient failures; after `reset_seconds`
+    one probe call is let through (half-open) and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, threshold: int = API_BREAKER_THRESHOLD, reset_seconds: float = API_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self._lock = threading.Lock()
+        self._probe_done = threading.Condition(self._lock)
+
+    def before_call(self, name: str):
+        with self._lock:
+            if self.state == "open":
+                remaining = self.reset_seconds - (time.monotonic() - self.opened_at)
+                if remaining > 0:
+                    raise CircuitOpenError(f"Circuit open for {name}; not calling the API", remaining)
+                self.state = "half_open"
+                self.probe_in_flight = False
+            if self.state == "half_open":
+                if self.probe_in_flight:
+                    raise CircuitOpenError(f"Circuit half-open for {name}; probe call in progress", probing=True)
+                self.probe_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self.probe_in_flight = False
+            self._probe_done.notify_all()
+
+    def record_failure(self) -> bool:
+        """Returns True when this failure opened the circuit."""
+        with self._lock:
+            self.failures += 1
+            self.probe_in_flight = False
+            self._probe_done.notify_all()
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def wait_for_probe(self, timeout: float):
+        """Blocks until the half-open probe call has finished, or at most timeout seconds."""
+        with self._lock:
+            if self.probe_in_flight:
+                self._probe_done.wait(timeout)
+
+
+class HedgeBudget:
+    """Every hedged call earns `rate` of a hedge; firing a hedge spends a whole one."""
+
+    def __init__(self, rate: float = API_HEDGE_BUDGET, max_balance: float = 10.0):
+        self.rate = rate
+        self.max_balance = max_balance
+        self.balance = 1.0
+        self._lock = threading.Lock()
+
+    def earn(self):
+        with self._lock:
+            self.balance = min(self.max_balance, self.balance + self.rate)
+
+    def spend(self) -> bool:
+        with self._lock:
+            if self.balance < 1.0:
+                return False
+            self.balance -= 1.0
+            return True
+
+
+class _Lane:
+    """Budgets, breaker and recent latencies for one (provider, model)."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.breaker = CircuitBreaker()
+        self.latencies = deque(maxlen=API_HEDGE_WINDOW)
+        self.hedge_budget = HedgeBudget()
+
+    def hedge_delay(self, percentile: float = API_HEDGE_PERCENTILE):
+        """Seconds to wait before hedging, or None until enough latencies are known."""
+        samples = sorted(self.latencies)
+        if len(samples) < API_HEDGE_MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * percentile / 100.0))
+        return max(API_HEDGE_MIN_DELAY, samples[index])
+
+
+class ApiScheduler:
+    def __init__(self, max_retries: int = API_MAX_RETRIES, backoff_base: float = API_BACKOFF_BASE,
+                 backoff_max: float = API_BACKOFF_MAX, hedging: bool = API_HEDGING):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedging = hedging
+        # Fraction of every rpm/tpm limit this process may use (see the module docstring)
+        self.limit_share = 1.0
+        self._lanes = {}
+        self._lock = threading.Lock()
+        self._stats = defaultdict(int)
+
+    def lane(self, provider: str, model: str) -> _Lane:
+        key = f"{provider}:{model}"
+        with self._lock:
+            if key not in self._lanes:
+                limits = dict(DEFAULT_LIMITS.get(provider, {"rpm": 0, "tpm": 0}))
+                limits.update(API_RATE_LIMITS.get(key, {}))
+                self._lanes[key] = _Lane(self.shared_limit(limits.get("rpm", 0)),
+                                         self.shared_limit(limits.get("tpm", 0)))
+            return self._lanes[key]
+
+    def shared_limit(self, limit) -> int:
+        """This process's part of a limit; 0 (unlimited) stays 0 and a limit never drops to 0."""
+        limit = int(limit or 0)
+        return max(1, int(limit * self.limit_share)) if limit > 0 else 0
+
+    def _count(self, name: str, amount: float = 1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return min(self.backoff_max, retry_after) + random.uniform(0, self.backoff_base)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def call(self, provider: str, model: str, fn, /, *args, tokens: int = 0, **kwargs):
+        """
+        Runs fn(*args, **kwargs) within the budgets of (provider, model), retrying
+        transient failures. Non-retryable errors (400, 401, 404, ...) are raised at once.
+        While the circuit is open no request is sent; waiting for it counts as a retry.
+        Waiting for the outcome of a half-open probe call does not.
+        """
+        return self._run(provider, model, fn, args, kwargs, tokens)
+
+    def _run(self, provider: str, model: str, fn, args: tuple, kwargs: dict, tokens: int = 0,
+             cancel: threading.Event = None):
+        name = f"{provider}:{model}"
+        lane = self.lane(provider, model)
+        attempt = 0
+
+        def sleep(delay):
+            # A cancelled hedge copy stops waiting as soon as the other copy wins
+            if cancel is None:
+                time.sleep(delay)
+            elif cancel.wait(delay):
+                raise HedgeCancelled(f"{name}: hedged call already answered")
+
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise HedgeCancelled(f"{name}: hedged call already answered")
+            try:
+                lane.breaker.before_call(name)
+            except CircuitOpenError as e:
+                if e.probing:
+                    # The probe (e.g. a slow vision call) decides; retries are not used up meanwhile
+                    self._count("probe_waits")
+                    lane.breaker.wait_for_probe(1.0)
+                    continue
+                if attempt >= self.max_retries:
+                    self._count("errors")
+                    raise
+                attempt += 1
+                delay = e.retry_in + random.uniform(0, self.backoff_base)
+                self._count("circuit_waits")
+                self._count("backoff_seconds", delay)
+                sleep(delay)
+                continue
+            if lane.requests:
+                self._count("throttled_seconds", lane.requests.acquire(1))
+            if lane.tokens and tokens:
+                self._count("throttled_seconds", lane.tokens.acquire(tokens))
+            self._count("calls")
+            started = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    lane.breaker.record_success()  # The API answered; the request itself was bad
+                    self._count("errors")
+                    raise
+                self._count("transient_errors")
+                if lane.breaker.record_failure():
+                    self._count("circuit_opened")
+                    logger.error(f"Circuit opened for {name} after repeated failures: {e}")
+                if attempt >= self.max_retries:
+                    self._count("errors")
+                    raise
+                delay = self.backoff(attempt, e)
+                attempt += 1
+                self._count("retries")
+                self._count("backoff_seconds", delay)
+                logger.warning(f"{name}: {error_status(e) or type(e).__name__}, "
+                               f"retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                sleep(delay)
+                continue
+            lane.latencies.append(time.monotonic() - started)
+            lane.breaker.record_success()
+            return result
+
+    def _start(self, provider: str, model: str, fn, args: tuple, kwargs: dict, tokens: int,
+               cancel: threading.Event) -> Future:
+        """Runs one copy of a hedged call on its own thread."""
+        future = Future()
+
+        def target():
+            try:
+                future.set_result(self._run(provider, model, fn, args, kwargs, tokens, cancel))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=target, name=f"hedge-{provider}", daemon=True).start()
+        return future
+
+    def hedged(self, provider: str, model: str, fn, /, *args, tokens: int = 0, **kwargs):
+        """
+        Like call(), but when hedging is on a second copy is sent if the first has not
+        returned after the lane's hedge delay. The first copy to succeed is returned;
+        the other is told to stop (an HTTP request already sent still runs to completion
+        in the background and its result is dropped). Hedges count against the same
+        rate limits as any other request.
+        """
+        if not self.hedging:
+            return self.call(provider, model, fn, *args, tokens=tokens, **kwargs)
+        lane = self.lane(provider, model)
+        lane.hedge_budget.earn()
+        delay = lane.hedge_delay()
+        if delay is None:
+            return self.call(provider, model, fn, *args, tokens=tokens, **kwargs)
+
+        self._count("hedged_calls")
+        copies = {}
+        primary_cancel = threading.Event()
+        primary = self._start(provider, model, fn, args, kwargs, tokens, primary_cancel)
+        copies[primary] = primary_cancel
+        if not wait([primary], timeout=delay).done:
+            if lane.hedge_budget.spend():
+                self._count("hedges_fired")
+                hedge_cancel = threading.Event()
+                copies[self._start(provider, model, fn, args, kwargs, tokens, hedge_cancel)] = hedge_cancel
+            else:
+                self._count("hedges_over_budget")
+
+        error = None
+        while copies:
+            done, _ = wait(list(copies), return_when=FIRST_COMPLETED)
+            for future in done:
+                copies.pop(future)
+                if future.exception() is None:
+                    if future is not primary:
+                        self._count("hedges_won")
+                    for cancel in copies.values():
+                        cancel.set()
+                        self._count("hedges_cancelled")
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {k: round(v, 2) if isinstance(v, float) else v for k, v in self._stats.items()}
+
+
+scheduler = ApiScheduler()
+
+
+def call(provider: str, model: str, fn, /, *args, tokens: int = 0, **kwargs):
+    """Shorthand for scheduler.call on the process-wide scheduler."""
+    return scheduler.call(provider, model, fn, *args, tokens=tokens, **kwargs)
+
+
+def hedged(provider: str, model: str, fn, /, *args, tokens: int = 0, **kwargs):
+    """Shorthand for scheduler.hedged on the process-wide scheduler."""
+    return scheduler.hedged(provider, model, fn, *args, tokens=tokens, **kwargs)
@@ -0,0 +1,268 @@
+"""
+Bulk OCR ingestion for a whole class of answer scripts.
+
+Takes a directory or ZIP of PDFs plus a manifest CSV mapping file names to
+student IDs and runs ocr_pdf.extract_text_from_pdf for every student on a
+pool of worker processes. PyMuPDF is not thread-safe across documents, so each
+worker is a separate (spawned) process with its own Mongo connection and OCR
+backend client, reused for every script it handles; API rate limits are split
+evenly between the workers. With one worker the scripts run in this process.
+
+Manifest format (header row required; manifest.csv inside the directory/ZIP is
+used when --manifest is not given):
+
+    file,student_id
+    roll_001.pdf,STU001
+    roll_002.pdf,STU002
+"""
+
+import argparse
+import csv
+import io
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from ocr_pdf import mongo_client, extract_text_from_pdf, validate_id, OCR_MAX_IN_FLIGHT
+from api_scheduler import scheduler
+
+logger = logging.getLogger(__name__)
+
+# Students processed concurrently, one worker process each. Total vision requests in
+# flight can reach BULK_WORKERS * OCR_MAX_IN_FLIGHT, so lower --max-in-flight when raising this.
+BULK_WORKERS = int(os.getenv("BULK_WORKERS", "4"))
+MANIFEST_NAME = "manifest.csv"
+
+FILE_COLUMNS = ("file", "filename", "file_name")
+STUDENT_COLUMNS = ("student_id", "studentid", "student")
+
+
+def load_manifest(text: str) -> dict:
+    """Parses manifest CSV text into {file name: student ID}."""
+    reader = csv.DictReader(io.StringIO(text))
+    columns = {name.strip().lower(): name for name in (reader.fieldnames or [])}
+    file_column = next((columns[c] for c in FILE_COLUMNS if c in columns), None)
+    student_column = next((columns[c] for c in STUDENT_COLUMNS if c in columns), None)
+    if not file_column or not student_column:
+        raise ValueError(f"Manifest needs a file column ({'/'.join(FILE_COLUMNS)}) "
+                         f"and a student column ({'/'.join(STUDENT_COLUMNS)})")
+
+    manifest = {}
+    for row in reader:
+        file_name = os.path.basename((row.get(file_column) or "").strip())
+        student_id = (row.get(student_column) or "").strip()
+        if not file_name or not student_id:
+            continue
+        if file_name in manifest and manifest[file_name] != student_id:
+            raise ValueError(f"Manifest maps {file_name} to both {manifest[file_name]} and {student_id}")
+        manifest[file_name] = student_id
+    return manifest
+
+
+def collect_scripts(source: str, dest_dir: str, manifest_path: str = None, prefix: str = ""):
+    """
+    Resolves the PDFs of a directory or ZIP against the manifest.
+    ZIP members are extracted into dest_dir (flattened, named prefix + file name).
+    Returns (jobs, skipped): jobs are {file, studentId, path}; skipped are status
+    entries for manifest rows without a PDF, PDFs without a manifest row and PDFs
+    whose file name appears in more than one ZIP folder (none of those is graded).
+    """
+    pdfs = {}
+    duplicates = {}
+    manifest_text = None
+
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            members = {}
+            for member in archive.infolist():
+                if member.is_dir():
+                    continue
+                # Only the base name is used, so member paths cannot escape dest_dir
+                name = os.path.basename(member.filename)
+                if name.lower() == MANIFEST_NAME and manifest_path is None:
+                    if manifest_text is not None:
+                        raise ValueError(f"More than one {MANIFEST_NAME} in {source}")
+                    manifest_text = archive.read(member).decode("utf-8-sig")
+                elif name.lower().endswith(".pdf") and not name.startswith("."):
+                    members.setdefault(name, []).append(member)
+            for name, same_name in members.items():
+                if len(same_name) > 1:
+                    # Flattening would let the last one overwrite the others
+                    duplicates[name] = [m.filename for m in same_name]
+                    continue
+                path = os.path.join(dest_dir, prefix + name)
+                with archive.open(same_name[0]) as src, open(path, "wb") as out:
+                    out.write(src.read())
+                pdfs[name] = path
+    elif os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.lower().endswith(".pdf"):
+                pdfs[name] = os.path.abspath(os.path.join(source, name))
+        if manifest_path is None and os.path.exists(os.path.join(source, MANIFEST_NAME)):
+            manifest_path = os.path.join(source, MANIFEST_NAME)
+    else:
+        raise ValueError(f"Not a directory or ZIP file: {source}")
+
+    if manifest_path is not None:
+        with open(manifest_path, "r", encoding="utf-8-sig") as f:
+            manifest_text = f.read()
+    if manifest_text is None:
+        raise ValueError(f"No manifest given and no {MANIFEST_NAME} found in {source}")
+    manifest = load_manifest(manifest_text)
+
+    jobs, skipped = [], []
+    for file_name, paths in sorted(duplicates.items()):
+        skipped.append({"file": file_name, "studentId": manifest.get(file_name), "status": "skipped",
+                        "error": f"{len(paths)} PDFs named {file_name} in the ZIP ({', '.join(paths)}); "
+                                 f"give each script a unique file name"})
+    for file_name, student_id in manifest.items():
+        if file_name in duplicates:
+            continue
+        if file_name in pdfs:
+            jobs.append({"file": file_name, "studentId": student_id, "path": pdfs[file_name]})
+        else:
+            skipped.append({"file": file_name, "studentId": student_id,
+                            "status": "missing", "error": "PDF listed in manifest not found"})
+    for file_name in sorted(set(pdfs) - set(manifest)):
+        skipped.append({"file": file_name, "studentId": None,
+                        "status": "skipped", "error": "PDF not listed in manifest"})
+    return jobs, skipped
+
+
+def init_worker(hedging: bool, limit_share: float):
+    """Runs in each worker process: the parent's scheduler settings do not survive spawn."""
+    scheduler.hedging = hedging
+    scheduler.limit_share = limit_share
+
+
+def ingest_student(job: dict, exam_id: str, ocr_options: dict) -> dict:
+    started = time.perf_counter()
+    status = {"file": job["file"], "studentId": job["studentId"]}
+    try:
+        result = extract_text_from_pdf(job["path"], exam_id, job["studentId"], **ocr_options)
+        status.update(status="ok", pages=result["pagesProcessed"], totalPages=result["totalPages"])
+        if result.get("segmentationError"):
+            # Still gradable from the pages, so the student is not marked failed
+            status["segmentationError"] = result["segmentationError"]
+        if result["pagesFailed"]:
+            # A partial script would be graded as if the missing answers were blank
+            status.update(status="failed", error=f"page(s) {result['pagesFailed']} failed; "
+                                                 f"re-run with --resume")
+    except Exception as e:
+        logger.error(f"❌ {job['file']} ({job['studentId']}): {e}")
+        status.update(status="failed", pages=0, error=str(e))
+    status["seconds"] = round(time.perf_counter() - started, 2)
+    return status
+
+
+def run_jobs(jobs: list, exam_id: str, workers: int = BULK_WORKERS, skipped: list = None, **ocr_options) -> dict:
+    """
+    OCRs the jobs ({file, studentId, path}), `workers` students at a time.
+    ocr_options are passed through to extract_text_from_pdf.
+    Returns per-student status entries and the aggregate throughput.
+    """
+    skipped = skipped or []
+    workers = max(1, int(workers or 1))
+    logger.info(f"Bulk ingest: {len(jobs)} script(s) for exam {exam_id}, {workers} worker(s), "
+                f"{len(skipped)} manifest/file mismatch(es)")
+
+    started = time.perf_counter()
+    students = []
+
+    def record(status):
+        students.append(status)
+        logger.info(f"[{len(students)}/{len(jobs)}] {status['file']} -> {status['studentId']}: "
+                    f"{status['status']} ({status['pages']} page(s), {status['seconds']}s)")
+
+    if workers == 1 or len(jobs) <= 1:
+        for job in jobs:
+            record(ingest_student(job, exam_id, ocr_options))
+    else:
+        workers = min(workers, len(jobs))
+        # spawn, not fork: the parent's Mongo client and PyMuPDF state must not be inherited
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=init_worker, initargs=(scheduler.hedging, 1.0 / workers)) as pool:
+            futures = {pool.submit(ingest_student, job, exam_id, ocr_options): job for job in jobs}
+            for future in as_completed(futures):
+                try:
+                    record(future.result())
+                except Exception as e:
+                    # The worker process died (e.g. no Mongo connection at import)
+                    job = futures[future]
+                    logger.error(f"❌ {job['file']} ({job['studentId']}): worker failed: {e}")
+                    record({"file": job["file"], "studentId": job["studentId"], "status": "failed",
+                            "pages": 0, "error": f"worker failed: {e}", "seconds": 0.0})
+    elapsed = time.perf_counter() - started
+
+    students.sort(key=lambda s: s["file"])
+    total_pages = sum(s["pages"] for s in students)
+    summary = {
+        "examId": exam_id,
+        "succeeded": sum(1 for s in students if s["status"] == "ok"),
+        "failed": sum(1 for s in students if s["status"] == "failed"),
+        "skipped": len(skipped),
+        "pages": total_pages,
+        "seconds": round(elapsed, 2),
+        "pagesPerSecond": round(total_pages / elapsed, 2) if elapsed > 0 else 0.0,
+        "students": students + skipped,
+    }
+
+    logger.info("\n" + "="*60)
+    logger.info("BULK INGEST SUMMARY")
+    logger.info("="*60)
+    for s in summary["students"]:
+        detail = f"{s.get('pages', 0)} page(s)" if s["status"] == "ok" else s.get("error", "")
+        logger.info(f"   {s['status']:<8} {s['file']:<40} {s['studentId'] or '-':<20} {detail}")
+    logger.info(f"   {summary['succeeded']} ok, {summary['failed']} failed, {summary['skipped']} skipped; "
+                f"{total_pages} pages in {summary['seconds']}s ({summary['pagesPerSecond']} pages/sec)")
+    return summary
+
+
+def bulk_ingest(source: str, exam_id: str, manifest_path: str = None, workers: int = BULK_WORKERS,
+                dest_dir: str = None, prefix: str = "", **ocr_options) -> dict:
+    """OCRs every script of a directory or ZIP for exam_id (see run_jobs)."""
+    exam_id = validate_id(exam_id, "Exam ID")
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        jobs, skipped = collect_scripts(source, dest_dir or scratch_dir, manifest_path, prefix)
+        return run_jobs(jobs, exam_id, workers, skipped, **ocr_options)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OCR a directory or ZIP of answer scripts for one exam.")
+    parser.add_argument("source", help="Directory or ZIP file containing the PDFs")
+    parser.add_argument("--exam-id", required=True, help="Exam ID the scripts belong to")
+    parser.add_argument("--manifest", help=f"CSV mapping file to student_id (default: {MANIFEST_NAME} in the source)")
+    parser.add_argument("--workers", type=int, default=BULK_WORKERS, help="Students processed concurrently")
+    parser.add_argument("--max-in-flight", type=int, default=OCR_MAX_IN_FLIGHT,
+                        help="Vision requests in flight per student")
+    parser.add_argument("--resume", action="store_true",
+                        help="Keep pages already stored for each script and OCR only the missing ones")
+    parser.add_argument("--hedge", action="store_true",
+                        help="Send a duplicate vision request when one is slower than usual (see API_HEDGE_*)")
+    parser.add_argument("--dest", help="Keep PDFs extracted from a ZIP in this directory (default: temporary)")
+    parser.add_argument("--prefix", default="", help="Prefix for the names of PDFs extracted from a ZIP")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON on stdout")
+
+    args = parser.parse_args()
+    if args.hedge:
+        scheduler.hedging = True
+
+    try:
+        summary = bulk_ingest(os.path.abspath(args.source), args.exam_id, manifest_path=args.manifest,
+                              workers=args.workers, dest_dir=args.dest, prefix=args.prefix,
+                              max_in_flight=args.max_in_flight, resume=args.resume)
+    except Exception as e:
+        logger.error(f"❌ FATAL ERROR: {e}")
+        sys.exit(1)
+    finally:
+        mongo_client.close()
+
+    if args.json:
+        print(json.dumps(summary))
+    sys.exit(1 if summary["failed"] or not summary["succeeded"] else 0)
@@ -0,0 +1,236 @@
+"""
+Splits one scanned bundle of many students' booklets into per-student scripts
+and OCRs them through the bulk ingestion pool.
+
+Booklet boundaries are found before any vision call, from cheap signals only:
+  roll:      a roll number printed in the top region of a page (text layer);
+             a new booklet starts whenever the roll number changes
+  separator: a separator sheet carrying a marker text; the sheet itself is dropped
+  cover:     pages that match a cover-page template on a downscaled render
+             (perceptual hash + intensity grid, as in ocr_pdf page triage)
+"auto" uses the first of these that finds more than one booklet.
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+
+import fitz  # PyMuPDF
+import numpy as np
+
+from ocr_pdf import mongo_client, validate_id, OCR_MAX_IN_FLIGHT, OCR_TRIAGE_DPI
+from page_images import render_page, page_fingerprint, hamming_distance
+from bulk_ingest import run_jobs, BULK_WORKERS
+
+logger = logging.getLogger(__name__)
+
+# Roll number printed on the booklet; group 1 is the roll number itself
+BUNDLE_ROLL_PATTERN = os.getenv(
+    "BUNDLE_ROLL_PATTERN", r"Roll\s*(?:No\.?|Number)\s*[:\-]?\s*([A-Za-z0-9][A-Za-z0-9/\-]*)"
+)
+# Fraction of the page height (from the top) searched for the roll number
+BUNDLE_ROLL_REGION = float(os.getenv("BUNDLE_ROLL_REGION", "0.25"))
+BUNDLE_SEPARATOR_TEXT = os.getenv("BUNDLE_SEPARATOR_TEXT", "BOOKLET SEPARATOR")
+# A page is a cover when it is within both limits of the cover template. Looser
+# than duplicate triage: covers differ by the handwritten name and roll number.
+BUNDLE_COVER_MAX_DISTANCE = int(os.getenv("BUNDLE_COVER_MAX_DISTANCE", "40"))
+BUNDLE_COVER_MAX_GRID_DIFF = float(os.getenv("BUNDLE_COVER_MAX_GRID_DIFF", "4.0"))
+
+SPLIT_METHODS = ("auto", "roll", "separator", "cover")
+
+
+def read_roll_number(page: "fitz.Page", pattern: "re.Pattern") -> str:
+    rect = page.rect
+    region = fitz.Rect(rect.x0, rect.y0, rect.x1, rect.y0 + rect.height * BUNDLE_ROLL_REGION)
+    match = pattern.search(page.get_text("text", clip=region))
+    return match.group(1) if match else None
+
+
+def split_by_roll_number(doc: "fitz.Document", pattern: str = BUNDLE_ROLL_PATTERN) -> list:
+    compiled = re.compile(pattern, re.IGNORECASE)
+    booklets = []
+    for i in range(len(doc)):
+        roll_number = read_roll_number(doc[i], compiled)
+        if not booklets or (roll_number and roll_number != booklets[-1]["rollNumber"]):
+            if booklets and booklets[-1]["rollNumber"] is None and roll_number:
+                # Leading pages without a roll number belong to the first booklet found
+                booklets[-1]["rollNumber"] = roll_number
+            else:
+                booklets.append({"pages": [], "rollNumber": roll_number})
+        booklets[-1]["pages"].append(i)
+    return booklets
+
+
+def split_by_separator(doc: "fitz.Document", marker: str = BUNDLE_SEPARATOR_TEXT) -> list:
+    booklets = [{"pages": [], "rollNumber": None}]
+    for i in range(len(doc)):
+        if marker.lower() in doc[i].get_text("text").lower():
+            booklets.append({"pages": [], "rollNumber": None})
+            continue
+        booklets[-1]["pages"].append(i)
+    return [b for b in booklets if b["pages"]]
+
+
+def split_by_cover(doc: "fitz.Document", template: "fitz.Page" = None,
+                   max_distance: int = BUNDLE_COVER_MAX_DISTANCE,
+                   max_grid_diff: float = BUNDLE_COVER_MAX_GRID_DIFF) -> list:
+    """Without a template, the first page of the bundle is taken to be a cover."""
+    template_fp = page_fingerprint(render_page(template if template is not None else doc[0],
+                                               OCR_TRIAGE_DPI, grayscale=True))
+    roll_pattern = re.compile(BUNDLE_ROLL_PATTERN, re.IGNORECASE)
+    booklets = []
+    for i in range(len(doc)):
+        fp = page_fingerprint(render_page(doc[i], OCR_TRIAGE_DPI, grayscale=True))
+        is_cover = (fp["grid"].shape == template_fp["grid"].shape
+                    and hamming_distance(fp["hash"], template_fp["hash"]) <= max_distance
+                    and float(np.abs(fp["grid"] - template_fp["grid"]).mean()) <= max_grid_diff)
+        if is_cover or not booklets:
+            booklets.append({"pages": [], "rollNumber": read_roll_number(doc[i], roll_pattern)})
+        booklets[-1]["pages"].append(i)
+    return booklets
+
+
+def detect_booklets(doc: "fitz.Document", method: str = "auto", template: "fitz.Page" = None) -> tuple:
+    """Returns (method used, booklets); each booklet is {pages: [page indices], rollNumber}."""
+    if method not in SPLIT_METHODS:
+        raise ValueError(f"Unknown split method '{method}'. Choose from: {', '.join(SPLIT_METHODS)}")
+    detectors = {
+        "roll": lambda: split_by_roll_number(doc),
+        "separator": lambda: split_by_separator(doc),
+        "cover": lambda: split_by_cover(doc, template),
+    }
+    if method != "auto":
+        return method, detectors[method]()
+    for name in ("separator", "roll", "cover"):
+        booklets = detectors[name]()
+        if len(booklets) > 1:
+            return name, booklets
+    raise ValueError("No booklet boundaries detected; choose --split-by explicitly or check the bundle")
+
+
+def assign_student_ids(booklets: list, student_ids: list, stem: str) -> list:
+    """
+    Roll number when one was read, else the next ID from student_ids (bundle order),
+    else a placeholder derived from the bundle name. Booklets of the same student
+    are merged so their pages cannot overwrite each other.
+    """
+    merged = {}
+    for n, booklet in enumerate(booklets):
+        if booklet["rollNumber"]:
+            student_id = booklet["rollNumber"]
+        elif n < len(student_ids):
+            student_id = student_ids[n]
+        else:
+            student_id = f"{stem}_{n + 1:03d}"
+        if student_id in merged:
+            merged[student_id]["pages"].extend(booklet["pages"])
+        else:
+            merged[student_id] = {"studentId": student_id, "pages": list(booklet["pages"])}
+    return list(merged.values())
+
+
+def write_booklets(doc: "fitz.Document", booklets: list, dest_dir: str, stem: str, prefix: str = "") -> list:
+    jobs = []
+    for n, booklet in enumerate(booklets, start=1):
+        safe_id = re.sub(r"[^A-Za-z0-9_-]+", "_", booklet["studentId"])
+        file_name = f"{prefix}{stem}_{n:03d}_{safe_id}.pdf"
+        path = os.path.join(dest_dir, file_name)
+        out = fitz.open()
+        for index in booklet["pages"]:
+            out.insert_pdf(doc, from_page=index, to_page=index)
+        # No fresh /ID, so splitting the same bundle again gives byte-identical booklets
+        # (same sourceHash), which --resume needs to find their stored pages
+        out.save(path, garbage=3, deflate=True, no_new_id=True)
+        out.close()
+        jobs.append({"file": file_name, "studentId": booklet["studentId"], "path": path,
+                     "bundlePages": [i + 1 for i in booklet["pages"]]})
+    return jobs
+
+
+def split_bundle(bundle_path: str, dest_dir: str, method: str = "auto", template_path: str = None,
+                 student_ids: list = None, prefix: str = "") -> tuple:
+    """Splits the bundle into per-student PDFs in dest_dir. Returns (method used, jobs)."""
+    doc = fitz.open(bundle_path)
+    template_doc = fitz.open(template_path) if template_path else None
+    try:
+        used, booklets = detect_booklets(doc, method, template_doc[0] if template_doc else None)
+        stem = re.sub(r"[^A-Za-z0-9_-]+", "_", os.path.splitext(os.path.basename(bundle_path))[0])
+        booklets = assign_student_ids(booklets, student_ids or [], stem)
+        jobs = write_booklets(doc, booklets, dest_dir, stem, prefix)
+    finally:
+        doc.close()
+        if template_doc:
+            template_doc.close()
+
+    logger.info(f"Split {bundle_path} into {len(jobs)} booklet(s) by {used}")
+    for job in jobs:
+        pages = job["bundlePages"]
+        logger.info(f"   {job['studentId']:<20} bundle pages {pages[0]}-{pages[-1]} ({len(pages)} page(s))")
+    return used, jobs
+
+
+def ingest_bundle(bundle_path: str, exam_id: str, method: str = "auto", template_path: str = None,
+                  student_ids: list = None, workers: int = BULK_WORKERS, dest_dir: str = None,
+                  prefix: str = "", **ocr_options) -> dict:
+    """Splits a bundle and OCRs every booklet through the bulk ingestion pool."""
+    exam_id = validate_id(exam_id, "Exam ID")
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        used, jobs = split_bundle(bundle_path, dest_dir or scratch_dir, method, template_path, student_ids, prefix)
+        summary = run_jobs(jobs, exam_id, workers, **ocr_options)
+    summary["splitBy"] = used
+    pages_by_file = {job["file"]: job["bundlePages"] for job in jobs}
+    for status in summary["students"]:
+        status["bundlePages"] = pages_by_file.get(status["file"])
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split a scanned bundle into per-student scripts and OCR them.")
+    parser.add_argument("bundle_path", help="Combined PDF of many students' booklets")
+    parser.add_argument("--exam-id", help="Exam ID the scripts belong to (not needed with --split-only)")
+    parser.add_argument("--split-by", choices=SPLIT_METHODS, default="auto", help="Booklet boundary detection")
+    parser.add_argument("--cover-template", help="PDF whose first page is a blank cover (default: first bundle page)")
+    parser.add_argument("--student-ids", help="Text file with one student ID per line, in bundle order "
+                                               "(used for booklets without a readable roll number)")
+    parser.add_argument("--workers", type=int, default=BULK_WORKERS, help="Students processed concurrently")
+    parser.add_argument("--max-in-flight", type=int, default=OCR_MAX_IN_FLIGHT,
+                        help="Vision requests in flight per student")
+    parser.add_argument("--resume", action="store_true",
+                        help="Keep pages already stored for each booklet and OCR only the missing ones")
+    parser.add_argument("--dest", help="Keep the per-student PDFs in this directory (default: temporary)")
+    parser.add_argument("--prefix", default="", help="Prefix for the names of the per-student PDFs")
+    parser.add_argument("--split-only", action="store_true", help="Write the per-student PDFs without running OCR")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON on stdout")
+
+    args = parser.parse_args()
+    if not args.exam_id and not args.split_only:
+        parser.error("--exam-id is required unless --split-only is given")
+
+    student_ids = []
+    if args.student_ids:
+        with open(args.student_ids, "r", encoding="utf-8-sig") as f:
+            student_ids = [line.strip() for line in f if line.strip()]
+
+    try:
+        if args.split_only:
+            used, jobs = split_bundle(os.path.abspath(args.bundle_path), args.dest or os.getcwd(),
+                                      args.split_by, args.cover_template, student_ids, args.prefix)
+            summary = {"splitBy": used, "booklets": jobs, "succeeded": len(jobs), "failed": 0}
+        else:
+            summary = ingest_bundle(os.path.abspath(args.bundle_path), args.exam_id, args.split_by,
+                                    args.cover_template, student_ids, workers=args.workers,
+                                    dest_dir=args.dest, prefix=args.prefix, max_in_flight=args.max_in_flight,
+                                    resume=args.resume)
+    except Exception as e:
+        logger.error(f"❌ FATAL ERROR: {e}")
+        sys.exit(1)
+    finally:
+        mongo_client.close()
+
+    if args.json:
+        print(json.dumps(summary))
+    sys.exit(1 if summary["failed"] or not summary["succeeded"] else 0)
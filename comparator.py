@@ -1,13 +1,16 @@
-import os, sys, json, argparse, logging
+import os, sys, json, argparse, logging, time
 from datetime import datetime
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List
-import google.generativeai as genai
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne
 import numpy as np
-from openai import OpenAI
-import hashlib
+from api_scheduler import scheduler, estimate_tokens
+from scheme_validation import find_scheme
+from embeddings import EMBED_MODEL, embed_many, build_reference_text, refresh_reference_embeddings
+from embeddings import cache as embedding_cache
+from gemini_registry import registry as gemini_registry
 
 # Setup logging
 logging.basicConfig(
@@ -24,10 +27,11 @@ load_dotenv()
 
 # Config
 MONGO_URI = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
-EMBED_MODEL = "text-embedding-3-small"
 LOW_SIMILARITY_FLAG = 0.50
 BORDERLINE_SIMILARITY = 0.65
 HIGH_SIMILARITY = 0.85
+# Concurrent Gemini verification calls (per student, or across the exam with --all-students)
+VERIFY_WORKERS = int(os.getenv("VERIFY_WORKERS", "8"))
 
 # MongoDB
 logger.info(f"≡ƒöù Connecting to MongoDB: {MONGO_URI}")
@@ -41,6 +45,8 @@ except Exception as e:
 
 db_student = mongo["ai_evaluation_system"]
 col_student = db_student["ocr_extracted_answers"]
+# Per-question answers assembled by ocr_pdf.py at ingest (question_segmenter)
+col_student_questions = db_student["ocr_question_answers"]
 
 db_schema = mongo["schema_db"]
 col_schema = db_schema["schema_extracted_answers"]
@@ -48,8 +54,10 @@ col_schema = db_schema["schema_extracted_answers"]
 db_results = mongo["result_db"]
 col_results = db_results["evaluations"]
 
-# OpenAI client
-client = OpenAI()
+# Answer and reference vectors by (model, text hash), shared with scheme_extractor.py
+embedding_cache.attach(db_student["embedding_cache"])
+# Discovered Gemini models and their health, shared by all comparator runs
+gemini_registry.attach(db_student["gemini_models"])
 
 # Helper functions
 def validate_id(id_str: str, field_name: str = "ID") -> str:
@@ -65,49 +73,43 @@ def validate_id(id_str: str, field_name: str = "ID") -> str:
     logger.info(f"Γ£à {field_name} validated: {id_str}")
     return id_str
 
-def safe_json_loads(text: str) -> Dict[str, Any]:
-    try:
-        return json.loads(text)
-    except Exception:
-        cleaned = text.strip().strip("`").strip("json").strip()
-        try:
-            return json.loads(cleaned)
-        except Exception:
-            return {"questions": [], "metadata": {}}
-
-def cosine(a: List[float], b: List[float]) -> float:
-    a = np.array(a, dtype=float)
-    b = np.array(b, dtype=float)
-    na = np.linalg.norm(a)
-    nb = np.linalg.norm(b)
-    if na == 0 or nb == 0:
-        return 0.0
-    return float(np.dot(a, b) / (na * nb))
-
 def embed(texts: List[str]) -> List[List[float]]:
+    """Embeds texts in as few batched requests as the API limits allow (see embeddings.embed_many)."""
     logger.info(f"≡ƒöñ Generating embeddings for {len(texts)} texts...")
-    resp = client.embeddings.create(model=EMBED_MODEL, input=texts)
+    vectors = embed_many(texts)
     logger.info(f"Γ£à Embeddings generated")
-    return [d.embedding for d in resp.data]
-
-def build_reference_text(q: Dict[str, Any]) -> str:
-    parts = [
-        q.get("questionText", ""),
-        q.get("referenceAnswer", ""),
-        " ".join(q.get("evaluationCriteria", {}).get("mustIncludePoints", []) or []),
-        q.get("evaluationCriteria", {}).get("fullMarksRequirements", "") or "",
-    ]
-    
-    concept_bits = []
-    for c in q.get("concepts", []) or []:
-        concept_bits.append(c.get("description", ""))
-        kws = c.get("keywords", []) or []
-        if isinstance(kws, list):
-            concept_bits.append(" ".join(kws))
-    parts.append(" ".join(concept_bits))
-    
-    ref = "\n".join([p for p in parts if p and isinstance(p, str)])
-    return ref if ref.strip() else q.get("questionText", "")
+    return vectors
+
+# Per-question scheme fields read for scoring (see build_reference_text)
+SCORING_QUESTION_FIELDS = [
+    "questionNumber", "maxMarks", "questionText", "referenceAnswer",
+    "evaluationCriteria.mustIncludePoints", "evaluationCriteria.fullMarksRequirements",
+    "concepts.conceptId", "concepts.description", "concepts.keywords",
+]
+
+def load_reference_vectors(scheme_doc: Dict[str, Any], scheme_questions: List[Dict[str, Any]]) -> Dict[Any, Dict[str, Any]]:
+    """
+    Reference vectors per question number ({"vector", "concepts": {conceptId: vector}}).
+    Vectors precomputed at scheme ingest are reused; missing or stale ones (scheme text or
+    EMBED_MODEL changed) are embedded once and written back for the next student.
+    """
+    stored = scheme_doc.get("referenceEmbeddings")
+    document, computed = refresh_reference_embeddings(scheme_questions, stored)
+    if computed:
+        logger.info(f"≡ƒöä Refreshed {computed} reference embedding(s) ({EMBED_MODEL})")
+        try:
+            col_schema.update_one({"_id": scheme_doc["_id"]}, {"$set": {"referenceEmbeddings": document}})
+        except Exception as e:
+            logger.warning(f"Could not store reference embeddings: {e}")
+    else:
+        logger.info(f"Γ£à Using precomputed reference embeddings ({EMBED_MODEL})")
+    return {
+        entry["questionNumber"]: {
+            "vector": entry["vector"],
+            "concepts": {c["conceptId"]: c["vector"] for c in entry.get("concepts", [])},
+        }
+        for entry in document["questions"]
+    }
 
 def aggregate_student_answers(pages: List[Dict[str, Any]]) -> str:
     pages_sorted = sorted(pages, key=lambda x: x.get("pageNumber", 0))
@@ -166,89 +168,10 @@ Rules:
     try:
         logger.info(f"🤖 Calling AI for verification (Q{question_number})...")
         
-        # Get available models from API
-        available_model_names = []
-        try:
-            for model in genai.list_models():
-                if 'generateContent' in model.supported_generation_methods:
-                    # Use the full model name as returned by the API
-                    available_model_names.append(model.name)
-            if available_model_names:
-                logger.info(f"≡ƒôï Found {len(available_model_names)} available Gemini models")
-        except Exception as e:
-            logger.debug(f"Could not list models: {str(e)}, using fallback list")
-        
-        # Build model list: prioritize available models, then try common names
-        model_names = []
-        if available_model_names:
-            # Prefer flash model (faster) then pro model
-            preferred_order = []
-            for pref in ["flash", "pro"]:
-                for model_name in available_model_names:
-                    if pref in model_name.lower() and model_name not in preferred_order:
-                        preferred_order.append(model_name)
-            # Add any remaining models
-            for model_name in available_model_names:
-                if model_name not in preferred_order:
-                    preferred_order.append(model_name)
-            model_names = preferred_order
-        else:
-            # Fallback: try common model names without 'models/' prefix
-            # The SDK will handle adding the prefix if needed
-            model_names = [
-                "gemini-1.5-flash",
-                "gemini-1.5-pro",
-                "gemini-pro"
-            ]
-        
-        last_error = None
-        text = None
-        
-        for model_name in model_names:
-            try:
-                logger.debug(f"Trying model: {model_name}")
-                model = genai.GenerativeModel(model_name)
-                response = model.generate_content(prompt)
-                
-                # Handle response safely
-                if not response:
-                    raise Exception("Empty response from AI")
-                
-                # Check for blocked content or errors
-                if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
-                    if hasattr(response.prompt_feedback, 'block_reason') and response.prompt_feedback.block_reason:
-                        raise Exception(f"Content blocked: {response.prompt_feedback.block_reason}")
-                
-                # Get text from response
-                if hasattr(response, 'text'):
-                    text = response.text
-                elif hasattr(response, 'candidates') and response.candidates and len(response.candidates) > 0:
-                    candidate = response.candidates[0]
-                    if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
-                        text_parts = [part.text for part in candidate.content.parts if hasattr(part, 'text')]
-                        text = ' '.join(text_parts)
-                
-                if text:
-                    model_display = model_name.split('/')[-1]  # Just show the model name part
-                    logger.info(f"Γ£à Successfully used model: {model_display}")
-                    break
-                else:
-                    raise Exception("No text content in AI response")
-                    
-            except Exception as e:
-                last_error = e
-                error_msg = str(e)
-                # Log more details for debugging
-                if "404" in error_msg or "not found" in error_msg.lower():
-                    logger.debug(f"Model {model_name} not found: {error_msg}")
-                else:
-                    logger.debug(f"Model {model_name} failed: {error_msg}")
-                continue
-        
-        if not text:
-            error_details = f"Last error: {last_error}" if last_error else "Unknown error"
-            available_info = f"Tried {len(model_names)} models: {[m.split('/')[-1] for m in model_names[:3]]}" if model_names else "No models to try"
-            raise Exception(f"All AI models failed. {error_details}. {available_info}")
+        # Model discovery, failover and client reuse live in the registry
+        text, model_name = gemini_registry.generate(prompt, tokens=estimate_tokens(prompt, max_output=200))
+        model_display = model_name.split('/')[-1]  # Just show the model name part
+        logger.info(f"Γ£à Successfully used model: {model_display}")
         
         # Parse JSON response
         cleaned_text = text.strip().strip("`").strip("json").strip()
@@ -282,142 +205,221 @@ Rules:
             "gemini_marks": 0
         }
 
-def compare_and_score(exam_id: str, student_id: str) -> Dict[str, Any]:
-    logger.info("\n" + "="*60)
-    logger.info("ΓÜû∩╕Å  EVALUATION STARTED")
-    logger.info("="*60)
-    logger.info(f"≡ƒåö Exam ID: {exam_id}")
-    logger.info(f"≡ƒæñ Student ID: {student_id}")
-    
-    exam_id = validate_id(exam_id, "exam_id")
-    student_id = validate_id(student_id, "student_id")
-    
-    logger.info(f"≡ƒôï Exam ID validated: {exam_id}")
-    logger.info(f"≡ƒôï Student ID validated: {student_id}")
+def load_exam_answers(exam_id: str, student_ids: List[str] = None) -> Dict[str, Dict[int, Dict[str, Any]]]:
+    """
+    {studentId: {questionNumber: {answerText, confidence}}} for all students of an exam
+    (or only student_ids). Per-question documents segmented at ingest are read in one
+    query; students ingested before segmentation existed fall back to grouping their
+    pages by questionNumber (one more query for all of them).
+    """
+    query = {"examId": exam_id}
+    if student_ids is not None:
+        query["studentId"] = {"$in": list(student_ids)}
 
-    # 1) Load scheme
-    logger.info("\n--- Step 1: Loading Marking Scheme ---")
-    scheme_doc = col_schema.find_one({"examId": exam_id}, sort=[("_id", -1)])
+    answers: Dict[str, Dict[int, Dict[str, Any]]] = defaultdict(dict)
+    for a in col_student_questions.find(query, {"studentId": 1, "questionNumber": 1, "answerText": 1, "confidence": 1}):
+        answers[a["studentId"]][a["questionNumber"]] = {"answerText": a.get("answerText", ""),
+                                                        "confidence": float(a.get("confidence", 0) or 0)}
+
+    if student_ids is not None:
+        unsegmented = {"examId": exam_id, "studentId": {"$in": [s for s in student_ids if s not in answers]}}
+    else:
+        unsegmented = {"examId": exam_id, "studentId": {"$nin": list(answers)}}
+    if student_ids is None or unsegmented["studentId"]["$in"]:
+        pages_by_student: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for p in col_student.find(unsegmented, {"studentId": 1, "pageNumber": 1, "questionNumber": 1,
+                                                "rawText": 1, "confidence": 1}):
+            pages_by_student[p["studentId"]].append(p)
+        for sid, student_pages in pages_by_student.items():
+            # Group by question number
+            grouped: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+            for p in student_pages:
+                qn = p.get("questionNumber", -1)
+                if isinstance(qn, int) and qn > 0:
+                    grouped[qn].append(p)
+            for qn, pages in grouped.items():
+                confs = [float(p.get("confidence", 0)) for p in pages if "confidence" in p]
+                answers[sid][qn] = {"answerText": aggregate_student_answers(pages),
+                                    "confidence": sum(confs) / len(confs) if confs else 0.0}
+            # A student whose pages carry no question numbers still has a (blank) script
+            answers.setdefault(sid, {})
+    return dict(answers)
+
+def load_student_answers(exam_id: str, student_id: str) -> Dict[int, Dict[str, Any]]:
+    """{questionNumber: {answerText, confidence}} for one student (see load_exam_answers)."""
+    answers = load_exam_answers(exam_id, [student_id])
+    if student_id not in answers:
+        logger.error("Γ¥î No student answers found")
+        raise RuntimeError("No student answers found for given examId + studentId in ai_evaluation_system")
+    logger.info(f"Γ£à Found answers for {len(answers[student_id])} question(s)")
+    return answers[student_id]
+
+def load_scoring_scheme(exam_id: str):
+    """Returns (scheme record, scheme questions, reference vectors per question number)."""
+    scheme_doc = find_scheme(col_schema, exam_id, SCORING_QUESTION_FIELDS,
+                             ["subjectId", "professorId", "referenceEmbeddings"])
     if not scheme_doc:
         logger.error("Γ¥î No scheme found for given examId in schema_db.schema_extracted_answers")
         raise RuntimeError("No scheme found for given examId in schema_db.schema_extracted_answers")
 
     logger.info(f"Γ£à Scheme found: {scheme_doc.get('_id')}")
-    
-    structured = safe_json_loads(scheme_doc.get("structuredData", "{}"))
+
+    structured = scheme_doc["structuredData"]
     scheme_questions = structured.get("questions", [])
-    
+
     if not scheme_questions:
         logger.error("Γ¥î Scheme has no parsed questions")
         raise RuntimeError("Scheme has no parsed questions")
-    
-    logger.info(f"≡ƒô¥ Scheme has {len(scheme_questions)} questions")
-
-    # 2) Load student OCR answers
-    logger.info("\n--- Step 2: Loading Student Answers ---")
-    student_pages = list(col_student.find({"examId": exam_id, "studentId": student_id}))
-    
-    if not student_pages:
-        logger.error("Γ¥î No student answers found")
-        raise RuntimeError("No student answers found for given examId + studentId in ai_evaluation_system")
 
-    logger.info(f"Γ£à Found {len(student_pages)} pages of student answers")
-    
-    # Group by question number
-    grouped: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
-    for p in student_pages:
-        qn = p.get("questionNumber", -1)
-        if isinstance(qn, int) and qn > 0:
-            grouped[qn].append(p)
-    
-    logger.info(f"≡ƒôè Grouped into {len(grouped)} questions")
-    for qn, pages in grouped.items():
-        logger.info(f"   Q{qn}: {len(pages)} page(s)")
-
-    # 3) Evaluate each question
-    logger.info("\n--- Step 3: Evaluating Each Question ---")
-    per_question_results = []
-    total_scored = 0
-    total_max = 0
+    logger.info(f"≡ƒô¥ Scheme has {len(scheme_questions)} questions")
+    return scheme_doc, scheme_questions, load_reference_vectors(scheme_doc, scheme_questions)
 
-    for idx, q in enumerate(scheme_questions):
-        qn = q.get("questionNumber")
-        max_marks = q.get("maxMarks", 0) or 0
-        total_max += max_marks
+def unit_rows(matrix: np.ndarray) -> np.ndarray:
+    """Rows scaled to unit length along the last axis; all-zero rows stay zero."""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
 
+def similarity_matrix(student_ids: List[str], question_numbers: List[Any],
+                      answer_vectors: Dict[tuple, List[float]], reference_vectors: Dict[Any, Dict[str, Any]]):
+    """
+    Cosine similarity of every (student, question) answer with its reference as one
+    float32 einsum over normalized vectors. Returns (students x questions matrix,
+    {(studentId, questionNumber): [{conceptId, similarity}]}). Missing answers score 0.
+    """
+    dims = {len(v) for v in answer_vectors.values() if len(v)}
+    dims |= {len(r["vector"]) for r in reference_vectors.values() if len(r["vector"])}
+    dim = max(dims) if dims else 1
+    s_index = {sid: i for i, sid in enumerate(student_ids)}
+    q_index = {qn: j for j, qn in enumerate(question_numbers)}
+
+    answers = np.zeros((len(student_ids), len(question_numbers), dim), dtype=np.float32)
+    for (sid, qn), vector in answer_vectors.items():
+        if len(vector) == dim:
+            answers[s_index[sid], q_index[qn]] = vector
+    references = np.zeros((len(question_numbers), dim), dtype=np.float32)
+    for qn, j in q_index.items():
+        vector = reference_vectors.get(qn, {}).get("vector") or []
+        if len(vector) == dim:
+            references[j] = vector
+    answers = unit_rows(answers)
+    similarities = np.einsum("sqd,qd->sq", answers, unit_rows(references))
+
+    # Per-concept similarities against the answer of the concept's question
+    concept_keys, concept_rows = [], []
+    for qn, j in q_index.items():
+        for concept_id, vector in reference_vectors.get(qn, {}).get("concepts", {}).items():
+            if len(vector) == dim:
+                concept_keys.append((qn, j, concept_id))
+                concept_rows.append(vector)
+    concept_similarities: Dict[tuple, List[Dict[str, Any]]] = defaultdict(list)
+    if concept_rows:
+        concepts = unit_rows(np.asarray(concept_rows, dtype=np.float32))
+        owners = np.array([j for _, j, _ in concept_keys])
+        per_concept = np.einsum("skd,kd->sk", answers[:, owners, :], concepts)
+        for (sid, qn) in answer_vectors:
+            i = s_index[sid]
+            for k, (concept_qn, _, concept_id) in enumerate(concept_keys):
+                if concept_qn == qn:
+                    concept_similarities[(sid, qn)].append(
+                        {"conceptId": concept_id, "similarity": round(float(per_concept[i, k]), 4)})
+    return similarities, concept_similarities
+
+def score_question(q: Dict[str, Any], answer: Dict[str, Any], similarity: float,
+                   concept_similarities: List[Dict[str, Any]], verbose: bool = True) -> Dict[str, Any]:
+    """Marks and flags of one answer; AI verification is added by finish_question."""
+    qn = q.get("questionNumber")
+    max_marks = q.get("maxMarks", 0) or 0
+    if verbose:
         logger.info(f"\n≡ƒöì Evaluating Question {qn} (Max: {max_marks} marks)")
-        
-        reference_text = build_reference_text(q)
-        logger.info(f"   Reference text length: {len(reference_text)} characters")
 
-        student_text = ""
-        ocr_conf_avg = 0.0
-        
-        if qn in grouped:
-            student_text = aggregate_student_answers(grouped[qn])
-            confs = [float(p.get("confidence", 0)) for p in grouped[qn] if "confidence" in p]
-            ocr_conf_avg = sum(confs) / len(confs) if confs else 0.0
+    student_text = ""
+    ocr_conf_avg = 0.0
+    if answer is not None:
+        student_text = answer["answerText"]
+        ocr_conf_avg = answer["confidence"]
+        if verbose:
             logger.info(f"   Student answer length: {len(student_text)} characters")
             logger.info(f"   Average OCR confidence: {ocr_conf_avg:.2f}")
-        else:
-            logger.warning(f"   ΓÜá∩╕Å  No student answer found for Q{qn}")
+    elif verbose:
+        logger.warning(f"   ΓÜá∩╕Å  No student answer found for Q{qn}")
 
-        # Calculate similarity
-        if not student_text.strip():
-            similarity = 0.0
-            scored_marks = 0
+    if not student_text.strip():
+        similarity = 0.0
+        scored_marks = 0
+        concept_similarities = []
+        if verbose:
             logger.warning(f"   ≡ƒôë No answer provided: 0 marks")
-        else:
-            [e_ref, e_student] = embed([reference_text, student_text])
-            similarity = cosine(e_ref, e_student)
-            scored_marks = int(round(max(0.0, min(1.0, similarity)) * max_marks))
-            
+    else:
+        similarity = float(similarity)
+        scored_marks = int(round(max(0.0, min(1.0, similarity)) * max_marks))
+        if verbose:
             logger.info(f"   ≡ƒÄ» Similarity: {similarity:.4f}")
             logger.info(f"   Γ£à Scored: {scored_marks}/{max_marks} marks")
 
-        total_scored += scored_marks
-
-        # Flags
-        q_flags = flags_for(similarity, ocr_conf_avg)
-        if q_flags:
-            logger.warning(f"   ≡ƒÜ⌐ Flags: {', '.join(q_flags)}")
-
-        # AI verification
-        verification = verify_with_gemini(qn, student_text, reference_text, scored_marks,
-                                         similarity, ocr_conf_avg, max_marks)
-        if verification.get("verificationFlag", False):
-            q_flags.append("GEMINI_VERIFICATION_FLAG")
-            q_flags.append(f"Reason: {verification.get('reason', '')}")
-            logger.warning(f"   🤖 AI flagged: {verification.get('reason')}")
-
-        per_question_results.append({
-            "questionNumber": qn,
-            "maxMarks": max_marks,
-            "scoredMarks": scored_marks,
-            "gemini_marks": verification.get("gemini_marks", 0),
-            "similarity": round(similarity, 4),
-            "ocrConfidenceAvg": round(ocr_conf_avg, 3),
-            "flags": q_flags,
-            "verification": verification,
-        })
-
-    # Overall results
+    # Flags
+    q_flags = flags_for(similarity, ocr_conf_avg)
+    if q_flags and verbose:
+        logger.warning(f"   ≡ƒÜ⌐ Flags: {', '.join(q_flags)}")
+
+    return {
+        "questionNumber": qn,
+        "maxMarks": max_marks,
+        "scoredMarks": scored_marks,
+        "similarity": similarity,
+        "ocrConfidenceAvg": ocr_conf_avg,
+        "conceptSimilarities": concept_similarities,
+        "flags": q_flags,
+        "studentText": student_text,
+        "referenceText": build_reference_text(q),
+    }
+
+def verify_question(scored: Dict[str, Any]) -> Dict[str, Any]:
+    return verify_with_gemini(scored["questionNumber"], scored["studentText"], scored["referenceText"],
+                              scored["scoredMarks"], scored["similarity"], scored["ocrConfidenceAvg"],
+                              scored["maxMarks"])
+
+def verify_all(scored_questions: List[Dict[str, Any]], workers: int = VERIFY_WORKERS) -> List[Dict[str, Any]]:
+    """
+    AI verification of every scored answer, VERIFY_WORKERS at a time (questions do not
+    depend on each other; Gemini rate limits still apply through the scheduler).
+    Results are returned in input order.
+    """
+    if workers <= 1 or len(scored_questions) <= 1:
+        return [verify_question(scored) for scored in scored_questions]
+    with ThreadPoolExecutor(max_workers=min(workers, len(scored_questions))) as executor:
+        return list(executor.map(verify_question, scored_questions))
+
+def finish_question(scored: Dict[str, Any], verification: Dict[str, Any], verbose: bool = True) -> Dict[str, Any]:
+    """The per-question result entry: scoring plus AI verification."""
+    q_flags = scored["flags"]
+    if verification.get("verificationFlag", False):
+        q_flags.append("GEMINI_VERIFICATION_FLAG")
+        q_flags.append(f"Reason: {verification.get('reason', '')}")
+        if verbose:
+            logger.warning(f"   🤖 AI flagged Q{scored['questionNumber']}: {verification.get('reason')}")
+
+    return {
+        "questionNumber": scored["questionNumber"],
+        "maxMarks": scored["maxMarks"],
+        "scoredMarks": scored["scoredMarks"],
+        "gemini_marks": verification.get("gemini_marks", 0),
+        "similarity": round(scored["similarity"], 4),
+        "ocrConfidenceAvg": round(scored["ocrConfidenceAvg"], 3),
+        "conceptSimilarities": scored["conceptSimilarities"],
+        "flags": q_flags,
+        "verification": verification,
+    }
+
+def build_result_doc(exam_id: str, student_id: str, scheme_doc: Dict[str, Any],
+                     per_question_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    total_max = sum(q["maxMarks"] for q in per_question_results)
+    total_scored = sum(q["scoredMarks"] for q in per_question_results)
     overall = {
         "totalMaxMarks": total_max,
         "totalScoredMarks": total_scored,
         "percentage": round((total_scored / total_max) * 100, 2) if total_max > 0 else 0.0
     }
-
-    logger.info("\n" + "="*60)
-    logger.info(f"≡ƒôè EVALUATION SUMMARY")
-    logger.info("="*60)
-    logger.info(f"   Total Score: {total_scored}/{total_max} ({overall['percentage']}%)")
-    logger.info(f"   Questions Evaluated: {len(per_question_results)}")
-    logger.info(f"   Flagged Questions: {sum(1 for q in per_question_results if q['flags'])}")
-    logger.info("="*60)
-
-    # Build result document
-    result_doc = {
+    return {
         "examId": exam_id,
         "studentId": student_id,
         "subjectId": scheme_doc.get("subjectId"),
@@ -438,36 +440,171 @@ def compare_and_score(exam_id: str, student_id: str) -> Dict[str, Any]:
         "overall": overall
     }
 
-    # 4) Store in result_db
-    logger.info("\n--- Step 4: Saving Results ---")
-    # Use replace_one with upsert to update existing or insert new
-    result = col_results.replace_one(
-        {'examId': exam_id, 'studentId': student_id},
-        result_doc,
-        upsert=True
-    )
+def score_students(exam_id: str, scheme_doc: Dict[str, Any], scheme_questions: List[Dict[str, Any]],
+                   reference_vectors: Dict[Any, Dict[str, Any]], answers_by_student: Dict[str, Dict[int, Dict[str, Any]]],
+                   verbose: bool = False) -> List[Dict[str, Any]]:
+    """
+    Result documents for every student in answers_by_student. All answers are embedded
+    together (embed_many packs them into as few requests as the API limits allow) and
+    all similarities come from one matrix product.
+    """
+    student_ids = sorted(answers_by_student)
+    question_numbers = [q.get("questionNumber") for q in scheme_questions]
+    scheme_numbers = set(question_numbers)
+
+    keys = [(sid, qn) for sid in student_ids for qn, a in answers_by_student[sid].items()
+            if qn in scheme_numbers and a["answerText"].strip()]
+    vectors = embed([answers_by_student[sid][qn]["answerText"] for sid, qn in keys]) if keys else []
+    similarities, concept_similarities = similarity_matrix(student_ids, question_numbers,
+                                                           dict(zip(keys, vectors)), reference_vectors)
+
+    scored = [
+        [score_question(q, answers_by_student[sid].get(q.get("questionNumber")), similarities[i, j],
+                        concept_similarities.get((sid, q.get("questionNumber")), []), verbose)
+         for j, q in enumerate(scheme_questions)]
+        for i, sid in enumerate(student_ids)
+    ]
+    # Verification is the slow part: all answers of all students go through one worker pool
+    verifications = iter(verify_all([entry for row in scored for entry in row]))
+
+    result_docs = []
+    for sid, row in zip(student_ids, scored):
+        per_question_results = [finish_question(entry, next(verifications), verbose) for entry in row]
+        result_docs.append(build_result_doc(exam_id, sid, scheme_doc, per_question_results))
+    return result_docs
+
+def save_results(result_docs: List[Dict[str, Any]]):
+    """Upserts all result documents (one per exam/student) with a single bulk_write."""
+    if not result_docs:
+        return
+    result = col_results.bulk_write([
+        ReplaceOne({'examId': doc["examId"], 'studentId': doc["studentId"]}, doc, upsert=True)
+        for doc in result_docs
+    ], ordered=False)
+    for index, upserted_id in result.upserted_ids.items():
+        result_docs[index]["_id"] = upserted_id
+    logger.info(f"Γ£à Saved {len(result_docs)} evaluation(s): {result.upserted_count} inserted, "
+                f"{result.modified_count} updated")
+
+def compare_and_score(exam_id: str, student_id: str) -> Dict[str, Any]:
+    logger.info("\n" + "="*60)
+    logger.info("ΓÜû∩╕Å  EVALUATION STARTED")
+    logger.info("="*60)
+    logger.info(f"≡ƒåö Exam ID: {exam_id}")
+    logger.info(f"≡ƒæñ Student ID: {student_id}")
     
-    if result.upserted_id:
-        logger.info(f"Γ£à Inserted new evaluation with ID: {result.upserted_id}")
-        result_doc["_id"] = result.upserted_id
-    else:
-        logger.info(f"Γ£à Updated existing evaluation for {student_id}")
+    exam_id = validate_id(exam_id, "exam_id")
+    student_id = validate_id(student_id, "student_id")
     
+    logger.info(f"≡ƒôï Exam ID validated: {exam_id}")
+    logger.info(f"≡ƒôï Student ID validated: {student_id}")
+
+    # 1) Load scheme
+    logger.info("\n--- Step 1: Loading Marking Scheme ---")
+    scheme_doc, scheme_questions, reference_vectors = load_scoring_scheme(exam_id)
+
+    # 2) Load student OCR answers
+    logger.info("\n--- Step 2: Loading Student Answers ---")
+    answers = load_student_answers(exam_id, student_id)
+
+    # 3) Evaluate each question (same scoring path as evaluate_exam, for one student)
+    logger.info("\n--- Step 3: Evaluating Each Question ---")
+    [result_doc] = score_students(exam_id, scheme_doc, scheme_questions, reference_vectors,
+                                  {student_id: answers}, verbose=True)
+    per_question_results = result_doc["perQuestion"]
+    overall = result_doc["overall"]
+
+    logger.info("\n" + "="*60)
+    logger.info(f"≡ƒôè EVALUATION SUMMARY")
+    logger.info("="*60)
+    logger.info(f"   Total Score: {overall['totalScoredMarks']}/{overall['totalMaxMarks']} ({overall['percentage']}%)")
+    logger.info(f"   Questions Evaluated: {len(per_question_results)}")
+    logger.info(f"   Flagged Questions: {sum(1 for q in per_question_results if q['flags'])}")
+    logger.info("="*60)
+
+    # 4) Store in result_db
+    logger.info("\n--- Step 4: Saving Results ---")
+    save_results([result_doc])
+    gemini_registry.flush()
+    logger.info(f"≡ƒôè Embedding cache: {embedding_cache.snapshot()}")
+    logger.info(f"≡ƒôè Gemini models: {gemini_registry.snapshot()}")
     return result_doc
 
+def evaluate_exam(exam_id: str, student_ids: List[str] = None) -> Dict[str, Any]:
+    """
+    Evaluates all students of an exam (or only student_ids) in one pass: the scheme and
+    all answers are loaded once, answers embedded in large batches, similarities computed
+    as one students x questions matrix and results written with one bulk_write.
+    Per-student result documents are the same as compare_and_score's.
+    """
+    started = time.perf_counter()
+    exam_id = validate_id(exam_id, "exam_id")
+    logger.info(f"\n--- Exam evaluation: {exam_id} ---")
+    scheme_doc, scheme_questions, reference_vectors = load_scoring_scheme(exam_id)
+
+    answers_by_student = load_exam_answers(exam_id, student_ids)
+    failed = [{"studentId": sid, "error": "No student answers found"}
+              for sid in (student_ids or []) if sid not in answers_by_student]
+    logger.info(f"≡ƒæÑ {len(answers_by_student)} student(s) with answers, {len(failed)} without")
+
+    result_docs = score_students(exam_id, scheme_doc, scheme_questions, reference_vectors, answers_by_student)
+    save_results(result_docs)
+    gemini_registry.flush()
+
+    for doc in result_docs:
+        o = doc["overall"]
+        logger.info(f"   {doc['studentId']:<20} {o['totalScoredMarks']}/{o['totalMaxMarks']} ({o['percentage']}%)")
+    return {
+        "examId": exam_id,
+        "evaluated": len(result_docs),
+        "failed": failed,
+        "seconds": round(time.perf_counter() - started, 2),
+        "embeddingCache": embedding_cache.snapshot(),
+        "geminiModels": gemini_registry.snapshot(),
+        "students": [{"studentId": d["studentId"], **d["overall"]} for d in result_docs],
+    }
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Compare student answers with scheme and score.")
     parser.add_argument("--exam-id", required=True, help="Exam ID (any string format)")
-    parser.add_argument("--student-id", required=True, help="Student ID (any string format)")
+    parser.add_argument("--student-id", help="Student ID (any string format)")
+    parser.add_argument("--all-students", action="store_true",
+                        help="Evaluate every student with OCR answers for the exam in one pass")
+    parser.add_argument("--student-ids", nargs="+", metavar="STUDENT_ID",
+                        help="Student IDs to evaluate in one pass (space- or comma-separated)")
+    parser.add_argument("--json", action="store_true", help="Print the exam evaluation summary as JSON on stdout")
+    parser.add_argument("--hedge", action="store_true",
+                        help="Send a duplicate embedding request when one is slower than usual (see API_HEDGE_*)")
     args = parser.parse_args()
+    if sum(bool(x) for x in (args.student_id, args.all_students, args.student_ids)) != 1:
+        parser.error("give exactly one of --student-id, --all-students or --student-ids")
+    student_ids = None
+    if args.student_ids is not None:
+        student_ids = list(dict.fromkeys(s.strip() for arg in args.student_ids for s in arg.split(",") if s.strip()))
+        if not student_ids:
+            parser.error("--student-ids needs at least one non-empty student ID")
+    if args.hedge:
+        scheduler.hedging = True
+
+    if args.student_id:
+        try:
+            out = compare_and_score(args.exam_id, args.student_id)
+            logger.info("\nΓ£à SUCCESS: Evaluation completed")
+            logger.info(f"   Score: {out['overall']['totalScoredMarks']}/{out['overall']['totalMaxMarks']}")
+            sys.exit(0)
+        except Exception as e:
+            logger.error(f"\nΓ¥î FATAL ERROR: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            sys.exit(1)
 
     try:
-        out = compare_and_score(args.exam_id, args.student_id)
-        logger.info("\nΓ£à SUCCESS: Evaluation completed")
-        logger.info(f"   Score: {out['overall']['totalScoredMarks']}/{out['overall']['totalMaxMarks']}")
-        sys.exit(0)
+        summary = evaluate_exam(args.exam_id, student_ids)
     except Exception as e:
         logger.error(f"\nΓ¥î FATAL ERROR: {str(e)}")
-        import traceback
-        traceback.print_exc()
         sys.exit(1)
+    logger.info(f"\nΓ£à Evaluated {summary['evaluated']} student(s) in {summary['seconds']}s; "
+                f"{len(summary['failed'])} failed")
+    if args.json:
+        print(json.dumps(summary))
+    sys.exit(1 if summary["failed"] or not summary["evaluated"] else 0)
@@ -0,0 +1,386 @@
+"""
+Embedding helpers shared by scheme_extractor.py and comparator.py.
+
+Reference-answer vectors (and optionally one per concept) are computed when a scheme
+is ingested and stored on the scheme record:
+
+    referenceEmbeddings: {
+        "model": "text-embedding-3-small",
+        "concepts": <bool>,
+        "questions": [{"questionNumber", "textHash", "vector",
+                       "concepts": [{"conceptId", "textHash", "vector"}]}]
+    }
+
+A vector is only reused while its textHash matches the current reference text and the
+model matches EMBED_MODEL; anything else is recomputed by refresh_reference_embeddings.
+
+embed_many packs any number of texts into as few embeddings requests as the per-request
+input and token limits allow. Texts longer than one input are split into chunks whose
+vectors are pooled (length-weighted mean), so long answers are neither rejected nor truncated.
+
+Vectors are cached by (model, sha256 of the text): an in-process LRU in front of a Mongo
+collection (attached by the script that owns the connection) holding vectors packed as
+little-endian float32 (or float16, EMBED_CACHE_DTYPE) bytes. Re-embedding unchanged text
+costs no API call; cached and fresh vectors are both returned at the stored precision.
+"""
+
+import hashlib
+import logging
+import math
+import os
+import re
+import struct
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from bson import Binary
+from openai import OpenAI
+from pymongo import UpdateOne
+
+from api_scheduler import scheduler, estimate_tokens
+
+EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
+# Per-request limits of the embeddings API (text-embedding-3-*: 8191 tokens per input,
+# 2048 inputs and 300k tokens per request), with some headroom on the token counts
+EMBED_MAX_INPUT_TOKENS = int(os.getenv("EMBED_MAX_INPUT_TOKENS", "8000"))
+EMBED_MAX_BATCH_INPUTS = int(os.getenv("EMBED_MAX_BATCH_INPUTS", "2048"))
+EMBED_MAX_BATCH_TOKENS = int(os.getenv("EMBED_MAX_BATCH_TOKENS", "280000"))
+# Token counts are estimated without a tokenizer; 3 characters per token over-counts
+# English text, so estimates stay on the safe side of the limits
+EMBED_CHARS_PER_TOKEN = 3
+# Embedding cache: packed vector precision, in-process LRU size (0 disables it) and
+# days an unused Mongo entry is kept (TTL index on lastUsedAt)
+EMBED_CACHE_DTYPE = os.getenv("EMBED_CACHE_DTYPE", "float32")
+EMBED_CACHE_LRU_ENTRIES = int(os.getenv("EMBED_CACHE_LRU_ENTRIES", "4096"))
+EMBED_CACHE_TTL_DAYS = int(os.getenv("EMBED_CACHE_TTL_DAYS", "90"))
+PACK_FORMATS = {"float32": ("f", 4), "float16": ("e", 2)}
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> OpenAI:
+    global _client
+    with _client_lock:
+        if _client is None:
+            # Retries, backoff and rate limits are handled by api_scheduler
+            _client = OpenAI(max_retries=0)
+        return _client
+
+
+def embed_texts(texts: List[str], model: str = EMBED_MODEL) -> List[List[float]]:
+    """One embeddings request for all texts, in order."""
+    if not texts:
+        return []
+    resp = scheduler.hedged("openai", model, get_client().embeddings.create,
+                            tokens=estimate_tokens("".join(texts), max_output=0),
+                            model=model, input=texts)
+    return [d.embedding for d in resp.data]
+
+
+def pack_vector(vector: List[float], dtype: str = EMBED_CACHE_DTYPE) -> bytes:
+    code, _ = PACK_FORMATS[dtype]
+    return struct.pack(f"<{len(vector)}{code}", *vector)
+
+
+def unpack_vector(data: bytes, dtype: str = EMBED_CACHE_DTYPE) -> List[float]:
+    code, size = PACK_FORMATS[dtype]
+    return list(struct.unpack(f"<{len(data) // size}{code}", data))
+
+
+def bson_array_bytes(length: int) -> int:
+    """Size of a BSON array of `length` doubles (what a plain list of floats is stored as)."""
+    return 5 + sum(10 + len(str(i)) for i in range(length))
+
+
+class EmbeddingCache:
+    """
+    Embedding vectors keyed by (model, sha256(text)). Lookups go to the in-process LRU,
+    then to the Mongo collection if one is attached; entries are written to both.
+    Mongo errors are logged and treated as misses, so the cache never fails a request.
+    """
+
+    def __init__(self, collection=None, max_entries: int = EMBED_CACHE_LRU_ENTRIES,
+                 dtype: str = EMBED_CACHE_DTYPE):
+        if dtype not in PACK_FORMATS:
+            raise ValueError(f"Unknown EMBED_CACHE_DTYPE '{dtype}'. Choose from: {', '.join(PACK_FORMATS)}")
+        self.collection = collection
+        self.max_entries = max_entries
+        self.dtype = dtype
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "store_hits": 0, "misses": 0, "stored": 0,
+                       "tokens_saved": 0, "bytes_saved": 0}
+
+    def attach(self, collection):
+        """Uses collection as the persistent layer (and ensures its TTL index)."""
+        self.collection = collection
+        try:
+            collection.create_index("lastUsedAt", expireAfterSeconds=EMBED_CACHE_TTL_DAYS * 24 * 3600)
+        except Exception as e:
+            logger.warning(f"Could not ensure embedding cache TTL index: {e}")
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return f"{model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def _remember(self, key: str, packed: bytes):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._lru[key] = packed
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+
+    def _count(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self._stats[name] += amount
+
+    def get_many(self, model: str, texts: List[str]) -> Dict[str, List[float]]:
+        """{text: vector} for the texts found in either layer."""
+        found, pending = {}, {}
+        with self._lock:
+            for text in texts:
+                key = self.key(model, text)
+                if key in self._lru:
+                    self._lru.move_to_end(key)
+                    found[text] = self._lru[key]
+                else:
+                    pending[key] = text
+        memory_hits = len(found)
+
+        if pending and self.collection is not None:
+            try:
+                entries = list(self.collection.find(
+                    {"_id": {"$in": list(pending)}, "dtype": self.dtype}, {"vector": 1}))
+                if entries:
+                    self.collection.update_many(
+                        {"_id": {"$in": [e["_id"] for e in entries]}},
+                        {"$set": {"lastUsedAt": datetime.utcnow()}, "$inc": {"hits": 1}})
+            except Exception as e:
+                logger.warning(f"Embedding cache lookup failed: {e}")
+                entries = []
+            for entry in entries:
+                packed = bytes(entry["vector"])
+                found[pending[entry["_id"]]] = packed
+                self._remember(entry["_id"], packed)
+
+        self._count(memory_hits=memory_hits, store_hits=len(found) - memory_hits,
+                    misses=len(texts) - len(found),
+                    tokens_saved=sum(approx_tokens(text) for text in found))
+        return {text: unpack_vector(packed, self.dtype) for text, packed in found.items()}
+
+    def put_many(self, model: str, vectors: Dict[str, List[float]]) -> Dict[str, List[float]]:
+        """Stores {text: vector}; returns the vectors at the stored precision."""
+        now = datetime.utcnow()
+        stored, operations = {}, []
+        for text, vector in vectors.items():
+            key = self.key(model, text)
+            packed = pack_vector(vector, self.dtype)
+            self._remember(key, packed)
+            stored[text] = unpack_vector(packed, self.dtype)
+            operations.append(UpdateOne(
+                {"_id": key},
+                {"$set": {"model": model, "dtype": self.dtype, "dimensions": len(vector),
+                          "vector": Binary(packed), "lastUsedAt": now},
+                 "$setOnInsert": {"createdAt": now, "hits": 0}},
+                upsert=True))
+        if operations and self.collection is not None:
+            try:
+                self.collection.bulk_write(operations, ordered=False)
+                self._count(stored=len(operations),
+                            bytes_saved=sum(bson_array_bytes(len(v)) - len(pack_vector(v, self.dtype))
+                                            for v in vectors.values()))
+            except Exception as e:
+                logger.warning(f"Embedding cache write failed: {e}")
+        return stored
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats, lru_entries=len(self._lru))
+        lookups = stats["memory_hits"] + stats["store_hits"] + stats["misses"]
+        stats["hit_rate"] = round((lookups - stats["misses"]) / lookups, 3) if lookups else 0.0
+        return stats
+
+
+# Process-wide cache used by embed_many; scripts with a Mongo connection attach its collection
+cache = EmbeddingCache()
+
+
+def approx_tokens(text: str) -> int:
+    return len(text) // EMBED_CHARS_PER_TOKEN + 1
+
+
+def split_for_embedding(text: str, max_tokens: int = EMBED_MAX_INPUT_TOKENS) -> List[str]:
+    """Splits text into chunks of at most max_tokens (estimated), at line, then word boundaries."""
+    max_chars = max(1, (max_tokens - 1) * EMBED_CHARS_PER_TOKEN)
+    if len(text) <= max_chars:
+        return [text]
+    chunks, current = [], ""
+    for piece in re.split(r"(?<=\n)|(?<= )", text):
+        while len(piece) > max_chars:
+            # A single line/word longer than a chunk is cut hard
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(piece[:max_chars])
+            piece = piece[max_chars:]
+        if len(current) + len(piece) > max_chars:
+            chunks.append(current)
+            current = ""
+        current += piece
+    if current.strip() or not chunks:
+        chunks.append(current)
+    return chunks
+
+
+def pack_batches(inputs: List[str], max_inputs: int = EMBED_MAX_BATCH_INPUTS,
+                 max_tokens: int = EMBED_MAX_BATCH_TOKENS) -> List[List[int]]:
+    """Greedy packing of input indices into requests within both limits, keeping input order."""
+    batches, current, current_tokens = [], [], 0
+    for i, text in enumerate(inputs):
+        tokens = approx_tokens(text)
+        if current and (len(current) >= max_inputs or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def pool_vectors(vectors: List[List[float]], weights: List[int]) -> List[float]:
+    """Weighted mean of chunk vectors, renormalized to unit length."""
+    if len(vectors) == 1:
+        return vectors[0]
+    total = float(sum(weights))
+    pooled = [sum(w * v[d] for v, w in zip(vectors, weights)) / total for d in range(len(vectors[0]))]
+    norm = math.sqrt(sum(x * x for x in pooled)) or 1.0
+    return [x / norm for x in pooled]
+
+
+def embed_many(texts: List[str], model: str = EMBED_MODEL, max_input_tokens: int = EMBED_MAX_INPUT_TOKENS,
+               max_inputs: int = EMBED_MAX_BATCH_INPUTS, max_tokens: int = EMBED_MAX_BATCH_TOKENS,
+               use_cache: bool = True) -> List[List[float]]:
+    """
+    One vector per text, in order, using the fewest embeddings requests the limits allow.
+    Blank texts are not sent (the API rejects empty input) and get an empty vector.
+    Cached texts, and repeats of a text, are not sent either.
+    """
+    unique = list(dict.fromkeys(text for text in texts if text.strip()))
+    vectors = cache.get_many(model, unique) if use_cache else {}
+    missing = [text for text in unique if text not in vectors]
+
+    inputs, owners = [], []
+    for n, text in enumerate(missing):
+        for chunk in split_for_embedding(text, max_input_tokens):
+            inputs.append(chunk)
+            owners.append(n)
+
+    chunk_vectors = [None] * len(inputs)
+    for batch in pack_batches(inputs, max_inputs, max_tokens):
+        for i, vector in zip(batch, embed_texts([inputs[i] for i in batch], model)):
+            chunk_vectors[i] = vector
+
+    grouped = [([], []) for _ in missing]
+    for i, n in enumerate(owners):
+        grouped[n][0].append(chunk_vectors[i])
+        grouped[n][1].append(len(inputs[i]))
+    computed = {text: pool_vectors(*grouped[n]) for n, text in enumerate(missing)}
+    vectors.update(cache.put_many(model, computed) if use_cache else computed)
+    return [vectors[text] if text.strip() else [] for text in texts]
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+
+def build_reference_text(q: Dict[str, Any]) -> str:
+    parts = [
+        q.get("questionText", ""),
+        q.get("referenceAnswer", ""),
+        " ".join(q.get("evaluationCriteria", {}).get("mustIncludePoints", []) or []),
+        q.get("evaluationCriteria", {}).get("fullMarksRequirements", "") or "",
+    ]
+
+    concept_bits = []
+    for c in q.get("concepts", []) or []:
+        concept_bits.append(c.get("description", ""))
+        kws = c.get("keywords", []) or []
+        if isinstance(kws, list):
+            concept_bits.append(" ".join(kws))
+    parts.append(" ".join(concept_bits))
+
+    ref = "\n".join([p for p in parts if p and isinstance(p, str)])
+    return ref if ref.strip() else q.get("questionText", "")
+
+
+def build_concept_text(c: Dict[str, Any]) -> str:
+    keywords = c.get("keywords", []) or []
+    parts = [c.get("description", ""), " ".join(keywords) if isinstance(keywords, list) else ""]
+    return "\n".join(p for p in parts if p)
+
+
+def refresh_reference_embeddings(questions: List[Dict[str, Any]], stored: Optional[Dict[str, Any]] = None,
+                                 concepts: Optional[bool] = None, model: str = EMBED_MODEL):
+    """
+    Returns (referenceEmbeddings document, number of vectors computed). Vectors in `stored`
+    whose model and text hash still match are kept; the rest are embedded with embed_many.
+    concepts=None keeps the stored setting (off for a new scheme).
+    """
+    stored = stored or {}
+    if concepts is None:
+        concepts = bool(stored.get("concepts"))
+    reusable = {}
+    if stored.get("model") == model:
+        for entry in stored.get("questions", []) or []:
+            reusable[("q", entry.get("questionNumber"))] = entry
+            for c in entry.get("concepts", []) or []:
+                reusable[("c", entry.get("questionNumber"), c.get("conceptId"))] = c
+
+    # (key, text) for every vector the scheme needs
+    wanted = []
+    for q in questions:
+        qn = q.get("questionNumber")
+        wanted.append((("q", qn), build_reference_text(q)))
+        if concepts:
+            for c in q.get("concepts", []) or []:
+                text = build_concept_text(c)
+                if text.strip():
+                    wanted.append((("c", qn, c.get("conceptId")), text))
+
+    vectors = {}
+    missing = []
+    for key, text in wanted:
+        entry = reusable.get(key)
+        if entry and entry.get("textHash") == text_hash(text) and entry.get("vector") is not None:
+            vectors[key] = entry["vector"]
+        else:
+            missing.append((key, text))
+    if missing:
+        for (key, _), vector in zip(missing, embed_many([text for _, text in missing], model)):
+            vectors[key] = vector
+
+    hashes = {key: text_hash(text) for key, text in wanted}
+    entries = []
+    for q in questions:
+        qn = q.get("questionNumber")
+        entry = {"questionNumber": qn, "textHash": hashes[("q", qn)], "vector": vectors[("q", qn)]}
+        if concepts:
+            entry["concepts"] = [
+                {"conceptId": c.get("conceptId"), "textHash": hashes[key], "vector": vectors[key]}
+                for c in q.get("concepts", []) or []
+                for key in [("c", qn, c.get("conceptId"))] if key in vectors
+            ]
+        entries.append(entry)
+
+    document = {"model": model, "concepts": concepts, "questions": entries,
+                "updatedAt": datetime.utcnow() if missing else stored.get("updatedAt", datetime.utcnow())}
+    return document, len(missing)
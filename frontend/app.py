@@ -5,6 +5,8 @@ Integrates with OCR extraction, scheme extraction, and comparison services
 
 import os
 import sys
+import csv
+import io
 import json
 import subprocess
 import logging
@@ -32,6 +34,10 @@ app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(__file__), 'static/uploads')
 ALLOWED_EXTENSIONS = {'pdf'}
+# A bulk upload OCRs a whole class in one subprocess, so it gets a much longer timeout
+BULK_INGEST_TIMEOUT = int(os.getenv("BULK_INGEST_TIMEOUT", "7200"))
+# Batch evaluation scores all selected students in one comparator run
+BATCH_EVALUATE_TIMEOUT = int(os.getenv("BATCH_EVALUATE_TIMEOUT", "3600"))
 
 # Ensure upload folder exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -48,6 +54,7 @@ except Exception as e:
 # Database connections
 db_student = mongo["ai_evaluation_system"]
 col_ocr_answers = db_student["ocr_extracted_answers"]
+col_question_answers = db_student["ocr_question_answers"]
 
 db_schema = mongo["schema_db"]
 col_schema = db_schema["schema_extracted_answers"]
@@ -82,14 +89,26 @@ def convert_to_objectid(id_str: str, field_name: str = "ID") -> ObjectId:
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def run_cli_command(script_name, args):
+# Student column names accepted in a bulk manifest (as in bulk_ingest.py)
+MANIFEST_STUDENT_COLUMNS = ('student_id', 'studentid', 'student')
+
+def manifest_student_ids(text):
+    """Student IDs of a file,student_id manifest, in row order; None without a student column."""
+    reader = csv.DictReader(io.StringIO(text))
+    columns = {name.strip().lower(): name for name in (reader.fieldnames or [])}
+    column = next((columns[c] for c in MANIFEST_STUDENT_COLUMNS if c in columns), None)
+    if column is None:
+        return None
+    return [(row.get(column) or '').strip() for row in reader if (row.get(column) or '').strip()]
+
+def run_cli_command(script_name, args, timeout=300):
     """Execute CLI Python scripts."""
     try:
         script_path = os.path.join(PARENT_DIR, script_name)
         cmd = [sys.executable, script_path] + args
         logger.info(f"Running: {' '.join(cmd)}")
         
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
         logger.info(f"Return code: {result.returncode}")
         logger.info(f"STDOUT: {result.stdout}")
         if result.stderr:
@@ -288,6 +307,10 @@ def batch_evaluate():
         data = request.get_json()
         exam_id = data.get('exam_id', '')
         student_ids = data.get('student_ids', [])
+        if not isinstance(student_ids, list):
+            student_ids = []
+        # Blank entries would reach comparator.py as an empty argument
+        student_ids = list(dict.fromkeys(str(sid).strip() for sid in student_ids if str(sid).strip()))
         
         if not exam_id or not student_ids:
             return jsonify({'success': False, 'message': 'Exam ID and student IDs required'}), 400
@@ -299,34 +322,24 @@ def batch_evaluate():
             'errors': []
         }
         
-        # Evaluate each student one by one
-        for student_id in student_ids:
-            try:
-                logger.info(f"Evaluating {student_id} for exam {exam_id}...")
-                
-                # Run comparator
-                success, stdout, stderr = run_cli_command(
-                    'comparator.py',
-                    ['--exam-id', exam_id, '--student-id', student_id]
-                )
-                
-                if success:
-                    results_data['successful'] += 1
-                    logger.info(f"✅ Evaluated {student_id}")
-                else:
-                    results_data['failed'] += 1
-                    results_data['errors'].append({
-                        'student_id': student_id,
-                        'error': stderr
-                    })
-                    logger.warning(f"❌ Failed to evaluate {student_id}: {stderr}")
-            except Exception as e:
-                results_data['failed'] += 1
-                results_data['errors'].append({
-                    'student_id': student_id,
-                    'error': str(e)
-                })
-                logger.error(f"Error evaluating {student_id}: {e}")
+        # One comparator run scores every selected student (one embedding pass, one bulk write)
+        logger.info(f"Evaluating {len(student_ids)} student(s) for exam {exam_id}...")
+        success, stdout, stderr = run_cli_command(
+            'comparator.py',
+            ['--exam-id', exam_id, '--json', '--student-ids', *student_ids],
+            timeout=BATCH_EVALUATE_TIMEOUT
+        )
+        try:
+            summary = json.loads(stdout.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            logger.warning(f"❌ Batch evaluation failed: {stderr[-2000:]}")
+            results_data['failed'] = len(student_ids)
+            results_data['errors'] = [{'student_id': sid, 'error': stderr[-2000:]} for sid in student_ids]
+        else:
+            results_data['successful'] = summary['evaluated']
+            results_data['failed'] = len(summary['failed'])
+            results_data['errors'] = [{'student_id': f['studentId'], 'error': f['error']} for f in summary['failed']]
+            logger.info(f"✅ Evaluated {summary['evaluated']} student(s) in {summary['seconds']}s")
         
         return jsonify({
             'success': True,
@@ -417,11 +430,13 @@ def upload_schema():
         subject_id = request.form.get('subject_id') or str(ObjectId())
         
         # Run scheme extraction
+        # Re-uploads of an already structured PDF reuse the stored scheme unless force is set
+        extractor_args = [filepath, '--exam-id', exam_id, '--professor-id', professor_id, '--subject-id', subject_id]
+        if request.form.get('force') in ('1', 'true', 'on'):
+            extractor_args.append('--force')
+
         logger.info("Running scheme extraction...")
-        success, stdout, stderr = run_cli_command(
-            'scheme_extractor.py',
-            [filepath, '--exam-id', exam_id, '--professor-id', professor_id, '--subject-id', subject_id]
-        )
+        success, stdout, stderr = run_cli_command('scheme_extractor.py', extractor_args)
         
         if not success:
             return jsonify({
@@ -430,7 +445,7 @@ def upload_schema():
             }), 500
         
         # Get the stored schema document (use string ID directly)
-        schema_doc = col_schema.find_one({'examId': exam_id}, sort=[('_id', -1)])
+        schema_doc = col_schema.find_one({'examId': exam_id}, {'_id': 1}, sort=[('_id', -1)])
         
         return jsonify({
             'success': True,
@@ -449,12 +464,16 @@ def get_schema(exam_id):
     """Fetch schema for a given exam."""
     try:
         # Query using string ID directly
-        schema = col_schema.find_one({'examId': exam_id}, sort=[('_id', -1)])
+        # Only the structured scheme; the raw OCR text and model output are not needed here
+        schema = col_schema.find_one({'examId': exam_id}, {'structuredData': 1}, sort=[('_id', -1)])
         
         if not schema:
             return jsonify({'success': False, 'message': 'Schema not found'}), 404
         
-        structured = json.loads(schema.get('structuredData', '{}'))
+        structured = schema.get('structuredData') or {}
+        if isinstance(structured, str):
+            # Stored before schemes were kept as native documents
+            structured = json.loads(structured)
         return jsonify({
             'success': True,
             'schema_id': str(schema['_id']),
@@ -525,6 +544,87 @@ def upload_script():
         logger.error(f"Upload script error: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
 
+@app.route('/api/upload-scripts-bulk', methods=['POST'])
+def upload_scripts_bulk():
+    """
+    Upload a whole class at once and OCR every script:
+    a ZIP of PDFs plus a manifest CSV (file,student_id), or one scanned bundle PDF
+    that is split into per-student booklets (split_by: auto/roll/separator/cover).
+    A bundle takes its student IDs (bundle order) from an optional student_ids file,
+    one ID per line, or from the student_id column of a manifest CSV.
+    """
+    try:
+        archive = request.files.get('file')
+        if not archive or archive.filename == '':
+            return jsonify({'success': False, 'message': 'No ZIP or PDF file provided'}), 400
+        is_bundle = archive.filename.lower().endswith('.pdf')
+        if not is_bundle and not archive.filename.lower().endswith('.zip'):
+            return jsonify({'success': False, 'message': 'Only ZIP or PDF files allowed'}), 400
+
+        exam_id = request.form.get('exam_id', '')
+        if not exam_id:
+            return jsonify({'success': False, 'message': 'Exam ID required'}), 400
+
+        # Extracted PDFs are kept in the upload folder (timestamp-prefixed) so the PDF viewer can serve them
+        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S_')
+        archive_path = os.path.join(app.config['UPLOAD_FOLDER'], timestamp + secure_filename(archive.filename))
+        archive.save(archive_path)
+        args = [archive_path, '--exam-id', exam_id, '--dest', app.config['UPLOAD_FOLDER'], '--json']
+
+        manifest = request.files.get('manifest')
+        id_list = request.files.get('student_ids')
+        manifest_path = None
+        if is_bundle and ((id_list and id_list.filename) or (manifest and manifest.filename)):
+            # bundle_splitter.py reads one student ID per line, in bundle order
+            if id_list and id_list.filename:
+                student_ids = [line.strip() for line in id_list.read().decode('utf-8-sig').splitlines()
+                               if line.strip()]
+            else:
+                student_ids = manifest_student_ids(manifest.read().decode('utf-8-sig'))
+                if student_ids is None:
+                    os.remove(archive_path)
+                    return jsonify({'success': False,
+                                    'message': 'Manifest needs a student_id column'}), 400
+            manifest_path = os.path.join(app.config['UPLOAD_FOLDER'], timestamp + 'student_ids.txt')
+            with open(manifest_path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(student_ids) + '\n')
+            args += ['--student-ids', manifest_path]
+        elif manifest and manifest.filename:
+            manifest_path = os.path.join(app.config['UPLOAD_FOLDER'], timestamp + 'manifest.csv')
+            manifest.save(manifest_path)
+            args += ['--manifest', manifest_path]
+        if is_bundle:
+            # Booklet file names already carry the timestamp through the bundle name
+            args += ['--split-by', request.form.get('split_by', 'auto')]
+        else:
+            args += ['--prefix', timestamp]
+
+        logger.info(f"Running bulk OCR ingestion for exam {exam_id}...")
+        try:
+            script = 'bundle_splitter.py' if is_bundle else 'bulk_ingest.py'
+            success, stdout, stderr = run_cli_command(script, args, timeout=BULK_INGEST_TIMEOUT)
+        finally:
+            for path in (archive_path, manifest_path):
+                if path and os.path.exists(path):
+                    os.remove(path)
+
+        try:
+            summary = json.loads(stdout.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            return jsonify({'success': False, 'message': f'Bulk ingestion failed: {stderr[-2000:]}'}), 500
+
+        return jsonify({
+            'success': success,
+            'message': (f'Bulk ingestion complete: {summary["succeeded"]} successful, '
+                        f'{summary["failed"]} failed, {summary["skipped"]} skipped '
+                        f'({summary["pagesPerSecond"]} pages/sec)'),
+            'data': summary
+        })
+
+    except Exception as e:
+        logger.error(f"Bulk upload error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
 @app.route('/api/ocr-data/<exam_id>/<student_id>', methods=['GET'])
 def get_ocr_data(exam_id, student_id):
     """Fetch OCR extracted text for a student."""
@@ -541,6 +641,7 @@ def get_ocr_data(exam_id, student_id):
                 'question_number': page.get('questionNumber'),
                 'confidence': page.get('confidence', 0),
                 'text': page.get('rawText', ''),
+                'triage': page.get('triage'),
                 'extracted_at': page.get('createdAt', datetime.utcnow()).strftime('%Y-%m-%d %H:%M')
             })
         
@@ -553,6 +654,34 @@ def get_ocr_data(exam_id, student_id):
         logger.error(f"Error fetching OCR data: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
 
+@app.route('/api/question-answers/<exam_id>/<student_id>', methods=['GET'])
+def get_question_answers(exam_id, student_id):
+    """Fetch a student's answers segmented per question at OCR time."""
+    try:
+        answers = list(col_question_answers.find(
+            {'examId': exam_id, 'studentId': student_id},
+            {'_id': 0, 'questionNumber': 1, 'answerText': 1, 'pageNumbers': 1, 'confidence': 1, 'updatedAt': 1}
+        ).sort('questionNumber', 1))
+
+        data = []
+        for answer in answers:
+            data.append({
+                'question_number': answer.get('questionNumber'),
+                'text': answer.get('answerText', ''),
+                'pages': answer.get('pageNumbers', []),
+                'confidence': answer.get('confidence', 0),
+                'extracted_at': answer.get('updatedAt', datetime.utcnow()).strftime('%Y-%m-%d %H:%M')
+            })
+
+        return jsonify({
+            'success': True,
+            'data': data,
+            'total_questions': len(data)
+        })
+    except Exception as e:
+        logger.error(f"Error fetching question answers: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
 @app.route('/api/get-pdf-path/<exam_id>/<student_id>', methods=['GET'])
 def get_pdf_path(exam_id, student_id):
     """Get the PDF file path for a student's answer script."""
@@ -612,6 +741,7 @@ def get_schema_pdf_path(exam_id):
         # Query schema collection to find the PDF filename
         schema_record = col_schema.find_one(
             {'examId': exam_id},
+            {'pdfMetadata.fileName': 1, 'fileName': 1, 'filename': 1, 'file_name': 1},
             sort=[('_id', -1)]
         )
         
@@ -987,6 +1117,7 @@ def get_ocr_text(exam_id, student_id):
                 'question_number': page.get('questionNumber'),
                 'confidence': page.get('confidence', 0),
                 'text': page.get('rawText', ''),
+                'triage': page.get('triage'),
                 'file_name': page.get('fileName', '')
             }
         })
@@ -1171,6 +1302,10 @@ def delete_script(exam_id, student_id):
             'examId': exam_id,
             'studentId': student_id
         })
+        col_question_answers.delete_many({
+            'examId': exam_id,
+            'studentId': student_id
+        })
         
         # Delete from results collection
         col_results.delete_many({
@@ -0,0 +1,266 @@
+"""
+Gemini model discovery and failover for comparator.py's verification step.
+
+The list of models supporting generateContent is fetched with genai.list_models() at
+most once per GEMINI_MODELS_TTL seconds and stored in Mongo, so other processes reuse it.
+Each model also has a health record (successes, failures, consecutive failures, smoothed
+latency, last error):
+
+    {"_id": "models", "models": [...], "fetchedAt"}
+    {"_id": "health:<model>", "model", "successes", "failures", "latency", "notFoundUntil", ...}
+
+A model that answers 404 is skipped for GEMINI_NOT_FOUND_TTL seconds, in this process
+and in every process sharing the collection. Calls try models healthy-first, then by
+latency, then in discovery order (flash before pro). GenerativeModel objects are
+created once per model and reused.
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import google.generativeai as genai
+from pymongo import UpdateOne
+
+from api_scheduler import scheduler, error_status
+
+logger = logging.getLogger(__name__)
+
+# Seconds a discovered model list is used before list_models() is called again
+GEMINI_MODELS_TTL = int(os.getenv("GEMINI_MODELS_TTL", "86400"))
+# Seconds the fallback list is used after list_models() failed, before listing again
+GEMINI_MODELS_RETRY = int(os.getenv("GEMINI_MODELS_RETRY", "300"))
+# Seconds a model that answered 404 is skipped
+GEMINI_NOT_FOUND_TTL = int(os.getenv("GEMINI_NOT_FOUND_TTL", "86400"))
+# Weight of the newest sample in the smoothed latency
+GEMINI_LATENCY_ALPHA = float(os.getenv("GEMINI_LATENCY_ALPHA", "0.2"))
+# Used when list_models() fails; the SDK adds the 'models/' prefix
+GEMINI_FALLBACK_MODELS = ["gemini-1.5-flash", "gemini-1.5-pro", "gemini-pro"]
+MODELS_ID = "models"
+
+
+def is_not_found(error: Exception) -> bool:
+    return error_status(error) == 404 or "404" in str(error) or "not found" in str(error).lower()
+
+
+def preferred_order(model_names: List[str]) -> List[str]:
+    """Flash models (faster) first, then pro models, then the rest, each in API order."""
+    ordered = []
+    for pref in ["flash", "pro"]:
+        for model_name in model_names:
+            if pref in model_name.lower() and model_name not in ordered:
+                ordered.append(model_name)
+    ordered.extend(m for m in model_names if m not in ordered)
+    return ordered
+
+
+def response_text(response) -> str:
+    """Text of a generate_content response; raises when it is empty or blocked."""
+    if not response:
+        raise Exception("Empty response from AI")
+    feedback = getattr(response, "prompt_feedback", None)
+    if feedback and getattr(feedback, "block_reason", None):
+        raise Exception(f"Content blocked: {feedback.block_reason}")
+
+    text = None
+    if hasattr(response, "text"):
+        text = response.text
+    elif getattr(response, "candidates", None):
+        candidate = response.candidates[0]
+        if hasattr(candidate, "content") and hasattr(candidate.content, "parts"):
+            text = " ".join(part.text for part in candidate.content.parts if hasattr(part, "text"))
+    if not text:
+        raise Exception("No text content in AI response")
+    return text
+
+
+class ModelHealth:
+    def __init__(self, successes: int = 0, failures: int = 0, consecutiveFailures: int = 0,
+                 latency: Optional[float] = None, notFoundUntil: Optional[float] = None,
+                 lastError: str = "", **_):
+        self.successes = successes
+        self.failures = failures
+        self.consecutive_failures = consecutiveFailures
+        self.latency = latency
+        self.not_found_until = notFoundUntil
+        self.last_error = lastError
+
+    def available(self, now: float) -> bool:
+        return self.not_found_until is None or self.not_found_until <= now
+
+    def as_document(self) -> Dict[str, Any]:
+        return {"successes": self.successes, "failures": self.failures,
+                "consecutiveFailures": self.consecutive_failures, "latency": self.latency,
+                "notFoundUntil": self.not_found_until, "lastError": self.last_error}
+
+
+class GeminiModelRegistry:
+    """Discovered models, their health, and reusable GenerativeModel objects."""
+
+    def __init__(self, collection=None, models_ttl: int = GEMINI_MODELS_TTL,
+                 not_found_ttl: int = GEMINI_NOT_FOUND_TTL):
+        self.collection = collection
+        self.models_ttl = models_ttl
+        self.not_found_ttl = not_found_ttl
+        self._models: List[str] = []
+        self._fetched_at: Optional[float] = None
+        self._health: Dict[str, ModelHealth] = {}
+        self._clients: Dict[str, Any] = {}
+        self._loaded = False
+        self._lock = threading.RLock()
+        self._stats = {"list_models_calls": 0, "calls": 0, "failovers": 0, "skipped_not_found": 0}
+
+    def attach(self, collection):
+        """Persists the model list and health in collection (shared across processes)."""
+        with self._lock:
+            self.collection = collection
+            self._loaded = False
+
+    def _load(self):
+        if self._loaded or self.collection is None:
+            return
+        self._loaded = True
+        try:
+            docs = list(self.collection.find({}))
+        except Exception as e:
+            logger.warning(f"Could not load Gemini model registry: {e}")
+            return
+        for doc in docs:
+            if doc["_id"] == MODELS_ID and doc.get("models") and doc.get("fetchedAt"):
+                self._models = list(doc["models"])
+                self._fetched_at = doc["fetchedAt"]
+            elif doc.get("model"):
+                self._health.setdefault(doc["model"], ModelHealth(**doc))
+
+    def _save(self, documents: Dict[str, Dict[str, Any]]):
+        """Upserts {_id: fields} documents."""
+        if self.collection is None or not documents:
+            return
+        now = datetime.utcnow()
+        try:
+            self.collection.bulk_write([UpdateOne({"_id": _id}, {"$set": {**fields, "updatedAt": now}}, upsert=True)
+                                        for _id, fields in documents.items()], ordered=False)
+        except Exception as e:
+            logger.warning(f"Could not store Gemini model registry: {e}")
+
+    def _save_health(self, model_names: List[str]):
+        self._save({f"health:{name}": {"model": name, **self._health[name].as_document()} for name in model_names})
+
+    def models(self, refresh: bool = False) -> List[str]:
+        """Model names in preferred order, from the cached list while it is fresh."""
+        with self._lock:
+            self._load()
+            if not refresh and self._models and time.time() - self._fetched_at < self.models_ttl:
+                return list(self._models)
+            self._stats["list_models_calls"] += 1
+            try:
+                listed = scheduler.call("gemini", "list_models", lambda: list(genai.list_models()))
+                names = [m.name for m in listed if "generateContent" in m.supported_generation_methods]
+            except Exception as e:
+                logger.debug(f"Could not list models: {str(e)}, using fallback list")
+                names = []
+            if not names:
+                # Kept in memory only, so the next process lists the models again
+                self._models = self._models or list(GEMINI_FALLBACK_MODELS)
+                self._fetched_at = time.time() - self.models_ttl + GEMINI_MODELS_RETRY
+                return list(self._models)
+            self._models = preferred_order(names)
+            self._fetched_at = time.time()
+            logger.info(f"Found {len(self._models)} available Gemini models")
+            self._save({MODELS_ID: {"models": self._models, "fetchedAt": self._fetched_at}})
+            return list(self._models)
+
+    def health(self, model_name: str) -> ModelHealth:
+        with self._lock:
+            return self._health.setdefault(model_name, ModelHealth())
+
+    def candidates(self) -> List[str]:
+        """Models to try, in order; models known to answer 404 are left out."""
+        names = self.models()
+        now = time.time()
+        with self._lock:
+            available = [m for m in names if self.health(m).available(now)]
+            if not available:
+                # Every listed model 404'd: the cached list is probably stale
+                available = [m for m in self.models(refresh=True) if self.health(m).available(now)]
+            self._stats["skipped_not_found"] += len(names) - len(available)
+            rank = {m: i for i, m in enumerate(names)}
+
+            def order(m):
+                h = self.health(m)
+                return (h.consecutive_failures > 0, h.latency if h.latency is not None else float("inf"),
+                        rank.get(m, len(rank)))
+            return sorted(available, key=order)
+
+    def client(self, model_name: str):
+        with self._lock:
+            if model_name not in self._clients:
+                self._clients[model_name] = genai.GenerativeModel(model_name)
+            return self._clients[model_name]
+
+    def record_success(self, model_name: str, seconds: float):
+        with self._lock:
+            h = self.health(model_name)
+            h.successes += 1
+            h.consecutive_failures = 0
+            h.latency = seconds if h.latency is None else (
+                GEMINI_LATENCY_ALPHA * seconds + (1 - GEMINI_LATENCY_ALPHA) * h.latency)
+
+    def record_failure(self, model_name: str, error: Exception):
+        with self._lock:
+            h = self.health(model_name)
+            h.failures += 1
+            h.consecutive_failures += 1
+            h.last_error = str(error)[:300]
+            if is_not_found(error):
+                h.not_found_until = time.time() + self.not_found_ttl
+                logger.debug(f"Model {model_name} not found: {error}")
+                # Right away, so concurrent processes stop trying it too
+                self._save_health([model_name])
+            else:
+                logger.debug(f"Model {model_name} failed: {error}")
+
+    def generate(self, prompt: str, tokens: int = 0) -> Tuple[str, str]:
+        """(text, model name) from the first candidate model that answers."""
+        tried, last_error = [], None
+        for model_name in self.candidates():
+            tried.append(model_name)
+            logger.debug(f"Trying model: {model_name}")
+            started = time.monotonic()
+            try:
+                response = scheduler.call("gemini", model_name, self.client(model_name).generate_content,
+                                          prompt, tokens=tokens)
+                text = response_text(response)
+            except Exception as e:
+                last_error = e
+                self.record_failure(model_name, e)
+                continue
+            self.record_success(model_name, time.monotonic() - started)
+            with self._lock:
+                self._stats["calls"] += 1
+                self._stats["failovers"] += len(tried) - 1
+            return text, model_name
+
+        error_details = f"Last error: {last_error}" if last_error else "Unknown error"
+        available_info = f"Tried {len(tried)} models: {[m.split('/')[-1] for m in tried[:3]]}" if tried else "No models to try"
+        raise Exception(f"All AI models failed. {error_details}. {available_info}")
+
+    def flush(self):
+        """Stores the health of every model seen by this process."""
+        with self._lock:
+            self._save_health([name for name, h in self._health.items() if h.successes or h.failures])
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["models"] = {name.split('/')[-1]: {"ok": h.successes, "failed": h.failures,
+                                                     "latency": round(h.latency, 3) if h.latency is not None else None}
+                               for name, h in self._health.items() if h.successes or h.failures}
+            return stats
+
+
+# Process-wide registry; comparator.py attaches its Mongo collection
+registry = GeminiModelRegistry()
@@ -0,0 +1,139 @@
+"""
+Vision OCR backends used by ocr_pdf.py.
+The pipeline only ever calls backend.complete(); which backend runs is chosen by
+OCR_BACKEND / --backend, so throughput can be measured without a live API key.
+Both backends submit through the process-wide api_scheduler, hedged when API_HEDGING/--hedge is on.
+"""
+
+import hashlib
+import os
+import random
+import threading
+import time
+
+from openai import OpenAI
+
+from api_scheduler import scheduler, estimate_tokens
+
+# Local backend: simulated request latency (base per request + per page image,
+# plus up to OCR_LOCAL_JITTER_MS of deterministic jitter), in milliseconds
+OCR_LOCAL_LATENCY_MS = int(os.getenv("OCR_LOCAL_LATENCY_MS", "0"))
+OCR_LOCAL_LATENCY_PER_PAGE_MS = int(os.getenv("OCR_LOCAL_LATENCY_PER_PAGE_MS", "0"))
+OCR_LOCAL_JITTER_MS = int(os.getenv("OCR_LOCAL_JITTER_MS", "0"))
+OCR_LOCAL_CONFIDENCE = float(os.getenv("OCR_LOCAL_CONFIDENCE", "0.95"))
+# Stragglers: this share of requests (drawn per request, not per content) takes
+# OCR_LOCAL_TAIL_MS longer, to measure request hedging against a slow tail
+OCR_LOCAL_TAIL_RATE = float(os.getenv("OCR_LOCAL_TAIL_RATE", "0"))
+OCR_LOCAL_TAIL_MS = int(os.getenv("OCR_LOCAL_TAIL_MS", "0"))
+
+
+def build_chat_request(model: str, system_message: str, prompt: str, images: list, labels: list = None) -> dict:
+    """
+    Chat completion request with the prompt followed by the page images, given as
+    (image_b64, mime_type) pairs. When labels are given, each image is preceded by its label.
+    """
+    content = [{"type": "text", "text": prompt}]
+    for n, (image_b64, mime_type) in enumerate(images):
+        if labels:
+            content.append({"type": "text", "text": labels[n]})
+        content.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{image_b64}"}})
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": content}
+        ]
+    }
+
+
+class OpenAIVisionBackend:
+    """Calls the OpenAI chat completions API. The client is created on first use."""
+
+    name = "openai"
+    # Results are real model output and may be shared through the OCR cache
+    cache_tag = ""
+
+    def __init__(self, model: str):
+        self.model = model
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self) -> OpenAI:
+        with self._lock:
+            if self._client is None:
+                # Uses OPENAI_API_KEY from environment; retries are left to the scheduler
+                self._client = OpenAI(max_retries=0)
+            return self._client
+
+    def complete(self, system_message: str, prompt: str, images: list, labels: list = None) -> str:
+        response = scheduler.hedged(
+            "openai", self.model, self.client.chat.completions.create,
+            tokens=estimate_tokens(system_message + prompt, len(images)),
+            **build_chat_request(self.model, system_message, prompt, images, labels)
+        )
+        return response.choices[0].message.content
+
+
+class LocalVisionBackend:
+    """
+    Deterministic offline backend for load and throughput testing. Returns canned
+    text derived from the image bytes (same image, same text) after a simulated
+    latency. Multi-page requests get the "=== PAGE n ===" delimited format.
+    """
+
+    name = "local"
+    # Canned output must never be served to real runs from the OCR cache
+    cache_tag = "local"
+
+    def __init__(self, model: str, latency_ms: int = OCR_LOCAL_LATENCY_MS,
+                 per_page_ms: int = OCR_LOCAL_LATENCY_PER_PAGE_MS,
+                 jitter_ms: int = OCR_LOCAL_JITTER_MS, confidence: float = OCR_LOCAL_CONFIDENCE,
+                 tail_rate: float = OCR_LOCAL_TAIL_RATE, tail_ms: int = OCR_LOCAL_TAIL_MS):
+        self.model = model
+        self.latency_ms = latency_ms
+        self.per_page_ms = per_page_ms
+        self.jitter_ms = jitter_ms
+        self.confidence = confidence
+        self.tail_rate = tail_rate
+        self.tail_ms = tail_ms
+
+    def page_text(self, image_b64: str) -> str:
+        digest = hashlib.sha256(image_b64.encode("utf-8")).hexdigest()
+        return (f"[local OCR backend] page image {digest[:12]}, {len(image_b64)} base64 chars\n"
+                f"CONFIDENCE_SCORE: {self.confidence}")
+
+    def complete(self, system_message: str, prompt: str, images: list, labels: list = None) -> str:
+        # Scheduled like a real API so LOCAL_RPM/LOCAL_TPM can simulate rate limits
+        return scheduler.hedged("local", self.model, self._complete, images,
+                               tokens=estimate_tokens(system_message + prompt, len(images)))
+
+    def _complete(self, images: list) -> str:
+        texts = [self.page_text(image_b64) for image_b64, _ in images]
+
+        delay_ms = self.latency_ms + self.per_page_ms * len(images)
+        if self.jitter_ms:
+            # Seeded from the request content so repeated runs sleep identically
+            seed = hashlib.sha256("".join(texts).encode("utf-8")).digest()
+            delay_ms += random.Random(seed).uniform(0, self.jitter_ms)
+        if self.tail_rate and random.random() < self.tail_rate:
+            delay_ms += self.tail_ms
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000.0)
+
+        if len(texts) == 1:
+            return texts[0]
+        return "\n".join(f"=== PAGE {n} ===\n{text}" for n, text in enumerate(texts, start=1))
+
+
+OCR_BACKENDS = {
+    OpenAIVisionBackend.name: OpenAIVisionBackend,
+    LocalVisionBackend.name: LocalVisionBackend,
+}
+DEFAULT_OCR_BACKEND = OpenAIVisionBackend.name
+
+
+def get_backend(name: str, model: str):
+    if name not in OCR_BACKENDS:
+        raise ValueError(f"Unknown OCR backend '{name}'. Choose from: {', '.join(OCR_BACKENDS)}")
+    return OCR_BACKENDS[name](model)
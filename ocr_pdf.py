@@ -1,14 +1,30 @@
 import sys
 import os
 import fitz  # PyMuPDF
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from datetime import datetime
-from openai import OpenAI
 import base64
 from dotenv import load_dotenv
 import re
 import argparse
+import hashlib
+import json
+from urllib.parse import urlencode, parse_qsl
 import logging
+import queue
+import threading
+import time
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from concurrent.futures import Future
+from page_images import (ENCODING_PROFILES, DEFAULT_ENCODING_PROFILE, get_encoding_profile,
+                         render_page, encode_rendered, page_fingerprint, hamming_distance, ink_difference,
+                         image_coverage)
+from ocr_backends import OCR_BACKENDS, DEFAULT_OCR_BACKEND, get_backend, build_chat_request
+from question_segmenter import segment_pages, scheme_question_numbers, SEGMENTER_VERSION
+from api_scheduler import scheduler
+from scheme_validation import find_scheme
 
 # Setup logging
 logging.basicConfig(
@@ -20,9 +36,6 @@ logger = logging.getLogger(__name__)
 # Load environment
 load_dotenv()
 
-# Initialize OpenAI client (uses OPENAI_API_KEY from environment)
-client = OpenAI()
-
 # MongoDB setup
 MONGO_URI = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
 logger.info(f"≡ƒöù Connecting to MongoDB: {MONGO_URI}")
@@ -37,6 +50,77 @@ except Exception as e:
 
 db = mongo_client['ai_evaluation_system']
 ocr_collection = db['ocr_extracted_answers']
+# Content-addressed OCR results, keyed on rendered page bytes + prompt/model version
+ocr_cache_collection = db['ocr_page_cache']
+# One pre-assembled answer per (examId, studentId, questionNumber), built from the pages at ingest
+ocr_question_collection = db['ocr_question_answers']
+# Marking schemes (written by scheme_extractor.py); only read for their question numbers
+schema_collection = mongo_client['schema_db']['schema_extracted_answers']
+
+# OCR config
+OCR_MODEL = "gpt-4o-mini"
+OCR_DPI = 200
+# Vision backend (see ocr_backends.OCR_BACKENDS); "local" needs no API key
+OCR_BACKEND = os.getenv("OCR_BACKEND", DEFAULT_OCR_BACKEND)
+
+# Two-pass OCR (opt-in, --escalate): pages are first read at OCR_FIRST_PASS_DPI with OCR_MODEL; only pages
+# whose confidence is below OCR_ESCALATION_THRESHOLD are re-read at OCR_ESCALATION_DPI
+# with OCR_ESCALATION_MODEL, and the better result is kept. The threshold sits above
+# the comparator's LOW_OCR_CONFIDENCE flag (0.55 average) so flagged pages get a retry.
+# With escalation off (the default) every page is read once at OCR_DPI with OCR_MODEL.
+OCR_FIRST_PASS_DPI = int(os.getenv("OCR_FIRST_PASS_DPI", "150"))
+OCR_ESCALATION_DPI = int(os.getenv("OCR_ESCALATION_DPI", "300"))
+OCR_ESCALATION_MODEL = os.getenv("OCR_ESCALATION_MODEL", "gpt-4o")
+OCR_ESCALATION_THRESHOLD = float(os.getenv("OCR_ESCALATION_THRESHOLD", "0.7"))
+# Page image encoding profile (see page_images.ENCODING_PROFILES)
+OCR_ENCODING_PROFILE = os.getenv("OCR_ENCODING_PROFILE", DEFAULT_ENCODING_PROFILE)
+# Maximum number of vision requests in flight at once (1 = sequential)
+OCR_MAX_IN_FLIGHT = int(os.getenv("OCR_MAX_IN_FLIGHT", "4"))
+# Number of page images sent in one chat completion (1 = one request per page)
+OCR_PAGES_PER_REQUEST = int(os.getenv("OCR_PAGES_PER_REQUEST", "1"))
+# Capacity of each hand-off queue between the render, OCR and persist stages
+OCR_QUEUE_DEPTH = int(os.getenv("OCR_QUEUE_DEPTH", "4"))
+
+# Pages whose embedded text layer has at least this many characters are taken
+# as-is (typed/digitally produced scripts) and never rasterized, unless images cover
+# more than OCR_TEXT_LAYER_MAX_IMAGE_COVERAGE of the page (a scan whose text layer came
+# from the scanner's own OCR) or fewer than OCR_TEXT_LAYER_MIN_WORD_RATIO of its tokens
+# look like words. Such pages are stored with OCR_TEXT_LAYER_CONFIDENCE, not 1.0.
+OCR_TEXT_LAYER_MIN_CHARS = int(os.getenv("OCR_TEXT_LAYER_MIN_CHARS", "40"))
+OCR_TEXT_LAYER_MAX_IMAGE_COVERAGE = float(os.getenv("OCR_TEXT_LAYER_MAX_IMAGE_COVERAGE", "0.5"))
+OCR_TEXT_LAYER_MIN_WORD_RATIO = float(os.getenv("OCR_TEXT_LAYER_MIN_WORD_RATIO", "0.6"))
+OCR_TEXT_LAYER_CONFIDENCE = float(os.getenv("OCR_TEXT_LAYER_CONFIDENCE", "0.9"))
+# A token counts as a word when, apart from surrounding punctuation, it is a lower-case or
+# capitalised word, an acronym, a number or a label such as Q7; scanner OCR garbage
+# mixes symbols, digits and case inside tokens
+WORD_TOKEN = re.compile(r"^[(\[\"']*(?:[A-Za-z][a-z]*(?:[-'][A-Za-z][a-z]*)*|[A-Z]+s?|\d+(?:[.,]\d+)*"
+                        r"|[A-Za-z]{1,3}\d{1,3}[a-z]?)[)\]\"'.,;:!?%]*$")
+
+# Page triage on a downscaled render, before any vision call:
+#   pages whose ink density is below OCR_BLANK_INK_RATIO are treated as blank;
+#   pages within OCR_DUPLICATE_MAX_DISTANCE bits (perceptual hash) and
+#   OCR_DUPLICATE_MAX_GRID_DIFF gray levels of an earlier page are duplicate candidates,
+#   confirmed by comparing the ink of both pages at OCR_DUPLICATE_CONFIRM_DPI: no tile of
+#   the page may differ by more than OCR_DUPLICATE_MAX_INK_DIFF (fraction of its pixels).
+#   Ruled pages with a few different words look alike at thumbnail size, so the
+#   thumbnail checks alone never skip a page.
+OCR_TRIAGE_DPI = 36
+OCR_BLANK_INK_RATIO = float(os.getenv("OCR_BLANK_INK_RATIO", "0.002"))
+OCR_DUPLICATE_MAX_DISTANCE = int(os.getenv("OCR_DUPLICATE_MAX_DISTANCE", "2"))
+OCR_DUPLICATE_MAX_GRID_DIFF = float(os.getenv("OCR_DUPLICATE_MAX_GRID_DIFF", "0.25"))
+OCR_DUPLICATE_CONFIRM_DPI = int(os.getenv("OCR_DUPLICATE_CONFIRM_DPI", "100"))
+OCR_DUPLICATE_MAX_INK_DIFF = float(os.getenv("OCR_DUPLICATE_MAX_INK_DIFF", "0.01"))
+
+# Number of page records buffered before they are flushed with one bulk_write
+OCR_WRITE_BATCH_SIZE = int(os.getenv("OCR_WRITE_BATCH_SIZE", "8"))
+
+# OCR cache: entries unused for this many days are evicted by a TTL index;
+# OCR_CACHE_MAX_ENTRIES > 0 additionally trims the least recently used entries
+OCR_CACHE_TTL_DAYS = int(os.getenv("OCR_CACHE_TTL_DAYS", "30"))
+OCR_CACHE_MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", "0"))
+
+# Marks the end of the page stream between pipeline stages
+_STAGE_DONE = object()
 
 DETAILED_OCR_PROMPT = """
 You are an advanced OCR system specialized in accurately reading handwritten answer sheets.
@@ -58,6 +142,54 @@ At the end of the extracted text, provide a confidence score in the format:
 CONFIDENCE_SCORE: <value between 0 and 1>
 """
 
+OCR_SYSTEM_MESSAGE = "You perform precise OCR on handwritten documents."
+
+# Appended to DETAILED_OCR_PROMPT when several pages share one request
+MULTI_PAGE_OCR_INSTRUCTIONS = """
+You will receive {page_count} page images, in order, each preceded by its label.
+Apply the instructions above to every page separately. For each page, output a line
+"=== PAGE <n> ===" (n = 1..{page_count}), then that page's text, then its own
+CONFIDENCE_SCORE line. Output nothing before the first page marker.
+"""
+
+PAGE_MARKER_PATTERN = re.compile(r"^\s*=== PAGE (\d+) ===\s*$", re.MULTILINE)
+
+def ocr_prompt_version(model: str) -> str:
+    # Any change to the model or prompts yields a new version and so a fresh set of cache keys
+    return hashlib.sha256(
+        f"{model}\n{OCR_SYSTEM_MESSAGE}\n{DETAILED_OCR_PROMPT}".encode("utf-8")
+    ).hexdigest()[:16]
+
+OCR_PROMPT_VERSION = ocr_prompt_version(OCR_MODEL)
+# Pages split out of a multi-page response were read with a different prompt; they are
+# cached under their own keys, which only multi-page runs look up
+MULTI_PAGE_CACHE_TAG = "multi-" + hashlib.sha256(MULTI_PAGE_OCR_INSTRUCTIONS.encode("utf-8")).hexdigest()[:8]
+
+ocr_backend = get_backend(OCR_BACKEND, OCR_MODEL)
+escalation_backend = get_backend(OCR_BACKEND, OCR_ESCALATION_MODEL)
+
+try:
+    ocr_collection.create_index(
+        [("examId", 1), ("studentId", 1), ("pageNumber", 1)],
+        unique=True, name="exam_student_page"
+    )
+except Exception as e:
+    # Legacy duplicate pages block the unique index until they are cleaned up by a re-ingest
+    logger.warning(f"Could not ensure unique (examId, studentId, pageNumber) index: {e}")
+
+try:
+    ocr_question_collection.create_index(
+        [("examId", 1), ("studentId", 1), ("questionNumber", 1)],
+        unique=True, name="exam_student_question"
+    )
+except Exception as e:
+    logger.warning(f"Could not ensure unique (examId, studentId, questionNumber) index: {e}")
+
+try:
+    ocr_cache_collection.create_index("lastUsedAt", expireAfterSeconds=OCR_CACHE_TTL_DAYS * 24 * 3600)
+except Exception as e:
+    logger.warning(f"Could not ensure OCR cache TTL index: {e}")
+
 def validate_id(id_str: str, field_name: str = "ID") -> str:
     """
     Validate and return ID as a string.
@@ -95,7 +227,435 @@ def extract_question_number(text: str) -> int:
 
     return -1
 
-def extract_text_from_pdf(pdf_path, exam_id=None, student_id=None):
+def parse_confidence_score(extracted_text: str) -> float:
+    """
+    Reads the CONFIDENCE_SCORE the model appends to its output.
+    Returns 0.0 if it is missing or cannot be parsed.
+    """
+    confidence_score = 0.0
+    if "CONFIDENCE_SCORE:" in extracted_text:
+        try:
+            confidence_score = float(
+                extracted_text.split("CONFIDENCE_SCORE:")[1].strip().split()[0]
+            )
+        except:
+            logger.warning("ΓÜá∩╕Å  Could not parse confidence score")
+    return confidence_score
+
+def build_ocr_request_body(image_b64: str, mime_type: str = "image/png") -> dict:
+    """Chat completion request for one page, as sent by the OpenAI backend; used for the batch JSONL export."""
+    return build_chat_request(OCR_MODEL, OCR_SYSTEM_MESSAGE, DETAILED_OCR_PROMPT, [(image_b64, mime_type)])
+
+def ocr_page_image(image_b64: str, mime_type: str = "image/png", backend=None) -> str:
+    """
+    Sends one base64-encoded page image to the vision backend (default: the first-pass
+    backend) and returns the raw OCR text.
+    Safe to call from worker threads (backends are thread-safe).
+    """
+    backend = backend or ocr_backend
+    return backend.complete(OCR_SYSTEM_MESSAGE, DETAILED_OCR_PROMPT, [(image_b64, mime_type)])
+
+def ocr_page_images(images: list) -> str:
+    """
+    Sends several page images, given as (image_b64, mime_type) pairs, in one chat
+    completion and returns the raw, page-delimited output (see split_multi_page_output).
+    """
+    prompt = DETAILED_OCR_PROMPT + MULTI_PAGE_OCR_INSTRUCTIONS.format(page_count=len(images))
+    labels = [f"PAGE {n}" for n in range(1, len(images) + 1)]
+    return ocr_backend.complete(OCR_SYSTEM_MESSAGE, prompt, images, labels)
+
+def split_multi_page_output(text: str, page_count: int):
+    """
+    Splits a multi-page response into per-page texts.
+    Returns None when the split is ambiguous: markers missing, repeated, out of
+    order, or a page without its CONFIDENCE_SCORE line.
+    """
+    markers = list(PAGE_MARKER_PATTERN.finditer(text or ""))
+    if [int(m.group(1)) for m in markers] != list(range(1, page_count + 1)):
+        return None
+    if text[:markers[0].start()].strip():
+        return None
+
+    pages = []
+    for k, marker in enumerate(markers):
+        end = markers[k + 1].start() if k + 1 < len(markers) else len(text)
+        page_text = text[marker.end():end].strip()
+        if "CONFIDENCE_SCORE:" not in page_text:
+            return None
+        pages.append(page_text)
+    return pages
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def remove_duplicate_pages(exam_id: str, student_id: str) -> int:
+    """
+    Deletes all but the newest record for each pageNumber of a student.
+    Older ingests used insert_one, so a re-upload left two copies of every page.
+    """
+    duplicates = ocr_collection.aggregate([
+        {"$match": {"examId": exam_id, "studentId": student_id}},
+        {"$sort": {"_id": -1}},
+        {"$group": {"_id": "$pageNumber", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ])
+    stale_ids = [old_id for d in duplicates for old_id in d["ids"][1:]]
+    if not stale_ids:
+        return 0
+    return ocr_collection.delete_many({"_id": {"$in": stale_ids}}).deleted_count
+
+def find_resume_point(exam_id: str, student_id: str, source_hash: str, total_pages: int):
+    """
+    Returns (first_missing_page_index, last_question_number) for an interrupted run of
+    the same PDF. Pages before the first gap are kept; last_question_number is the value
+    the carry-forward logic had after the last kept page (triaged pages do not change it).
+    """
+    stored = {
+        d["pageNumber"]: d
+        for d in ocr_collection.find(
+            {"examId": exam_id, "studentId": student_id, "sourceHash": source_hash},
+            {"pageNumber": 1, "questionNumber": 1, "triage": 1}
+        )
+    }
+    first_missing = 0
+    last_question_number = -1
+    while first_missing < total_pages and (first_missing + 1) in stored:
+        page = stored[first_missing + 1]
+        if not page.get("triage") and page.get("questionNumber", -1) != -1:
+            last_question_number = page["questionNumber"]
+        first_missing += 1
+    return first_missing, last_question_number
+
+class OcrPageWriter:
+    """
+    Buffers page records and flushes them with bulk_write upserts keyed on
+    (examId, studentId, pageNumber), so re-ingesting a script replaces its pages
+    instead of adding another copy.
+    """
+
+    def __init__(self, collection, batch_size: int = OCR_WRITE_BATCH_SIZE):
+        self.collection = collection
+        self.batch_size = max(1, batch_size)
+        self.buffer: list = []
+        self.pages_written = 0
+        # Pages written more than once (e.g. replaced by an escalated read); counted once in pages_written
+        self.pages_rewritten = 0
+        self._written = set()
+        # Page numbers of every batch whose bulk_write failed (none of them count as written)
+        self.failed_pages = set()
+
+    def add(self, record: dict):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        operations = []
+        for record in self.buffer:
+            fields = dict(record)
+            created_at = fields.pop("createdAt", datetime.utcnow())
+            operations.append(UpdateOne(
+                {"examId": record["examId"], "studentId": record["studentId"],
+                 "pageNumber": record["pageNumber"]},
+                {"$set": fields, "$setOnInsert": {"createdAt": created_at}},
+                upsert=True
+            ))
+        pages = [r["pageNumber"] for r in self.buffer]
+        try:
+            result = self.collection.bulk_write(operations, ordered=False)
+        except Exception:
+            # The whole batch is reported, not just the page whose add() triggered the flush
+            self.failed_pages.update(pages)
+            self.buffer = []
+            raise
+        self.buffer = []
+        self.pages_rewritten += len(self._written.intersection(pages))
+        self._written.update(pages)
+        self.pages_written = len(self._written)
+        logger.info(f"≡ƒÆ╛ Saved pages {pages} to MongoDB "
+                    f"({result.upserted_count} new, {result.modified_count} updated)")
+
+def ocr_cache_key(image_bytes: bytes, model: str = OCR_MODEL) -> str:
+    """Cache key for a rendered page: hash of the image bytes plus the prompt/model version (and backend tag)."""
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    prefix = f"{ocr_backend.cache_tag}:" if ocr_backend.cache_tag else ""
+    return f"{prefix}{ocr_prompt_version(model)}:{image_hash}"
+
+def multi_page_cache_key(cache_key: str) -> str:
+    """Cache key for a page's text split out of a multi-page response (see MULTI_PAGE_CACHE_TAG)."""
+    return f"{cache_key}:{MULTI_PAGE_CACHE_TAG}"
+
+def get_cached_ocr(cache_key: str):
+    """Returns the cached OCR text for a page, or None on a miss."""
+    entry = ocr_cache_collection.find_one_and_update(
+        {"_id": cache_key},
+        {"$set": {"lastUsedAt": datetime.utcnow()}, "$inc": {"hits": 1}},
+        projection={"rawText": 1}
+    )
+    return entry["rawText"] if entry else None
+
+def put_cached_ocr(cache_key: str, extracted_text: str, model: str = OCR_MODEL):
+    now = datetime.utcnow()
+    ocr_cache_collection.update_one(
+        {"_id": cache_key},
+        {"$set": {"rawText": extracted_text, "model": model, "backend": ocr_backend.name,
+                  "promptVersion": ocr_prompt_version(model), "lastUsedAt": now},
+         "$setOnInsert": {"createdAt": now, "hits": 0}},
+        upsert=True
+    )
+
+def prune_ocr_cache(max_entries: int = OCR_CACHE_MAX_ENTRIES) -> int:
+    """Size-based eviction: drops the least recently used entries beyond max_entries."""
+    if max_entries <= 0:
+        return 0
+    excess = ocr_cache_collection.estimated_document_count() - max_entries
+    if excess <= 0:
+        return 0
+    stale_ids = [d["_id"] for d in ocr_cache_collection.find({}, {"_id": 1}).sort("lastUsedAt", 1).limit(excess)]
+    return ocr_cache_collection.delete_many({"_id": {"$in": stale_ids}}).deleted_count
+
+def triage_page(page, seen_fingerprints: list):
+    """
+    Decides from a downscaled grayscale render whether a page needs OCR at all.
+    Returns (verdict, duplicate_of_page_number) where verdict is None (keep),
+    "blank" or "duplicate". Kept pages are appended to seen_fingerprints.
+    """
+    fingerprint = page_fingerprint(render_page(page, OCR_TRIAGE_DPI, grayscale=True))
+    if fingerprint["ink"] < OCR_BLANK_INK_RATIO:
+        return "blank", None
+
+    confirm_pix = None
+    for page_number, earlier in seen_fingerprints:
+        if hamming_distance(fingerprint["hash"], earlier["hash"]) > OCR_DUPLICATE_MAX_DISTANCE:
+            continue
+        # Coarse intensity grid, so similar-looking pages of dense handwriting
+        # are not mistaken for a double-fed sheet
+        if float(abs(fingerprint["grid"] - earlier["grid"]).mean()) > OCR_DUPLICATE_MAX_GRID_DIFF:
+            continue
+        # Only skip a page whose ink matches the earlier page at a readable resolution
+        if confirm_pix is None:
+            confirm_pix = render_page(page, OCR_DUPLICATE_CONFIRM_DPI, grayscale=True)
+        earlier_pix = render_page(page.parent[page_number - 1], OCR_DUPLICATE_CONFIRM_DPI, grayscale=True)
+        if ink_difference(confirm_pix, earlier_pix) <= OCR_DUPLICATE_MAX_INK_DIFF:
+            return "duplicate", page_number
+
+    seen_fingerprints.append((page.number + 1, fingerprint))
+    return None, None
+
+def load_scheme_question_numbers(exam_id: str):
+    """Question numbers of the exam's latest marking scheme, or None if there is none yet."""
+    try:
+        scheme = find_scheme(schema_collection, exam_id, ["questionNumber"])
+    except Exception as e:
+        logger.warning(f"Could not load scheme question numbers: {e}")
+        return None
+    return scheme_question_numbers((scheme or {}).get("structuredData"))
+
+def store_question_answers(exam_id: str, student_id: str) -> int:
+    """
+    Segments all stored pages of a student into per-question answers and replaces the
+    student's documents in ocr_question_answers. Returns the number of questions stored.
+    """
+    pages = list(ocr_collection.find(
+        {"examId": exam_id, "studentId": student_id},
+        {"pageNumber": 1, "rawText": 1, "confidence": 1, "triage": 1}
+    ))
+    spans = [s for s in segment_pages(pages, load_scheme_question_numbers(exam_id)) if s["questionNumber"] > 0]
+
+    now = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {"examId": exam_id, "studentId": student_id, "questionNumber": span["questionNumber"]},
+            {"$set": {
+                "answerText": span["answerText"],
+                "pageNumbers": span["pageNumbers"],
+                "confidence": span["confidence"],
+                "segments": span["segments"],
+                "segmenterVersion": SEGMENTER_VERSION,
+                "updatedAt": now,
+            }, "$setOnInsert": {"createdAt": now}},
+            upsert=True
+        )
+        for span in spans
+    ]
+    if operations:
+        ocr_question_collection.bulk_write(operations, ordered=False)
+    ocr_question_collection.delete_many({
+        "examId": exam_id, "studentId": student_id,
+        "questionNumber": {"$nin": [span["questionNumber"] for span in spans]}
+    })
+    questions = ", ".join(f"Q{span['questionNumber']}" for span in spans) or "none"
+    logger.info(f"Question segmentation: {len(spans)} answer(s) stored ({questions})")
+    return len(spans)
+
+def segment_student(exam_id: str, student_id: str):
+    """
+    store_question_answers that never raises. Returns (questions stored, error or None).
+    On failure the student's ocr_question_answers documents are removed, since the
+    comparator prefers them to the pages and they would describe an older script.
+    """
+    try:
+        return store_question_answers(exam_id, student_id), None
+    except Exception as e:
+        logger.error(f"Γ¥î Question segmentation failed: {str(e)}")
+        error = str(e)
+    try:
+        removed = ocr_question_collection.delete_many({"examId": exam_id, "studentId": student_id}).deleted_count
+        logger.info(f"Removed {removed} stale question answer(s); grading falls back to the pages")
+    except Exception as e:
+        logger.error(f"Γ¥î Could not remove stale question answers: {str(e)}")
+    return 0, error
+
+def text_layer_word_ratio(text: str) -> float:
+    """Fraction of whitespace-separated tokens that look like words or numbers."""
+    tokens = text.split()
+    if not tokens:
+        return 0.0
+    return sum(1 for t in tokens if WORD_TOKEN.match(t)) / len(tokens)
+
+def usable_text_layer(page, layer_text: str) -> bool:
+    """True when a page's embedded text can be trusted instead of OCR (see OCR_TEXT_LAYER_*)."""
+    if len(layer_text) < OCR_TEXT_LAYER_MIN_CHARS:
+        return False
+    if image_coverage(page) > OCR_TEXT_LAYER_MAX_IMAGE_COVERAGE:
+        return False
+    return text_layer_word_ratio(layer_text) >= OCR_TEXT_LAYER_MIN_WORD_RATIO
+
+def page_confidence(result: dict) -> float:
+    if "confidence" in result:
+        return result["confidence"]
+    return parse_confidence_score(result["rawText"])
+
+def build_page_record(exam_id, student_id, file_name, source_hash, page_number, result,
+                      question_number=-1) -> dict:
+    """One ocr_extracted_answers document for a page result (vision, text layer or triage)."""
+    if result.get("triage"):
+        # Never sent to the API; recorded so the page count and viewer stay complete.
+        # questionNumber -1 keeps the page out of grading and of the carry-forward.
+        return {
+            "examId": exam_id,
+            "studentId": student_id,
+            "fileName": file_name,
+            "sourceHash": source_hash,
+            "pageNumber": page_number,
+            "questionNumber": -1,
+            "rawText": "",
+            "confidence": 1.0,
+            "source": "triage",
+            "triage": result["triage"],
+            "duplicateOf": result.get("duplicateOf"),
+            "createdAt": datetime.utcnow(),
+            "updatedAt": datetime.utcnow()
+        }
+    return {
+        "examId": exam_id,
+        "studentId": student_id,
+        "fileName": file_name,
+        "sourceHash": source_hash,
+        "pageNumber": page_number,
+        "questionNumber": question_number,
+        "rawText": result["rawText"],
+        "confidence": page_confidence(result),
+        "source": result.get("source", "vision"),
+        "escalation": result.get("escalation"),
+        "triage": None,
+        "duplicateOf": None,
+        "createdAt": datetime.utcnow(),
+        "updatedAt": datetime.utcnow()
+    }
+
+class OcrRunStats:
+    """
+    Thread-safe counters and per-stage timings for one OCR run.
+    Every pipeline stage reports into the same instance so the summary can show
+    whether a run was limited by rendering (CPU) or by the vision API (network).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    def add_time(self, stage: str, seconds: float):
+        with self._lock:
+            self.timings[stage] += seconds
+
+    def incr(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    @contextmanager
+    def timed(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "timings": {k: round(v, 3) for k, v in self.timings.items()},
+                "counters": dict(self.counters),
+            }
+
+def prepare_page(page, total_pages: int, profile: dict, stats: OcrRunStats, seen_fingerprints: list,
+                 use_text_layer: bool = True, triage: bool = True, dpi: int = OCR_DPI) -> dict:
+    """
+    Resolves a page without the vision model where possible (text layer, triage),
+    otherwise renders and encodes it. Returns a stage item: {"index", "result"} for
+    resolved pages, {"index", "image_b64", "mime", "cacheKey"} for pages needing OCR.
+    """
+    i = page.number
+
+    if use_text_layer:
+        with stats.timed("text_layer"):
+            layer_text = page.get_text("text").strip()
+            usable = usable_text_layer(page, layer_text)
+        if usable:
+            stats.incr("text_layer_pages")
+            logger.info(f"Page {i+1}/{total_pages}: using embedded text layer ({len(layer_text)} chars)")
+            return {"index": i, "result": {"rawText": layer_text, "confidence": OCR_TEXT_LAYER_CONFIDENCE,
+                                           "source": "text_layer"}}
+        if len(layer_text) >= OCR_TEXT_LAYER_MIN_CHARS:
+            stats.incr("text_layer_rejected")
+            logger.info(f"Page {i+1}/{total_pages}: embedded text layer looks like a scan's OCR, using the vision model")
+
+    if triage:
+        with stats.timed("triage"):
+            verdict, duplicate_of = triage_page(page, seen_fingerprints)
+        if verdict:
+            stats.incr(f"triage_{verdict}")
+            reason = f" of page {duplicate_of}" if duplicate_of else ""
+            logger.info(f"Page {i+1}/{total_pages}: {verdict}{reason}, skipped by triage")
+            return {"index": i, "result": {"rawText": "", "triage": verdict, "duplicateOf": duplicate_of}}
+
+    # Convert page to image
+    with stats.timed("render"):
+        pix = render_page(page, dpi, grayscale=profile["grayscale"])
+    with stats.timed("encode"):
+        encoded = encode_rendered(pix, profile)
+        image_b64 = base64.b64encode(encoded["bytes"]).decode('utf-8')
+        cache_key = ocr_cache_key(encoded["bytes"])
+    del pix
+    stats.incr("bytes_raw", encoded["rawBytes"])
+    stats.incr("bytes_encoded", encoded["encodedBytes"])
+    stats.incr("bytes_base64", len(image_b64))
+    logger.info(f"≡ƒû╝∩╕Å  Page {i+1}/{total_pages} image: {encoded['width']}x{encoded['height']}, "
+                f"{encoded['rawBytes'] / 1024:.0f} KB raw -> {encoded['encodedBytes'] / 1024:.0f} KB "
+                f"{encoded['mime']} ({len(image_b64)} bytes base64)")
+    return {"index": i, "image_b64": image_b64, "mime": encoded["mime"], "cacheKey": cache_key}
+
+def extract_text_from_pdf(pdf_path, exam_id=None, student_id=None, max_in_flight=OCR_MAX_IN_FLIGHT,
+                          queue_depth=OCR_QUEUE_DEPTH, use_cache=True, resume=False,
+                          encoding=OCR_ENCODING_PROFILE, quality=None, triage=True, use_text_layer=True,
+                          pages_per_request=OCR_PAGES_PER_REQUEST, escalate=False):
     logger.info("\n" + "="*60)
     logger.info("≡ƒöì OCR EXTRACTION STARTED")
     logger.info("="*60)
@@ -109,12 +669,12 @@ def extract_text_from_pdf(pdf_path, exam_id=None, student_id=None):
         student_id = validate_id(student_id, "Student ID")
     except ValueError as e:
         logger.error(f"Γ¥î Validation error: {e}")
-        sys.exit(1)
+        raise
     
     # Check if file exists
     if not os.path.exists(pdf_path):
         logger.error(f"Γ¥î File not found: {pdf_path}")
-        sys.exit(1)
+        raise FileNotFoundError(f"File not found: {pdf_path}")
     
     file_size = os.path.getsize(pdf_path) / 1024  # KB
     logger.info(f"≡ƒôª File size: {file_size:.2f} KB")
@@ -125,128 +685,779 @@ def extract_text_from_pdf(pdf_path, exam_id=None, student_id=None):
         logger.info(f"≡ƒôÜ Total pages: {total_pages}")
     except Exception as e:
         logger.error(f"Γ¥î Failed to open PDF: {e}")
-        sys.exit(1)
+        raise
     
-    full_text = ""
+    source_hash = file_sha256(pdf_path)
+    file_name = os.path.basename(pdf_path)
+
+    # Earlier ingests may have left several copies of a page; keep only the newest
+    removed = remove_duplicate_pages(exam_id, student_id)
+    if removed:
+        logger.info(f"Removed {removed} duplicate page record(s) left by earlier uploads")
+
+    start_index = 0
     last_question_number = -1
+    if resume:
+        start_index, last_question_number = find_resume_point(exam_id, student_id, source_hash, total_pages)
+        if start_index >= total_pages:
+            logger.info("All pages of this PDF are already stored; nothing to resume")
+        elif start_index:
+            logger.info(f"Resuming from page {start_index + 1} (pages 1-{start_index} already stored)")
+
+    max_in_flight = max(1, int(max_in_flight or 1))
+    pages_per_request = max(1, int(pages_per_request or 1))
+    profile = get_encoding_profile(encoding, quality)
+    logger.info(f"OCR backend: {ocr_backend.name} ({OCR_MODEL})")
+    logger.info(f"Text layer fast path: {'on' if use_text_layer else 'off'}")
+    logger.info(f"Page triage (blank/duplicate skipping): {'on' if triage else 'off'}")
+    first_pass_dpi = OCR_FIRST_PASS_DPI if escalate else OCR_DPI
+    if escalate:
+        logger.info(f"Two-pass OCR: {OCR_MODEL} at {first_pass_dpi} dpi, pages below confidence "
+                    f"{OCR_ESCALATION_THRESHOLD} re-read with {OCR_ESCALATION_MODEL} at {OCR_ESCALATION_DPI} dpi")
+    else:
+        logger.info(f"Single-pass OCR: {OCR_MODEL} at {first_pass_dpi} dpi")
+    logger.info(f"Encoding profile: {profile['name']} ({profile['format']}, "
+                f"grayscale={profile['grayscale']}, quality={profile['quality']}, crop={profile['crop']})")
+    queue_depth = max(1, int(queue_depth or 1))
+    logger.info(f"Max requests in flight: {max_in_flight}, pages per request: {pages_per_request}, "
+                f"queue depth: {queue_depth}, cache: {'on' if use_cache else 'off'}")
+
+    stats = OcrRunStats()
+    run_started = time.perf_counter()
+
+    # Bounded hand-off queues between the stages. Peak memory is governed by
+    # queue_depth + max_in_flight * pages_per_request pages, not by the page count of the script.
+    encoded_queue = queue.Queue(maxsize=queue_depth)
+    persist_queue = queue.Queue(maxsize=queue_depth)
+
+    writer = OcrPageWriter(ocr_collection)
+    total_characters = 0
     extracted_pages = []
+    # Pages that could not be rendered, OCR'd or stored; they are not written, so --resume retries them
+    failed_pages = set()
 
-    for i, page in enumerate(doc):
-        logger.info(f"\n--- Processing page {i+1}/{total_pages} ---")
-        
+    # --- Stage 1: rasterize + encode (PyMuPDF only ever runs on this thread) ---
+    def render_stage():
+        seen_fingerprints = []
         try:
-            # Convert page to image
-            pix = page.get_pixmap(dpi=200)
-            image_bytes = pix.tobytes()
-            image_b64 = base64.b64encode(image_bytes).decode('utf-8')
-            logger.info(f"≡ƒû╝∩╕Å  Image size: {len(image_b64)} bytes (base64)")
-            
-            # Call OpenAI Vision API
-            logger.info("≡ƒñû Calling OpenAI Vision API...")
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You perform precise OCR on handwritten documents."},
-                    {"role": "user",
-                     "content": [
-                         {"type": "text", "text": DETAILED_OCR_PROMPT},
-                         {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_b64}"}}
-                     ]}
-                ]
-            )
+            for i in range(start_index, total_pages):
+                try:
+                    item = prepare_page(doc[i], total_pages, profile, stats, seen_fingerprints,
+                                        use_text_layer=use_text_layer, triage=triage, dpi=first_pass_dpi)
+                except Exception as e:
+                    logger.error(f"Γ¥î Error rendering page {i+1}: {str(e)}")
+                    failed_pages.add(i + 1)
+                    continue
+
+                with stats.timed("render_blocked_on_queue"):
+                    encoded_queue.put(item)
+        finally:
+            encoded_queue.put(_STAGE_DONE)
+
+    # --- Stage 3: persist, strictly in page order ---
+    def store_triaged_page(i, result):
+        writer.add(build_page_record(exam_id, student_id, file_name, source_hash, i + 1, result))
+        extracted_pages.append({
+            'page': i + 1,
+            'question': -1,
+            'confidence': 1.0,
+            'text_length': 0,
+            'triage': result["triage"],
+            'duplicateOf': result.get("duplicateOf")
+        })
+
+    def store_page(i, result):
+        # Runs strictly in page order so the question number carry-forward
+        # matches the sequential path regardless of completion order.
+        nonlocal last_question_number, total_characters
+
+        if result.get("triage"):
+            store_triaged_page(i, result)
+            return
+
+        extracted_text = result["rawText"]
+        logger.info(f"Γ£à OCR completed for page {i+1}")
+        logger.info(f"≡ƒô¥ Extracted text length: {len(extracted_text)} characters")
 
-            extracted_text = response.choices[0].message.content
-            logger.info(f"Γ£à OCR completed for page {i+1}")
-            logger.info(f"≡ƒô¥ Extracted text length: {len(extracted_text)} characters")
+        # Extract confidence score (text-layer pages carry OCR_TEXT_LAYER_CONFIDENCE)
+        confidence_score = page_confidence(result)
+        logger.info(f"≡ƒÄ» Confidence score: {confidence_score}")
 
-            # Extract confidence score
-            confidence_score = 0.0
-            if "CONFIDENCE_SCORE:" in extracted_text:
+        # Extract question number
+        question_number = extract_question_number(extracted_text)
+        
+        if question_number == -1 and last_question_number != -1:
+            question_number = last_question_number
+            logger.info(f"≡ƒôî Using last question number: {question_number}")
+        elif question_number != -1:
+            last_question_number = question_number
+            logger.info(f"≡ƒöó Detected question number: {question_number}")
+        else:
+            logger.warning("ΓÜá∩╕Å  No question number detected")
+
+        # Build record
+        record = build_page_record(exam_id, student_id, file_name, source_hash, i + 1, result, question_number)
+
+        # Buffered; flushed to MongoDB as a bulk upsert
+        writer.add(record)
+        
+        extracted_pages.append({
+            'page': i + 1,
+            'question': question_number,
+            'confidence': confidence_score,
+            'text_length': len(extracted_text),
+            'source': result.get("source", "vision")
+        })
+        total_characters += len(extracted_text)
+
+    def persist_stage():
+        while True:
+            item = persist_queue.get()
+            if item is _STAGE_DONE:
                 try:
-                    confidence_score = float(
-                        extracted_text.split("CONFIDENCE_SCORE:")[1].strip().split()[0]
-                    )
-                    logger.info(f"≡ƒÄ» Confidence score: {confidence_score}")
-                except:
-                    logger.warning("ΓÜá∩╕Å  Could not parse confidence score")
-
-            # Extract question number
-            question_number = extract_question_number(extracted_text)
-            
-            if question_number == -1 and last_question_number != -1:
-                question_number = last_question_number
-                logger.info(f"≡ƒôî Using last question number: {question_number}")
-            elif question_number != -1:
-                last_question_number = question_number
-                logger.info(f"≡ƒöó Detected question number: {question_number}")
+                    with stats.timed("persist"):
+                        writer.flush()
+                except Exception as e:
+                    logger.error(f"Γ¥î Error saving pages {sorted(writer.failed_pages)} to MongoDB: {str(e)}")
+                return
+            i, result = item
+            try:
+                with stats.timed("persist"):
+                    store_page(i, result)
+            except Exception as e:
+                logger.error(f"Γ¥î Error processing page {i+1}: {str(e)}")
+                failed_pages.add(i + 1)
+
+    # --- Stage 2: vision calls on a thread pool with a bounded in-flight window ---
+    def cached_text_for(item, multi_page=False):
+        # A multi-page job can reuse single-page text; a single page never gets split text
+        if not use_cache:
+            return None
+        try:
+            cached_text = get_cached_ocr(item["cacheKey"])
+            if cached_text is None and multi_page:
+                cached_text = get_cached_ocr(multi_page_cache_key(item["cacheKey"]))
+        except Exception as e:
+            logger.warning(f"OCR cache lookup failed: {e}")
+            return None
+        stats.incr("cache_hits" if cached_text is not None else "cache_misses")
+        return cached_text
+
+    def remember(item, extracted_text, multi_page=False):
+        # Per-page cache entries, keyed by the kind of request the text came from
+        if not use_cache:
+            return
+        try:
+            key = multi_page_cache_key(item["cacheKey"]) if multi_page else item["cacheKey"]
+            put_cached_ocr(key, extracted_text)
+        except Exception as e:
+            logger.warning(f"OCR cache write failed: {e}")
+
+    def ocr_single(item):
+        with stats.timed("ocr_calls"):
+            extracted_text = ocr_page_image(item["image_b64"], item["mime"])
+        stats.incr("vision_requests")
+        remember(item, extracted_text)
+        return extracted_text
+
+    def ocr_job(items):
+        # One request for all uncached pages of the job; returns results in item order
+        texts = [cached_text_for(item, multi_page=len(items) > 1) for item in items]
+        missing = [k for k, text in enumerate(texts) if text is None]
+
+        if len(missing) > 1:
+            with stats.timed("ocr_calls"):
+                output = ocr_page_images([(items[k]["image_b64"], items[k]["mime"]) for k in missing])
+            stats.incr("vision_requests")
+            stats.incr("multi_page_requests")
+            parts = split_multi_page_output(output, len(missing))
+            if parts is None:
+                pages = [items[k]["index"] + 1 for k in missing]
+                logger.warning(f"Could not split multi-page OCR output for pages {pages}; retrying them one by one")
+                stats.incr("multi_page_fallbacks")
             else:
-                logger.warning("ΓÜá∩╕Å  No question number detected")
-
-            # Build record
-            record = {
-                "examId": exam_id,
-                "studentId": student_id,
-                "fileName": os.path.basename(pdf_path),
-                "pageNumber": i + 1,
-                "questionNumber": question_number,
-                "rawText": extracted_text,
-                "confidence": confidence_score,
-                "createdAt": datetime.utcnow(),
-                "updatedAt": datetime.utcnow()
-            }
+                for k, page_text in zip(missing, parts):
+                    texts[k] = page_text
+                    remember(items[k], page_text, multi_page=True)
+                missing = []
+
+        for k in missing:
+            texts[k] = ocr_single(items[k])
+        return [{"rawText": text} for text in texts]
+
+    in_flight = deque()
+    pending = []
+
+    def submit_pending(pool):
+        # Call OpenAI Vision API (unless the pages are already cached)
+        if not pending:
+            return
+        pages = [item["index"] + 1 for item in pending]
+        logger.info(f"≡ƒñû Calling OpenAI Vision API for page(s) {pages}...")
+        in_flight.append(([item["index"] for item in pending], pool.submit(ocr_job, list(pending))))
+        pending.clear()
+
+    def drain_oldest():
+        # Consumed from the left of the window, i.e. in page order
+        indices, future = in_flight.popleft()
+        try:
+            results = future.result()
+        except Exception as e:
+            logger.error(f"Γ¥î Error processing page(s) {[i + 1 for i in indices]}: {str(e)}")
+            failed_pages.update(i + 1 for i in indices)
+            return
+        for i, result in zip(indices, results):
+            consider_escalation(i, result)
+            with stats.timed("ocr_blocked_on_persist"):
+                persist_queue.put((i, result))
+
+    # --- Second pass: re-read low-confidence pages at a higher DPI with the stronger model ---
+    escalation_candidates = []
+
+    def consider_escalation(i, result):
+        if not escalate or result.get("triage") or result.get("source", "vision") != "vision":
+            return
+        stats.incr("vision_pages")
+        confidence = page_confidence(result)
+        if confidence < OCR_ESCALATION_THRESHOLD:
+            escalation_candidates.append((i, confidence))
+
+    def ocr_escalated(item):
+        cache_key = ocr_cache_key(item["bytes"], OCR_ESCALATION_MODEL)
+        cached_text = cached_text_for({"cacheKey": cache_key})
+        if cached_text is not None:
+            return cached_text
+        with stats.timed("escalation_calls"):
+            extracted_text = ocr_page_image(item["image_b64"], item["mime"], escalation_backend)
+        stats.incr("escalation_requests")
+        if use_cache:
+            try:
+                put_cached_ocr(cache_key, extracted_text, OCR_ESCALATION_MODEL)
+            except Exception as e:
+                logger.warning(f"OCR cache write failed: {e}")
+        return extracted_text
+
+    def run_escalation(pool):
+        """
+        Runs after the first pass, once the render thread is done with the document.
+        Returns (page index, result) for the pages where the second read scored
+        higher than the first; on a tie the first pass is kept.
+        """
+        improved = []
+        window = deque()
+
+        def collect():
+            i, first_confidence, future = window.popleft()
+            try:
+                extracted_text = future.result()
+            except Exception as e:
+                logger.error(f"Γ¥î Escalation failed for page {i+1}: {str(e)}")
+                stats.incr("escalation_failed")
+                return
+            confidence = parse_confidence_score(extracted_text)
+            if confidence > first_confidence:
+                logger.info(f"Page {i+1}: escalated confidence {confidence} (first pass {first_confidence}), keeping it")
+                stats.incr("escalation_improved")
+                improved.append((i, {"rawText": extracted_text, "confidence": confidence, "escalation": {
+                    "firstPassConfidence": first_confidence,
+                    "firstPassDpi": first_pass_dpi,
+                    "firstPassModel": OCR_MODEL,
+                    "model": OCR_ESCALATION_MODEL,
+                    "dpi": OCR_ESCALATION_DPI,
+                }}))
+            else:
+                logger.info(f"Page {i+1}: escalated confidence {confidence} not above first pass {first_confidence}")
+                stats.incr("escalation_kept_first_pass")
+
+        for i, first_confidence in escalation_candidates:
+            try:
+                with stats.timed("escalation_render"):
+                    pix = render_page(doc[i], OCR_ESCALATION_DPI, grayscale=profile["grayscale"])
+                    encoded = encode_rendered(pix, profile)
+                    del pix
+                item = {"bytes": encoded["bytes"], "mime": encoded["mime"],
+                        "image_b64": base64.b64encode(encoded["bytes"]).decode('utf-8')}
+            except Exception as e:
+                logger.error(f"Γ¥î Error rendering page {i+1} for escalation: {str(e)}")
+                stats.incr("escalation_failed")
+                continue
+            window.append((i, first_confidence, pool.submit(ocr_escalated, item)))
+            del item
+            while len(window) >= max_in_flight:
+                collect()
+        while window:
+            collect()
+        return improved
+
+    escalated_results = []
+
+    renderer = threading.Thread(target=render_stage, name="ocr-render", daemon=True)
+    persister = threading.Thread(target=persist_stage, name="ocr-persist", daemon=True)
+    renderer.start()
+    persister.start()
 
-            # Insert into MongoDB
-            result = ocr_collection.insert_one(record)
-            logger.info(f"≡ƒÆ╛ Saved to MongoDB with ID: {result.inserted_id}")
-            
-            extracted_pages.append({
-                'page': i + 1,
-                'question': question_number,
-                'confidence': confidence_score,
-                'text_length': len(extracted_text)
-            })
-
-            full_text += extracted_text + "\n\n"
-            
+    try:
+        with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+            while True:
+                with stats.timed("ocr_waiting_for_render"):
+                    item = encoded_queue.get()
+                if item is _STAGE_DONE:
+                    break
+                if "result" in item:
+                    # Resolved without the vision model; still passes through the
+                    # window so pages reach the persist stage in order
+                    submit_pending(pool)
+                    future = Future()
+                    future.set_result([item["result"]])
+                    in_flight.append(([item["index"]], future))
+                else:
+                    pending.append(item)
+                    if len(pending) >= pages_per_request:
+                        submit_pending(pool)
+                del item
+
+                while len(in_flight) >= max_in_flight:
+                    drain_oldest()
+
+            submit_pending(pool)
+            while in_flight:
+                drain_oldest()
+
+            if escalation_candidates:
+                logger.info(f"Escalating {len(escalation_candidates)} low-confidence page(s): "
+                            f"{[i + 1 for i, _ in escalation_candidates]}")
+                escalated_results = run_escalation(pool)
+    finally:
+        persist_queue.put(_STAGE_DONE)
+        renderer.join()
+        persister.join()
+
+    if escalated_results:
+        # The first-pass records are already stored; overwrite them (the carry-forward
+        # below is redone, since the new text may change it)
+        summary_by_page = {p['page']: p for p in extracted_pages}
+        for i, result in escalated_results:
+            writer.add(build_page_record(exam_id, student_id, file_name, source_hash, i + 1, result,
+                                         extract_question_number(result["rawText"])))
+            entry = summary_by_page.get(i + 1)
+            if entry:
+                total_characters += len(result["rawText"]) - entry['text_length']
+                entry.update(confidence=result["confidence"], text_length=len(result["rawText"]), escalated=True)
+        try:
+            with stats.timed("persist"):
+                writer.flush()
         except Exception as e:
-            logger.error(f"Γ¥î Error processing page {i+1}: {str(e)}")
-            continue
+            logger.error(f"Γ¥î Error saving escalated pages to MongoDB: {str(e)}")
+
+    # Redo the carry-forward over every stored page, so the numbers do not depend on
+    # where a --resume run restarted or on escalated text
+    try:
+        with stats.timed("persist"):
+            renumbered = finalize_question_numbers(exam_id, student_id)
+    except Exception as e:
+        logger.error(f"Γ¥î Error finalizing question numbers: {str(e)}")
+        renumbered = 0
+    if renumbered:
+        logger.info(f"Question numbers of {renumbered} page(s) updated by the carry-forward")
+        question_numbers = {d["pageNumber"]: d["questionNumber"] for d in ocr_collection.find(
+            {"examId": exam_id, "studentId": student_id}, {"pageNumber": 1, "questionNumber": 1})}
+        for entry in extracted_pages:
+            entry['question'] = question_numbers.get(entry['page'], entry['question'])
+
+    with stats.timed("segment"):
+        questions_stored, segmentation_error = segment_student(exam_id, student_id)
+
+    stats.add_time("wall", time.perf_counter() - run_started)
+    # Pages lost with a failed bulk write, including the final flush
+    failed_pages.update(writer.failed_pages)
+
+    if use_cache:
+        try:
+            evicted = prune_ocr_cache()
+            if evicted:
+                logger.info(f"OCR cache: evicted {evicted} least recently used entries")
+        except Exception as e:
+            logger.warning(f"OCR cache pruning failed: {e}")
 
-    # Close connections
+    # A shorter re-upload must not leave pages of the previous script behind
+    if not resume:
+        stale = ocr_collection.delete_many(
+            {"examId": exam_id, "studentId": student_id, "pageNumber": {"$gt": total_pages}}
+        ).deleted_count
+        if stale:
+            logger.info(f"Removed {stale} stale page record(s) beyond page {total_pages}")
+
+    # Close the document; the Mongo client is shared by every script processed in this process
     doc.close()
-    mongo_client.close()
     
     logger.info("\n" + "="*60)
     logger.info("Γ£à OCR EXTRACTION COMPLETED")
     logger.info("="*60)
     logger.info(f"≡ƒôè Summary:")
-    logger.info(f"   Total pages processed: {len(extracted_pages)}/{total_pages}")
-    logger.info(f"   Total characters extracted: {len(full_text)}")
+    logger.info(f"   Total pages processed: {len(extracted_pages)}/{total_pages - start_index}")
+    logger.info(f"   Pages written to MongoDB: {writer.pages_written} ({writer.pages_rewritten} rewritten)")
+    logger.info(f"   Total characters extracted: {total_characters}")
     
     # Display per-page summary
     logger.info(f"\n≡ƒôä Page-wise Summary:")
     for p in extracted_pages:
-        logger.info(f"   Page {p['page']}: Q{p['question']}, Confidence: {p['confidence']:.2f}, Length: {p['text_length']} chars")
+        if p.get('triage'):
+            of_page = f" of page {p['duplicateOf']}" if p.get('duplicateOf') else ""
+            logger.info(f"   Page {p['page']}: {p['triage']}{of_page} (skipped by triage)")
+            continue
+        escalated = " (escalated)" if p.get('escalated') else ""
+        logger.info(f"   Page {p['page']}: Q{p['question']}, Confidence: {p['confidence']:.2f}, Length: {p['text_length']} chars, Source: {p['source']}{escalated}")
+
+    logger.info(f"\nVision requests: {stats.counters['vision_requests']} "
+                f"({stats.counters['multi_page_requests']} multi-page, "
+                f"{stats.counters['multi_page_fallbacks']} fell back to per-page calls)")
+    if use_text_layer:
+        logger.info(f"\nText layer: {stats.counters['text_layer_pages']} page(s) read without OCR, "
+                    f"{stats.counters['text_layer_rejected']} scanned/low-quality layer(s) sent to OCR")
+    if triage:
+        logger.info(f"\nTriage: {stats.counters['triage_blank']} blank, "
+                    f"{stats.counters['triage_duplicate']} duplicate page(s) not sent to the vision API")
+
+    if escalate:
+        c = stats.counters
+        logger.info(f"\nEscalation: {len(escalation_candidates)} of {c['vision_pages']} vision page(s) below "
+                    f"{OCR_ESCALATION_THRESHOLD} re-read ({c['escalation_requests']} request(s)); "
+                    f"{c['escalation_improved']} improved, {c['escalation_kept_first_pass']} kept first pass, "
+                    f"{c['escalation_failed']} failed")
+    if use_cache:
+        logger.info(f"\nOCR cache: {stats.counters['cache_hits']} hit(s), {stats.counters['cache_misses']} miss(es)")
+    log_encoding_summary(stats, profile)
+    log_stage_timings(stats)
+    logger.info(f"\nAPI scheduler: {scheduler.snapshot()}")
+    if failed_pages:
+        logger.error(f"Γ¥î {len(failed_pages)} page(s) failed: {sorted(failed_pages)}; "
+                     f"re-run with --resume to retry them")
     
     logger.info("="*60 + "\n")
     
-    return full_text
+    return {
+        "pagesProcessed": len(extracted_pages),
+        "pagesWritten": writer.pages_written,
+        "pagesRewritten": writer.pages_rewritten,
+        "resumedFromPage": start_index + 1,
+        "totalPages": total_pages,
+        "totalCharacters": total_characters,
+        "questionsStored": questions_stored,
+        "segmentationError": segmentation_error,
+        "pagesFailed": sorted(failed_pages),
+        # Pages triage kept away from the vision model, so a wrong skip can be spotted
+        "pagesSkipped": [{"page": p["page"], "reason": p["triage"], "duplicateOf": p.get("duplicateOf")}
+                         for p in extracted_pages if p.get("triage")],
+        "pages": extracted_pages,
+        "stats": stats.as_dict(),
+    }
+
+def log_encoding_summary(stats: OcrRunStats, profile: dict):
+    """Logs payload sizes for the run so encoding profiles can be compared."""
+    c = stats.counters
+    logger.info(f"\nEncoding ({profile['name']}):")
+    logger.info(f"   Raw pixmap bytes:   {c['bytes_raw'] / 1024:.0f} KB")
+    logger.info(f"   Encoded bytes:      {c['bytes_encoded'] / 1024:.0f} KB")
+    logger.info(f"   Uploaded (base64):  {c['bytes_base64'] / 1024:.0f} KB")
+    if c['bytes_raw']:
+        logger.info(f"   Compression ratio:  {c['bytes_raw'] / max(c['bytes_encoded'], 1):.1f}x")
+
+def log_stage_timings(stats: OcrRunStats):
+    """Logs per-stage timings and which side of the pipeline limited the run."""
+    t = stats.timings
+    logger.info(f"\n⏱️  Stage timings:")
+    logger.info(f"   Text layer extraction:   {t['text_layer']:.2f}s")
+    logger.info(f"   Triage (thumbnails):     {t['triage']:.2f}s")
+    logger.info(f"   Render (PyMuPDF):        {t['render']:.2f}s")
+    logger.info(f"   Encode (PNG/base64):     {t['encode']:.2f}s")
+    logger.info(f"   Vision calls (summed):   {t['ocr_calls']:.2f}s")
+    logger.info(f"   Escalation render:       {t['escalation_render']:.2f}s")
+    logger.info(f"   Escalation calls:        {t['escalation_calls']:.2f}s")
+    logger.info(f"   Persist (MongoDB):       {t['persist']:.2f}s")
+    logger.info(f"   Question segmentation:   {t['segment']:.2f}s")
+    logger.info(f"   OCR idle, waiting pages: {t['ocr_waiting_for_render']:.2f}s")
+    logger.info(f"   Render blocked on queue: {t['render_blocked_on_queue']:.2f}s")
+    logger.info(f"   Wall time:               {t['wall']:.2f}s")
+
+    # If the OCR stage spent its time waiting for pages, rendering is the bottleneck;
+    # if the renderer spent its time blocked on a full queue, the network is.
+    if t['ocr_waiting_for_render'] > t['render_blocked_on_queue']:
+        logger.info("   Bottleneck: CPU (page rendering/encoding)")
+    else:
+        logger.info("   Bottleneck: network (vision API)")
+
+# ============================================================================
+# OFFLINE BATCH MODE (OpenAI Batch API JSONL)
+# ============================================================================
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+def batch_custom_id(exam_id, student_id, page_number, file_name, source_hash, cache_key) -> str:
+    """Everything needed to store a result is carried in custom_id, so results files are self-contained."""
+    return urlencode({"e": exam_id, "s": student_id, "p": page_number,
+                      "f": file_name, "h": source_hash, "k": cache_key})
+
+def parse_batch_custom_id(custom_id: str) -> dict:
+    fields = dict(parse_qsl(custom_id, keep_blank_values=True))
+    return {
+        "examId": fields["e"],
+        "studentId": fields["s"],
+        "pageNumber": int(fields["p"]),
+        "fileName": fields.get("f", ""),
+        "sourceHash": fields.get("h", ""),
+        "cacheKey": fields.get("k", ""),
+    }
+
+def finalize_question_numbers(exam_id: str, student_id: str) -> int:
+    """
+    Re-applies the page-order question number carry-forward over all stored pages
+    of a student. The batch path stores pages out of order (local pages at export,
+    vision pages at ingest), so numbers are assigned once everything is present.
+    Returns the number of pages whose questionNumber changed.
+    """
+    last_question_number = -1
+    operations = []
+    pages = ocr_collection.find(
+        {"examId": exam_id, "studentId": student_id},
+        {"pageNumber": 1, "questionNumber": 1, "rawText": 1, "triage": 1}
+    ).sort("pageNumber", 1)
+    for page in pages:
+        if page.get("triage"):
+            continue
+        question_number = extract_question_number(page.get("rawText", ""))
+        if question_number == -1 and last_question_number != -1:
+            question_number = last_question_number
+        elif question_number != -1:
+            last_question_number = question_number
+        if question_number != page.get("questionNumber"):
+            operations.append(UpdateOne(
+                {"_id": page["_id"]},
+                {"$set": {"questionNumber": question_number, "updatedAt": datetime.utcnow()}}
+            ))
+    if operations:
+        ocr_collection.bulk_write(operations, ordered=False)
+    return len(operations)
+
+def write_batch_requests(pdf_path, exam_id, student_id, out_path, encoding=OCR_ENCODING_PROFILE,
+                         quality=None, triage=True, use_text_layer=True, use_cache=True) -> dict:
+    """
+    Step 1 of the offline workflow: appends one Batch API request line per page that
+    needs the vision model to out_path. Pages resolved locally (text layer, triage,
+    OCR cache) are stored immediately and never enter the batch.
+    """
+    logger.info("\n" + "="*60)
+    logger.info("OCR BATCH EXPORT")
+    logger.info("="*60)
+
+    exam_id = validate_id(exam_id, "Exam ID")
+    student_id = validate_id(student_id, "Student ID")
+    if not os.path.exists(pdf_path):
+        raise FileNotFoundError(f"File not found: {pdf_path}")
+
+    doc = fitz.open(pdf_path)
+    total_pages = len(doc)
+    source_hash = file_sha256(pdf_path)
+    file_name = os.path.basename(pdf_path)
+    profile = get_encoding_profile(encoding, quality)
+    stats = OcrRunStats()
+    writer = OcrPageWriter(ocr_collection)
+    seen_fingerprints = []
+
+    remove_duplicate_pages(exam_id, student_id)
 
+    with open(out_path, "a", encoding="utf-8") as out:
+        for i in range(total_pages):
+            try:
+                item = prepare_page(doc[i], total_pages, profile, stats, seen_fingerprints,
+                                    use_text_layer=use_text_layer, triage=triage)
+            except Exception as e:
+                logger.error(f"Γ¥î Error rendering page {i+1}: {str(e)}")
+                continue
+
+            result = item.get("result")
+            if result is None and use_cache:
+                cached_text = get_cached_ocr(item["cacheKey"])
+                if cached_text is not None:
+                    stats.incr("cache_hits")
+                    result = {"rawText": cached_text}
+
+            if result is not None:
+                # Provisional question number; finalized once the batch results are ingested
+                writer.add(build_page_record(exam_id, student_id, file_name, source_hash, i + 1, result,
+                                             extract_question_number(result["rawText"])))
+                stats.incr("pages_local")
+                continue
+
+            out.write(json.dumps({
+                "custom_id": batch_custom_id(exam_id, student_id, i + 1, file_name, source_hash, item["cacheKey"]),
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": build_ocr_request_body(item["image_b64"], item["mime"])
+            }) + "\n")
+            stats.incr("batch_requests")
+
+    writer.flush()
+    doc.close()
+    ocr_collection.delete_many(
+        {"examId": exam_id, "studentId": student_id, "pageNumber": {"$gt": total_pages}}
+    )
+    finalize_question_numbers(exam_id, student_id)
+    # Replaces question answers of an earlier upload; ingest_batch_results segments
+    # again once the vision pages are in
+    questions_stored, segmentation_error = segment_student(exam_id, student_id)
+
+    counters = stats.counters
+    logger.info(f"Wrote {counters['batch_requests']} request line(s) to {out_path}; "
+                f"{counters['pages_local']} of {total_pages} page(s) resolved locally")
+    return {"totalPages": total_pages, "batchRequests": counters["batch_requests"],
+            "pagesLocal": counters["pages_local"], "questionsStored": questions_stored,
+            "segmentationError": segmentation_error, "stats": stats.as_dict()}
+
+def ingest_batch_results(results_path, use_cache=True) -> dict:
+    """
+    Step 2 of the offline workflow: reads a Batch API output file and stores each page
+    with the same confidence and question-number parsing as the live path.
+    """
+    logger.info("\n" + "="*60)
+    logger.info("OCR BATCH INGEST")
+    logger.info("="*60)
+
+    writer = OcrPageWriter(ocr_collection)
+    students = set()
+    ingested = 0
+    failed = []
+
+    with open(results_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            custom_id = None
+            try:
+                entry = json.loads(line)
+                custom_id = entry.get("custom_id")
+                meta = parse_batch_custom_id(custom_id)
+                response = entry.get("response") or {}
+                if entry.get("error") or response.get("status_code") != 200:
+                    raise ValueError(f"request failed: {entry.get('error') or response.get('status_code')}")
+                extracted_text = response["body"]["choices"][0]["message"]["content"]
+            except Exception as e:
+                logger.error(f"Γ¥î Line {line_number} ({custom_id}): {str(e)}")
+                failed.append(custom_id or f"line {line_number}")
+                continue
+
+            result = {"rawText": extracted_text}
+            writer.add(build_page_record(meta["examId"], meta["studentId"], meta["fileName"],
+                                         meta["sourceHash"], meta["pageNumber"], result,
+                                         extract_question_number(extracted_text)))
+            if use_cache and meta["cacheKey"]:
+                try:
+                    put_cached_ocr(meta["cacheKey"], extracted_text)
+                except Exception as e:
+                    logger.warning(f"OCR cache write failed: {e}")
+            students.add((meta["examId"], meta["studentId"]))
+            ingested += 1
+
+    writer.flush()
+    segmentation_failed = []
+    for exam_id, student_id in sorted(students):
+        finalize_question_numbers(exam_id, student_id)
+        if segment_student(exam_id, student_id)[1]:
+            segmentation_failed.append(student_id)
+
+    logger.info(f"Ingested {ingested} page(s) for {len(students)} student(s); {len(failed)} failed line(s)")
+    return {"pagesIngested": ingested, "students": len(students), "failed": failed,
+            "segmentationFailed": segmentation_failed}
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Extract text from PDF using OCR and save to database.")
-    parser.add_argument("pdf_path", help="Path to the PDF file")
-    parser.add_argument("--exam-id", required=True, help="MongoDB ObjectId for the exam (hex string)")
-    parser.add_argument("--student-id", required=True, help="MongoDB ObjectId for the student (hex string)")
+    parser.add_argument("pdf_path", nargs="?", help="Path to the PDF file (not needed with --batch-in)")
+    parser.add_argument("--exam-id", help="MongoDB ObjectId for the exam (hex string)")
+    parser.add_argument("--student-id", help="MongoDB ObjectId for the student (hex string)")
+    parser.add_argument("--batch-out", metavar="JSONL",
+                        help="Append Batch API request lines for this script to JSONL instead of calling the API")
+    parser.add_argument("--batch-in", metavar="JSONL",
+                        help="Ingest a Batch API results file into the OCR collection")
+    parser.add_argument("--backend", choices=sorted(OCR_BACKENDS), default=OCR_BACKEND,
+                        help="Vision OCR backend ('local' returns canned output with simulated latency, no API key needed)")
+    parser.add_argument("--max-in-flight", type=int, default=OCR_MAX_IN_FLIGHT,
+                        help="Maximum number of vision API requests in flight (1 = sequential)")
+    parser.add_argument("--hedge", action="store_true",
+                        help="Send a duplicate vision request when one is slower than usual (see API_HEDGE_*)")
+    parser.add_argument("--pages-per-request", type=int, default=OCR_PAGES_PER_REQUEST,
+                        help="Send this many page images in one vision request (1 = one request per page)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip pages already stored for this exam/student/PDF and continue from the first missing page")
+    parser.add_argument("--no-text-layer", action="store_true",
+                        help="Rasterize and OCR every page even if the PDF has an embedded text layer")
+    parser.add_argument("--escalate", action="store_true",
+                        help=f"First pass at {OCR_FIRST_PASS_DPI} dpi, then re-read pages below "
+                             f"{OCR_ESCALATION_THRESHOLD} confidence with {OCR_ESCALATION_MODEL} at {OCR_ESCALATION_DPI} dpi")
+    parser.add_argument("--no-triage", action="store_true",
+                        help="Send every page to the vision API, including blank and duplicate pages")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always call the vision API, ignoring and not updating the OCR cache")
+    parser.add_argument("--encoding", choices=sorted(ENCODING_PROFILES), default=OCR_ENCODING_PROFILE,
+                        help="Page image encoding profile sent to the vision model")
+    parser.add_argument("--quality", type=int, default=None,
+                        help="Override the JPEG/WebP quality of the encoding profile")
+    parser.add_argument("--queue-depth", type=int, default=OCR_QUEUE_DEPTH,
+                        help="Capacity of the queues between the render, OCR and persist stages")
 
     args = parser.parse_args()
 
+    if args.backend != ocr_backend.name:
+        ocr_backend = get_backend(args.backend, OCR_MODEL)
+        escalation_backend = get_backend(args.backend, OCR_ESCALATION_MODEL)
+    if args.hedge:
+        scheduler.hedging = True
+
+    if args.batch_in:
+        try:
+            summary = ingest_batch_results(args.batch_in, use_cache=not args.no_cache)
+        except Exception as e:
+            logger.error(f"Γ¥î FATAL ERROR: {str(e)}")
+            sys.exit(1)
+        finally:
+            mongo_client.close()
+        sys.exit(1 if summary["failed"] else 0)
+
+    if not args.pdf_path or not args.exam_id or not args.student_id:
+        parser.error("pdf_path, --exam-id and --student-id are required unless --batch-in is given")
+
     # Convert to absolute path
     pdf_path = os.path.abspath(args.pdf_path)
+
+    if args.batch_out:
+        try:
+            write_batch_requests(pdf_path, args.exam_id, args.student_id, args.batch_out,
+                                 encoding=args.encoding,
+                                 quality=args.quality,
+                                 triage=not args.no_triage,
+                                 use_text_layer=not args.no_text_layer,
+                                 use_cache=not args.no_cache)
+        except Exception as e:
+            logger.error(f"Γ¥î FATAL ERROR: {str(e)}")
+            sys.exit(1)
+        finally:
+            mongo_client.close()
+        sys.exit(0)
     
     try:
-        result = extract_text_from_pdf(pdf_path, args.exam_id, args.student_id)
-        sys.exit(0)  # Success
+        result = extract_text_from_pdf(pdf_path, args.exam_id, args.student_id,
+                                       max_in_flight=args.max_in_flight,
+                                       queue_depth=args.queue_depth,
+                                       use_cache=not args.no_cache,
+                                       resume=args.resume,
+                                       encoding=args.encoding,
+                                       quality=args.quality,
+                                       triage=not args.no_triage,
+                                       use_text_layer=not args.no_text_layer,
+                                       pages_per_request=args.pages_per_request,
+                                       escalate=args.escalate)
+        sys.exit(1 if result["pagesFailed"] else 0)
     except Exception as e:
         logger.error(f"Γ¥î FATAL ERROR: {str(e)}")
         sys.exit(1)  # Failure
+    finally:
+        mongo_client.close()
@@ -0,0 +1,214 @@
+"""
+Page rasterization and image encoding helpers shared by ocr_pdf.py and scheme_extractor.py.
+Encoding profiles trade payload size (upload time, vision tokens) against fidelity.
+"""
+
+import io
+import logging
+
+import fitz  # PyMuPDF
+import numpy as np
+
+try:
+    from PIL import Image  # Optional: only needed for the WebP profile
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Pixel values (0-255, per channel) darker than this count as ink
+INK_THRESHOLD = 200
+# Padding kept around the ink bounding box when cropping, in pixels
+CROP_MARGIN_PX = 24
+
+# Named encoding profiles for OCR payloads.
+#   format:    png | jpeg | webp
+#   grayscale: render with a single gray channel
+#   quality:   lossy quality for jpeg/webp (ignored for png)
+#   crop:      crop to the bounding box of the ink
+ENCODING_PROFILES = {
+    "png": {"format": "png", "grayscale": False, "quality": None, "crop": False},
+    "gray": {"format": "png", "grayscale": True, "quality": None, "crop": False},
+    "jpeg": {"format": "jpeg", "grayscale": True, "quality": 80, "crop": False},
+    "jpeg-crop": {"format": "jpeg", "grayscale": True, "quality": 80, "crop": True},
+    "webp": {"format": "webp", "grayscale": True, "quality": 75, "crop": True},
+}
+DEFAULT_ENCODING_PROFILE = "png"
+
+MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+def get_encoding_profile(name: str, quality: int = None) -> dict:
+    """Returns a copy of a named profile, optionally overriding its lossy quality."""
+    if name not in ENCODING_PROFILES:
+        raise ValueError(f"Unknown encoding profile '{name}'. Choose from: {', '.join(ENCODING_PROFILES)}")
+    profile = dict(ENCODING_PROFILES[name], name=name)
+    if quality is not None:
+        profile["quality"] = int(quality)
+    return profile
+
+
+def pixmap_array(pix: "fitz.Pixmap") -> np.ndarray:
+    """View of the pixmap samples as a (height, width, channels) uint8 array, without alpha."""
+    samples = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    if pix.alpha:
+        samples = samples[..., :pix.n - 1]
+    return samples
+
+
+def ink_mask(pix: "fitz.Pixmap", ink_threshold: int = INK_THRESHOLD) -> np.ndarray:
+    """Boolean (height, width) mask of pixels that are dark in any channel."""
+    return pixmap_array(pix).min(axis=2) < ink_threshold
+
+
+def ink_bbox(pix: "fitz.Pixmap", ink_threshold: int = INK_THRESHOLD, margin: int = CROP_MARGIN_PX):
+    """
+    Bounding box (x0, y0, x1, y1) of the ink on the page, padded by `margin` pixels.
+    Returns None for a page without ink.
+    """
+    mask = ink_mask(pix, ink_threshold)
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0 or cols.size == 0:
+        return None
+    x0 = max(int(cols[0]) - margin, 0)
+    y0 = max(int(rows[0]) - margin, 0)
+    x1 = min(int(cols[-1]) + margin + 1, pix.width)
+    y1 = min(int(rows[-1]) + margin + 1, pix.height)
+    return x0, y0, x1, y1
+
+
+def crop_pixmap(pix: "fitz.Pixmap", bbox) -> "fitz.Pixmap":
+    x0, y0, x1, y1 = bbox
+    if (x0, y0, x1, y1) == (0, 0, pix.width, pix.height):
+        return pix
+    samples = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    cropped = np.ascontiguousarray(samples[y0:y1, x0:x1])
+    return fitz.Pixmap(pix.colorspace, x1 - x0, y1 - y0, cropped.tobytes(), bool(pix.alpha))
+
+
+def encode_pixmap(pix: "fitz.Pixmap", fmt: str, quality: int = None):
+    """Encodes a pixmap; returns (image_bytes, mime_type)."""
+    if fmt == "webp":
+        if Image is None:
+            logger.warning("Pillow is not installed; falling back from WebP to JPEG")
+            fmt = "jpeg"
+        else:
+            mode = "L" if pix.n - pix.alpha == 1 else "RGB"
+            image = Image.frombytes(mode, (pix.width, pix.height), pixmap_array(pix).tobytes())
+            buffer = io.BytesIO()
+            image.save(buffer, format="WEBP", quality=quality or 75)
+            return buffer.getvalue(), MIME_TYPES["webp"]
+    if fmt == "jpeg":
+        return pix.tobytes("jpeg", jpg_quality=quality or 80), MIME_TYPES["jpeg"]
+    return pix.tobytes("png"), MIME_TYPES["png"]
+
+
+def ink_density(pix: "fitz.Pixmap", ink_threshold: int = INK_THRESHOLD) -> float:
+    """Fraction of pixels that are ink; near zero for a blank page."""
+    mask = ink_mask(pix, ink_threshold)
+    return float(mask.mean()) if mask.size else 0.0
+
+
+def block_means(gray: np.ndarray, rows: int, cols: int) -> np.ndarray:
+    """Downscales a 2-D array to rows x cols by averaging (area resampling)."""
+    h, w = gray.shape
+    row_edges = np.linspace(0, h, rows + 1).astype(int)
+    col_edges = np.linspace(0, w, cols + 1).astype(int)
+    summed = np.add.reduceat(np.add.reduceat(gray.astype(np.float64), row_edges[:-1], axis=0),
+                             col_edges[:-1], axis=1)
+    counts = np.outer(np.diff(row_edges), np.diff(col_edges))
+    return summed / np.maximum(counts, 1)
+
+
+def page_fingerprint(pix: "fitz.Pixmap", hash_size: int = 16) -> dict:
+    """
+    Cheap signature of a (downscaled) page for triage:
+      ink:  ink pixel density
+      hash: difference hash with hash_size^2 bits (perceptual, tolerant to noise and small shifts)
+      grid: 32x32 mean-intensity grid used to confirm near-duplicates
+    """
+    gray = pixmap_array(pix).mean(axis=2)
+    small = block_means(gray, hash_size, hash_size + 1)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    dhash = 0
+    for bit in bits:
+        dhash = (dhash << 1) | int(bit)
+    return {
+        "ink": ink_density(pix),
+        "hash": dhash,
+        "grid": block_means(gray, 32, 32),
+    }
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def dilate(mask: np.ndarray, px: int) -> np.ndarray:
+    """Grows the True pixels of a boolean mask by px pixels in every direction."""
+    grown = mask.copy()
+    for _ in range(px):
+        step = grown.copy()
+        step[1:, :] |= grown[:-1, :]
+        step[:-1, :] |= grown[1:, :]
+        step[:, 1:] |= grown[:, :-1]
+        step[:, :-1] |= grown[:, 1:]
+        grown = step
+    return grown
+
+
+def ink_difference(pix_a: "fitz.Pixmap", pix_b: "fitz.Pixmap", tolerance_px: int = 1, tiles: int = 8) -> float:
+    """
+    How much the ink of two renders (same size and dpi) differs, as the largest fraction
+    of a tile (of a tiles x tiles grid) covered by ink found in only one of them. Ink within
+    tolerance_px of ink in the other render matches. Taking the worst tile keeps a few
+    words on an otherwise identical ruled page from being averaged away. Renders of
+    different sizes differ completely (1.0).
+    """
+    if (pix_a.width, pix_a.height) != (pix_b.width, pix_b.height):
+        return 1.0
+    a, b = ink_mask(pix_a), ink_mask(pix_b)
+    mismatch = (a & ~dilate(b, tolerance_px)) | (b & ~dilate(a, tolerance_px))
+    return float(block_means(mismatch, tiles, tiles).max()) if mismatch.size else 0.0
+
+
+def image_coverage(page: "fitz.Page") -> float:
+    """Fraction of the page area covered by embedded images (1.0 for a scanned page)."""
+    page_area = abs(page.rect)
+    if not page_area:
+        return 0.0
+    covered = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+    return min(covered / page_area, 1.0)
+
+
+def render_page(page: "fitz.Page", dpi: int, grayscale: bool = False) -> "fitz.Pixmap":
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    return page.get_pixmap(dpi=dpi, colorspace=colorspace, alpha=False)
+
+
+def encode_rendered(pix: "fitz.Pixmap", profile: dict) -> dict:
+    """
+    Crops (if the profile asks for it) and encodes an already rendered page.
+    Returns the encoded bytes and MIME type plus the size before encoding (raw
+    pixmap samples) and after, so callers can log what each profile saves.
+    """
+    raw_bytes = len(pix.samples_mv)
+    if profile["crop"]:
+        bbox = ink_bbox(pix)
+        if bbox is not None:
+            pix = crop_pixmap(pix, bbox)
+    image_bytes, mime_type = encode_pixmap(pix, profile["format"], profile["quality"])
+    return {
+        "bytes": image_bytes,
+        "mime": mime_type,
+        "width": pix.width,
+        "height": pix.height,
+        "rawBytes": raw_bytes,
+        "encodedBytes": len(image_bytes),
+    }
+
+
+def encode_page(page: "fitz.Page", dpi: int, profile: dict) -> dict:
+    """Renders and encodes one page according to an encoding profile."""
+    return encode_rendered(render_page(page, dpi, grayscale=profile["grayscale"]), profile)
@@ -0,0 +1,123 @@
+"""
+Splits a student's OCR'd pages into per-question answer spans.
+
+A page can hold the end of one answer and the start of the next, and an answer
+can run over several pages. Boundaries are detected at the start of a line:
+  strong: "Q3", "Q.3", "Que 3", "Question 3", and "Ans" / "Answer" followed by a question
+          number shape ("Ans Q3", "Ans 3)", "Answer 3.") - a boundary whenever the number
+          is one of the scheme's questions (or the scheme is unknown); "Ans: 7 layers"
+          is answer text, not question 7
+  weak:   "3." / "3)" - only in scripts without any valid strong marker, and only when the
+          number moves forward past the open question and (if the scheme's question
+          numbers are known) is one of them, so numbered points inside an answer
+          ("1. ...", "2. ...") rarely split it.
+Text before the first boundary of the script is kept as question -1 (cover/preamble).
+"""
+
+import re
+from typing import Any, Dict, Iterable, List, Optional
+
+SEGMENTER_VERSION = 2
+
+STRONG_BOUNDARY = re.compile(
+    r"^\s*(?:(?:Q|Que|Ques|Question)\s*(?:No\.?)?\s*[.:#\-]?\s*(\d{1,3})(?!\d)"
+    r"|(?:Ans|Answer)\s*(?:No\.?)?\s*[.:#\-]?\s*(?:Q\s*[.:]?\s*(\d{1,3})(?!\d)|(\d{1,3})\s*[.):](?!\d)))",
+    re.IGNORECASE
+)
+WEAK_BOUNDARY = re.compile(r"^\s*\(?(\d{1,3})\s*[.)](?!\d)")
+CONFIDENCE_LINE = re.compile(r"^\s*CONFIDENCE_SCORE:.*$", re.MULTILINE)
+
+
+def strong_boundary(line: str, valid_questions: Optional[set]) -> Optional[int]:
+    """Question number of a strong marker at the start of this line, or None."""
+    match = STRONG_BOUNDARY.match(line)
+    if not match:
+        return None
+    number = int(next(group for group in match.groups() if group))
+    return number if valid_questions is None or number in valid_questions else None
+
+
+def find_boundary(line: str, open_question: int, valid_questions: Optional[set],
+                  use_weak: bool = True) -> Optional[int]:
+    """Question number starting at this line, or None."""
+    number = strong_boundary(line, valid_questions)
+    if number is not None:
+        return number
+    match = WEAK_BOUNDARY.match(line) if use_weak else None
+    if match:
+        number = int(match.group(1))
+        if number > open_question and (valid_questions is None or number in valid_questions):
+            return number
+    return None
+
+
+def segment_pages(pages: Iterable[Dict[str, Any]], valid_questions: Optional[Iterable[int]] = None) -> List[Dict[str, Any]]:
+    """
+    pages: OCR page documents (pageNumber, rawText, confidence, triage), any order.
+    Returns one entry per question, in order of first appearance:
+      {questionNumber, answerText, pageNumbers, confidence, segments: [{pageNumber, startLine, endLine}]}
+    An answer the student returns to later in the script is appended to its first span.
+    """
+    valid = set(valid_questions) if valid_questions else None
+    spans: Dict[int, Dict[str, Any]] = {}
+    order: List[int] = []
+    page_confidences: Dict[int, Dict[int, float]] = {}
+
+    page_lines = []
+    for page in sorted(pages, key=lambda p: p.get("pageNumber", 0)):
+        if not page.get("triage"):
+            page_lines.append((page, CONFIDENCE_LINE.sub("", page.get("rawText", "") or "").splitlines()))
+    use_weak = not any(strong_boundary(line, valid) is not None for _, lines in page_lines for line in lines)
+
+    open_question = -1
+    for page, lines in page_lines:
+        page_number = page.get("pageNumber", 0)
+        confidence = float(page.get("confidence", 0) or 0)
+
+        start = 0
+        for n in range(len(lines) + 1):
+            boundary = find_boundary(lines[n], open_question, valid, use_weak) if n < len(lines) else None
+            if boundary is None and n < len(lines):
+                continue
+            # Close the run [start, n) for the currently open question
+            text = "\n".join(lines[start:n]).strip()
+            if text:
+                if open_question not in spans:
+                    spans[open_question] = {"questionNumber": open_question, "parts": [],
+                                            "pageNumbers": [], "segments": []}
+                    order.append(open_question)
+                span = spans[open_question]
+                span["parts"].append(text)
+                if page_number not in span["pageNumbers"]:
+                    span["pageNumbers"].append(page_number)
+                span["segments"].append({"pageNumber": page_number, "startLine": start, "endLine": n})
+                page_confidences.setdefault(open_question, {})[page_number] = confidence
+            if boundary is not None:
+                open_question = boundary
+                start = n
+
+    results = []
+    for question_number in order:
+        span = spans[question_number]
+        confidences = list(page_confidences[question_number].values())
+        results.append({
+            "questionNumber": question_number,
+            "answerText": "\n".join(span["parts"]),
+            "pageNumbers": span["pageNumbers"],
+            "confidence": round(sum(confidences) / len(confidences), 3) if confidences else 0.0,
+            "segments": span["segments"],
+        })
+    return results
+
+
+def scheme_question_numbers(structured: Any) -> Optional[set]:
+    """Question numbers of a parsed marking scheme ({"questions": [...]}), or None if unavailable."""
+    if not isinstance(structured, dict):
+        return None
+    numbers = set()
+    for q in structured.get("questions", []) or []:
+        try:
+            numbers.add(int(q.get("questionNumber")))
+        except (TypeError, ValueError, AttributeError):
+            continue
+    return numbers or None
@@ -6,17 +6,48 @@ from datetime import datetime
 from openai import OpenAI
 import base64
 from dotenv import load_dotenv
-import re
+import hashlib
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from page_images import ENCODING_PROFILES, DEFAULT_ENCODING_PROFILE, get_encoding_profile, encode_page
+from api_scheduler import scheduler, estimate_tokens
+from question_segmenter import STRONG_BOUNDARY, find_boundary
+from scheme_validation import (SCHEME_FORMAT_VERSION, parse_structured_text,
+                               validate_scheme, as_structured)
+from embeddings import EMBED_MODEL, refresh_reference_embeddings
+from embeddings import cache as embedding_cache
 
 load_dotenv()
 
-client = OpenAI()
+# Retries, backoff and rate limits are handled by api_scheduler
+client = OpenAI(max_retries=0)
 
 # MongoDB setup (schema_db)
 mongo_uri = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
-schema_db = MongoClient(mongo_uri)["schema_db"]
+mongo_client = MongoClient(mongo_uri)
+schema_db = mongo_client["schema_db"]
 schema_collection = schema_db["schema_extracted_answers"]
+# Shared with comparator.py, which embeds the same reference texts when a scheme changes
+embedding_cache.attach(mongo_client["ai_evaluation_system"]["embedding_cache"])
+
+try:
+    # Cache lookups for re-uploaded scheme PDFs
+    schema_collection.create_index([("sourceHash", 1), ("promptVersion", 1)], name="source_prompt")
+except Exception as e:
+    print(f"[WARN] Could not create scheme cache index: {e}")
+
+SCHEME_MODEL = os.getenv("SCHEME_MODEL", "gpt-4o-mini")
+
+# Encoding profile for scanned scheme pages sent to the vision model (see page_images.py)
+SCHEME_ENCODING_PROFILE = os.getenv("SCHEME_ENCODING_PROFILE", DEFAULT_ENCODING_PROFILE)
+
+# Schemes longer than this (characters of raw text) are split at question boundaries
+# and the chunks structured concurrently; 0 always uses a single call
+SCHEME_CHUNK_CHARS = int(os.getenv("SCHEME_CHUNK_CHARS", "12000"))
+# Concurrent structuring calls (chunked mode) and vision calls for scanned pages
+SCHEME_WORKERS = int(os.getenv("SCHEME_WORKERS", "4"))
+# Also store one embedding per concept next to the per-question reference embeddings
+SCHEME_EMBED_CONCEPTS = os.getenv("SCHEME_EMBED_CONCEPTS", "0") == "1"
 
 # Prompt to structure scheme PDF text
 SCHEME_EXTRACTION_PROMPT = """
@@ -80,37 +111,209 @@ Follow these rules carefully:
 }
 """
 
-def extract_scheme_text(pdf_path):
+SCHEME_OCR_SYSTEM_MESSAGE = "Extract text from this exam scheme PDF page."
+SCHEME_OCR_PROMPT = "Extract all text visible on this page without formatting changes."
+SCHEME_STRUCTURE_SYSTEM_MESSAGE = "Convert extracted scheme text into structured JSON."
+
+def scheme_prompt_version(model=SCHEME_MODEL):
+    # Any change to the model or prompts yields a new version, so cached schemes are not reused
+    return hashlib.sha256(
+        f"{model}\n{SCHEME_OCR_SYSTEM_MESSAGE}\n{SCHEME_OCR_PROMPT}\n"
+        f"{SCHEME_STRUCTURE_SYSTEM_MESSAGE}\n{SCHEME_EXTRACTION_PROMPT}".encode("utf-8")
+    ).hexdigest()[:16]
+
+SCHEME_PROMPT_VERSION = scheme_prompt_version()
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def find_cached_scheme(source_hash, prompt_version=SCHEME_PROMPT_VERSION):
+    """Latest scheme structured from the same PDF bytes with the same prompts/model, or None."""
+    return schema_collection.find_one(
+        {"sourceHash": source_hash, "promptVersion": prompt_version, "structuredData": {"$exists": True}},
+        {"rawExtractedText": 1, "structuredData": 1, "structuredDataRaw": 1, "referenceEmbeddings": 1,
+         "examId": 1, "professorId": 1, "subjectId": 1,
+         "pdfMetadata.totalPages": 1, "pdfMetadata.structuringChunks": 1},
+        sort=[("_id", -1)]
+    )
+
+def latest_scheme_id(exam_id):
+    """_id of the scheme record find_scheme would use for exam_id, or None."""
+    latest = schema_collection.find_one({"examId": exam_id}, {"_id": 1}, sort=[("_id", -1)])
+    return latest["_id"] if latest else None
+
+def ocr_scheme_page(image_b64, mime_type):
+    response = scheduler.call(
+        "openai", SCHEME_MODEL, client.chat.completions.create,
+        tokens=estimate_tokens(images=1),
+        model=SCHEME_MODEL,
+        messages=[
+            {"role": "system", "content": SCHEME_OCR_SYSTEM_MESSAGE},
+            {"role": "user",
+             "content": [
+                 {"type": "text", "text": SCHEME_OCR_PROMPT},
+                 {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{image_b64}"}}
+             ]}
+        ]
+    )
+    return response.choices[0].message.content
+
+def extract_scheme_text(pdf_path, encoding=SCHEME_ENCODING_PROFILE, quality=None, workers=SCHEME_WORKERS):
     doc = fitz.open(pdf_path)
-    raw_text = ""
+    profile = get_encoding_profile(encoding, quality)
+    texts = []
 
-    for page in doc:
-        text = page.get_text("text").strip()
-        if not text:
+    # Pages are rendered here (PyMuPDF is not thread-safe) while earlier scanned
+    # pages are already being OCR'd on the pool
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="scheme-ocr") as pool:
+        for page in doc:
+            text = page.get_text("text").strip()
+            if text:
+                texts.append(text)
+                continue
             # If text not directly extractable, fallback to OCR
-            pix = page.get_pixmap(dpi=200)
-            image_bytes = pix.tobytes()
-            image_b64 = base64.b64encode(image_bytes).decode('utf-8')
-
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Extract text from this exam scheme PDF page."},
-                    {"role": "user",
-                     "content": [
-                         {"type": "text", "text": "Extract all text visible on this page without formatting changes."},
-                         {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_b64}"}}
-                     ]}
-                ]
-            )
-
-            text = response.choices[0].message.content
-
-        raw_text += text + "\n\n"
+            encoded = encode_page(page, 200, profile)
+            image_b64 = base64.b64encode(encoded["bytes"]).decode('utf-8')
+            print(f"[OCR] Page {page.number + 1}: {encoded['rawBytes'] / 1024:.0f} KB raw -> "
+                  f"{encoded['encodedBytes'] / 1024:.0f} KB {encoded['mime']} ({profile['name']} profile)")
+            texts.append(pool.submit(ocr_scheme_page, image_b64, encoded["mime"]))
 
+        raw_text = ""
+        for text in texts:
+            if not isinstance(text, str):
+                text = text.result()
+            raw_text += text + "\n\n"
+
+    doc.close()
     return raw_text
 
-def parse_and_store_scheme(pdf_path, examId=None, professorId=None, subjectId=None):
+def split_scheme_text(raw_text, max_chars=SCHEME_CHUNK_CHARS):
+    """
+    Splits scheme text into chunks of whole questions, each at most max_chars unless a
+    single question is longer. Boundaries follow question_segmenter: "Q3"/"Question 3"
+    style markers, or "3." / "3)" when the scheme has no such markers. Text before the
+    first question stays with the first chunk. Returns [raw_text] when no boundary is found.
+    """
+    lines = raw_text.splitlines(keepends=True)
+    use_weak = not any(STRONG_BOUNDARY.match(line) for line in lines)
+    starts = []
+    open_question = -1
+    for n, line in enumerate(lines):
+        number = find_boundary(line, open_question, None, use_weak)
+        if number is not None:
+            starts.append(n)
+            open_question = number
+    if not starts:
+        return [raw_text]
+
+    # Question blocks; the preamble is folded into the first question
+    bounds = [0] + starts[1:] + [len(lines)]
+    blocks = ["".join(lines[a:b]) for a, b in zip(bounds, bounds[1:])]
+
+    chunks = []
+    for block in blocks:
+        if chunks and len(chunks[-1]) + len(block) <= max_chars:
+            chunks[-1] += block
+        else:
+            chunks.append(block)
+    return chunks
+
+def structure_scheme_text(raw_text, response_format=None):
+    """One structuring call over raw_text; returns the model output as text."""
+    request = {}
+    if response_format:
+        request["response_format"] = response_format
+    structured_response = scheduler.call(
+        "openai", SCHEME_MODEL, client.chat.completions.create,
+        tokens=estimate_tokens(raw_text + SCHEME_EXTRACTION_PROMPT, max_output=4000),
+        model=SCHEME_MODEL,
+        messages=[
+            {"role": "system", "content": SCHEME_STRUCTURE_SYSTEM_MESSAGE},
+            {"role": "user", "content": raw_text},
+            {"role": "user", "content": SCHEME_EXTRACTION_PROMPT}
+        ],
+        **request
+    )
+    return structured_response.choices[0].message.content
+
+def merge_structured_chunks(parts):
+    """
+    Merges per-chunk results into one {"questions": [...], "metadata": {...}}.
+    Questions are ordered by question number (a question seen in two chunks keeps the
+    version with more concepts); totalMarks and numberOfQuestions are recomputed.
+    """
+    by_number = {}
+    unnumbered = []
+    for part in parts:
+        for q in part.get("questions", []):
+            try:
+                number = int(q.get("questionNumber"))
+            except (TypeError, ValueError):
+                unnumbered.append(q)
+                continue
+            kept = by_number.get(number)
+            if kept is None or len(q.get("concepts") or []) > len(kept.get("concepts") or []):
+                by_number[number] = q
+    questions = [by_number[n] for n in sorted(by_number)] + unnumbered
+
+    metadata = {}
+    for part in parts:
+        for key, value in (part.get("metadata") or {}).items():
+            metadata.setdefault(key, value)
+    total_marks = 0
+    for q in questions:
+        try:
+            total_marks += float(q.get("maxMarks") or 0)
+        except (TypeError, ValueError):
+            continue
+    metadata["totalMarks"] = int(total_marks) if float(total_marks).is_integer() else total_marks
+    metadata["numberOfQuestions"] = len(questions)
+    return {"questions": questions, "metadata": metadata}
+
+def structure_scheme(raw_text, chunk_chars=SCHEME_CHUNK_CHARS, workers=SCHEME_WORKERS):
+    """
+    Returns (parsed scheme, raw model outputs). Short schemes (or chunk_chars=0) use a
+    single call as before; long ones are split at question boundaries, the chunks
+    structured concurrently and merged. Raises ValueError on output that is not JSON.
+    """
+    chunks = split_scheme_text(raw_text, chunk_chars) if chunk_chars and len(raw_text) > chunk_chars else [raw_text]
+    if len(chunks) == 1:
+        output = structure_scheme_text(raw_text)
+        try:
+            return parse_structured_text(output), [output]
+        except ValueError as e:
+            raise ValueError(f"Model did not return a valid scheme: {e}")
+
+    print(f"[CHUNKED] {len(chunks)} chunks of up to {chunk_chars} characters, {workers} worker(s)")
+
+    def structure_chunk(n, chunk):
+        output = structure_scheme_text(chunk, {"type": "json_object"})
+        try:
+            return parse_structured_text(output), output
+        except ValueError as e:
+            raise ValueError(f"Chunk {n} of {len(chunks)} did not return a valid scheme: {e}")
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="scheme-chunk") as pool:
+        results = list(pool.map(structure_chunk, range(1, len(chunks) + 1), chunks))
+    return merge_structured_chunks([part for part, _ in results]), [output for _, output in results]
+
+def parse_and_store_scheme(pdf_path, examId=None, professorId=None, subjectId=None,
+                           encoding=SCHEME_ENCODING_PROFILE, quality=None,
+                           chunk_chars=SCHEME_CHUNK_CHARS, workers=SCHEME_WORKERS, force=False,
+                           embed_concepts=SCHEME_EMBED_CONCEPTS):
+    """
+    Extracts and structures a scheme PDF and stores it for examId. A PDF whose bytes were
+    already structured with the current prompts/model is not sent to the API again: the
+    stored result is linked to this exam instead (force=True always re-extracts).
+    The scheme is validated before anything is stored (SchemeValidationError) and kept
+    as native sub-documents; the model output is kept in structuredDataRaw.
+    Reference-answer embeddings (per concept too with embed_concepts) are computed here
+    once, so the comparator only embeds student text.
+    """
     # Set default string IDs if not provided
     if not examId:
         import uuid
@@ -127,22 +330,54 @@ def parse_and_store_scheme(pdf_path, examId=None, professorId=None, subjectId=No
     professorId = str(professorId).strip()
     subjectId = str(subjectId).strip()
 
-    print("\n--- Extracting raw text from scheme PDF ---")
+    source_hash = file_sha256(pdf_path)
+    cached = None if force else find_cached_scheme(source_hash)
 
-    raw_text = extract_scheme_text(pdf_path)
+    if cached:
+        # Only a no-op while it is still the exam's latest scheme: after A, B, A the
+        # second A must become the newest record again, or grading stays on B
+        if ((cached.get("examId"), cached.get("professorId"), cached.get("subjectId")) == (examId, professorId, subjectId)
+                and latest_scheme_id(examId) == cached["_id"]):
+            print(f"[CACHE] Scheme already stored for this exam (ID: {cached['_id']}); nothing to do")
+            return as_structured(cached["structuredData"])
+        print(f"\n--- Reusing scheme structured from identical PDF (ID: {cached['_id']}) ---")
+        raw_text = cached.get("rawExtractedText", "")
+        structured = as_structured(cached["structuredData"])
+        # Records from before native storage hold the model output itself in structuredData
+        raw_outputs = cached.get("structuredDataRaw") or [cached["structuredData"]]
+        chunk_count = cached.get("pdfMetadata", {}).get("structuringChunks", 1)
+        total_pages = cached.get("pdfMetadata", {}).get("totalPages")
+        extraction_method = "cache"
+    else:
+        print("\n--- Extracting raw text from scheme PDF ---")
 
-    print("\n--- Calling GPT to structure schema ---")
+        raw_text = extract_scheme_text(pdf_path, encoding, quality, workers)
 
-    structured_response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "Convert extracted scheme text into structured JSON."},
-            {"role": "user", "content": raw_text},
-            {"role": "user", "content": SCHEME_EXTRACTION_PROMPT}
-        ]
-    )
+        print("\n--- Calling GPT to structure schema ---")
 
-    structured_json = structured_response.choices[0].message.content
+        structured, raw_outputs = structure_scheme(raw_text, chunk_chars, workers)
+        chunk_count = len(raw_outputs)
+        total_pages = None
+        extraction_method = "text_extraction"
+
+    structured, warnings = validate_scheme(structured)
+    for warning in warnings:
+        print(f"[WARN] {warning}")
+
+    reference_embeddings = None
+    try:
+        reference_embeddings, computed = refresh_reference_embeddings(
+            structured["questions"], cached.get("referenceEmbeddings") if cached else None, embed_concepts
+        )
+        print(f"[EMBED] {computed} reference embedding(s) computed with {EMBED_MODEL}")
+        print(f"[CACHE] Embedding cache: {embedding_cache.snapshot()}")
+    except Exception as e:
+        # The comparator computes (and stores) them on first use instead
+        print(f"[WARN] Reference embeddings not precomputed: {e}")
+
+    if total_pages is None:
+        with fitz.open(pdf_path) as doc:
+            total_pages = doc.page_count
 
     # Insert into schema_db
     record = {
@@ -153,31 +388,94 @@ def parse_and_store_scheme(pdf_path, examId=None, professorId=None, subjectId=No
             "fileName": os.path.basename(pdf_path),
             "filePath": os.path.abspath(pdf_path),
             "fileSize": os.path.getsize(pdf_path),
-            "totalPages": fitz.open(pdf_path).page_count,
+            "totalPages": total_pages,
             "uploadedAt": datetime.utcnow(),
-            "extractionMethod": "text_extraction"
+            "extractionMethod": extraction_method,
+            "structuringChunks": chunk_count
         },
+        "sourceHash": source_hash,
+        "promptVersion": SCHEME_PROMPT_VERSION,
+        "cachedFrom": cached["_id"] if cached else None,
         "rawExtractedText": raw_text,
-        "structuredData": structured_json,
+        "schemeFormat": SCHEME_FORMAT_VERSION,
+        "structuredData": structured,
+        "structuredDataRaw": raw_outputs,
+        "validationWarnings": warnings,
+        "referenceEmbeddings": reference_embeddings,
         "createdAt": datetime.utcnow(),
         "updatedAt": datetime.utcnow()
     }
 
     result = schema_collection.insert_one(record)
-    print(f"[SUCCESS] Schema stored with ID: {result.inserted_id}")
+    print(f"[SUCCESS] Schema stored with ID: {result.inserted_id} "
+          f"({structured['metadata']['numberOfQuestions']} questions, {structured['metadata']['totalMarks']} marks)")
 
-    return structured_json
+    return structured
+
+def migrate_legacy_schemes():
+    """
+    Converts records whose structuredData is still the model's JSON string to native,
+    validated sub-documents. Records that fail validation are left as they are and reported.
+    Returns (migrated, failed).
+    """
+    migrated, failed = 0, 0
+    for doc in schema_collection.find({"structuredData": {"$type": "string"}}, {"structuredData": 1, "examId": 1}):
+        try:
+            structured, warnings = validate_scheme(parse_structured_text(doc["structuredData"]))
+        except ValueError as e:
+            print(f"[ERROR] Scheme {doc['_id']} (exam {doc.get('examId')}): {e}")
+            failed += 1
+            continue
+        schema_collection.update_one({"_id": doc["_id"]}, {"$set": {
+            "schemeFormat": SCHEME_FORMAT_VERSION,
+            "structuredData": structured,
+            "structuredDataRaw": [doc["structuredData"]],
+            "validationWarnings": warnings,
+            "updatedAt": datetime.utcnow(),
+        }})
+        migrated += 1
+    print(f"[SUCCESS] Migrated {migrated} scheme(s); {failed} could not be validated")
+    return migrated, failed
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Extract and structure evaluation scheme from PDF.")
-    parser.add_argument("pdf_path", help="Path to the scheme PDF file")
+    parser.add_argument("pdf_path", nargs="?", help="Path to the scheme PDF file")
     parser.add_argument("--exam-id", help="Exam ID (any string format, auto-generated if not provided)")
     parser.add_argument("--professor-id", help="Professor ID (any string format, auto-generated if not provided)")
     parser.add_argument("--subject-id", help="Subject ID (any string format, auto-generated if not provided)")
+    parser.add_argument("--encoding", choices=sorted(ENCODING_PROFILES), default=SCHEME_ENCODING_PROFILE,
+                        help="Image encoding profile for scanned pages that need OCR")
+    parser.add_argument("--quality", type=int, default=None,
+                        help="Override the JPEG/WebP quality of the encoding profile")
+    parser.add_argument("--chunk-chars", type=int, default=SCHEME_CHUNK_CHARS,
+                        help="Split schemes longer than this many characters at question boundaries "
+                             "and structure the chunks concurrently (0 = single call)")
+    parser.add_argument("--workers", type=int, default=SCHEME_WORKERS,
+                        help="Concurrent structuring calls and scanned-page OCR calls")
+    parser.add_argument("--force", action="store_true",
+                        help="Re-extract even if this PDF was already structured with the current prompts/model")
+    parser.add_argument("--embed-concepts", action="store_true", default=SCHEME_EMBED_CONCEPTS,
+                        help="Also precompute one embedding per concept (reported as conceptSimilarities)")
+    parser.add_argument("--migrate", action="store_true",
+                        help="Convert stored schemes from JSON strings to validated native documents and exit")
 
     args = parser.parse_args()
 
+    if args.migrate:
+        migrated, failed = migrate_legacy_schemes()
+        sys.exit(1 if failed else 0)
+    if not args.pdf_path:
+        parser.error("pdf_path is required unless --migrate is given")
+
     # Convert to absolute path to handle paths from anywhere on the PC
     pdf_path = os.path.abspath(args.pdf_path)
-    parse_and_store_scheme(pdf_path, args.exam_id, args.professor_id, args.subject_id)
+    try:
+        parse_and_store_scheme(pdf_path, args.exam_id, args.professor_id, args.subject_id,
+                               encoding=args.encoding, quality=args.quality,
+                               chunk_chars=args.chunk_chars, workers=args.workers, force=args.force,
+                               embed_concepts=args.embed_concepts)
+    except ValueError as e:
+        # Malformed or inconsistent model output: nothing is stored
+        print(f"[ERROR] {e}", file=sys.stderr)
+        sys.exit(1)
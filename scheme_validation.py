@@ -0,0 +1,201 @@
+"""
+Validation and loading of structured marking schemes.
+
+scheme_extractor validates the model output once at ingest and stores it in
+schema_extracted_answers.structuredData as native sub-documents:
+
+    {"questions": [{questionNumber, questionText, maxMarks, concepts: [...],
+                    evaluationCriteria: {...}, referenceAnswer, onlyAnswer, hints, difficulty}],
+     "metadata": {totalMarks, numberOfQuestions, ...}}
+
+Records written before that hold the model output as a JSON string; find_scheme
+accepts both, so readers can project per-question fields on native records.
+"""
+
+import json
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+SCHEME_FORMAT_VERSION = 2
+
+TEXT_FIELDS = ("questionText", "referenceAnswer", "onlyAnswer", "difficulty")
+CRITERIA_TEXT_FIELDS = ("fullMarksRequirements", "partialMarksConditions")
+CRITERIA_LIST_FIELDS = ("commonMistakes", "mustIncludePoints")
+# Concept marks may differ from maxMarks by rounding in the model output
+MARKS_TOLERANCE = 0.01
+
+
+class SchemeValidationError(ValueError):
+    """The structured scheme cannot be used for evaluation; errors lists every problem found."""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("Invalid marking scheme: " + "; ".join(errors))
+        self.errors = errors
+
+
+def parse_structured_text(text: str) -> Dict[str, Any]:
+    """Parses model output that should be a JSON object, tolerating ```json fences."""
+    cleaned = (text or "").strip()
+    if cleaned.startswith("```"):
+        cleaned = re.sub(r"^```(?:json)?\s*|\s*```$", "", cleaned)
+    data = json.loads(cleaned)
+    if not isinstance(data, dict):
+        raise ValueError("structured scheme is not a JSON object")
+    return data
+
+
+def _number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*(?:marks?|m)?\s*", value, re.IGNORECASE)
+        if match:
+            number = float(match.group(1))
+            return int(number) if number.is_integer() else number
+    return None
+
+
+def _text(value: Any) -> str:
+    if value is None:
+        return ""
+    return value if isinstance(value, str) else str(value)
+
+
+def _text_list(value: Any) -> List[str]:
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value] if value.strip() else []
+    if isinstance(value, list):
+        return [_text(v) for v in value if v is not None and _text(v).strip()]
+    return [_text(value)]
+
+
+def _bool(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "yes", "1")
+    return bool(value)
+
+
+def validate_scheme(data: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Normalizes types and checks a structured scheme. Returns (scheme, warnings).
+    Raises SchemeValidationError when questions are missing, question numbers are not
+    unique integers or marks are not non-negative numbers. totalMarks and numberOfQuestions
+    are recomputed; a different declared total is kept as metadata.declaredTotalMarks.
+    """
+    errors: List[str] = []
+    warnings: List[str] = []
+
+    raw_questions = data.get("questions") if isinstance(data, dict) else None
+    if not isinstance(raw_questions, list) or not raw_questions:
+        raise SchemeValidationError(["scheme has no questions"])
+
+    questions = []
+    seen = set()
+    for n, q in enumerate(raw_questions, start=1):
+        if not isinstance(q, dict):
+            errors.append(f"question #{n} is not an object")
+            continue
+        number = _number(q.get("questionNumber"))
+        if number is None or number != int(number):
+            errors.append(f"question #{n} has no integer questionNumber ({q.get('questionNumber')!r})")
+            continue
+        number = int(number)
+        if number in seen:
+            errors.append(f"question number {number} appears more than once")
+            continue
+        seen.add(number)
+
+        max_marks = _number(q.get("maxMarks"))
+        if max_marks is None or max_marks < 0:
+            errors.append(f"Q{number} has invalid maxMarks ({q.get('maxMarks')!r})")
+            continue
+
+        concepts = []
+        for k, c in enumerate(q.get("concepts") or [], start=1):
+            if not isinstance(c, dict):
+                warnings.append(f"Q{number} concept #{k} is not an object; dropped")
+                continue
+            marks = _number(c.get("marks"))
+            if marks is None or marks < 0:
+                warnings.append(f"Q{number} concept #{k} has invalid marks ({c.get('marks')!r}); set to 0")
+                marks = 0
+            concepts.append({
+                "conceptId": _text(c.get("conceptId")) or f"Q{number}_C{k}",
+                "description": _text(c.get("description")),
+                "keywords": _text_list(c.get("keywords")),
+                "marks": marks,
+                "isMandatory": _bool(c.get("isMandatory")),
+                "acceptableVariations": _text_list(c.get("acceptableVariations")),
+            })
+        concept_marks = sum(c["marks"] for c in concepts)
+        if concepts and abs(concept_marks - max_marks) > MARKS_TOLERANCE:
+            warnings.append(f"Q{number} concept marks add up to {concept_marks}, maxMarks is {max_marks}")
+
+        criteria = q.get("evaluationCriteria") if isinstance(q.get("evaluationCriteria"), dict) else {}
+        question = {"questionNumber": number, "maxMarks": max_marks}
+        for field in TEXT_FIELDS:
+            question[field] = _text(q.get(field))
+        question["concepts"] = concepts
+        question["evaluationCriteria"] = {
+            **{field: _text(criteria.get(field)) for field in CRITERIA_TEXT_FIELDS},
+            **{field: _text_list(criteria.get(field)) for field in CRITERIA_LIST_FIELDS},
+        }
+        question["hints"] = _text_list(q.get("hints"))
+        questions.append(question)
+
+    if errors:
+        raise SchemeValidationError(errors)
+
+    metadata = dict(data.get("metadata") or {}) if isinstance(data.get("metadata"), dict) else {}
+    total_marks = sum(q["maxMarks"] for q in questions)
+    if isinstance(total_marks, float) and total_marks.is_integer():
+        total_marks = int(total_marks)
+    declared = _number(metadata.get("totalMarks"))
+    if declared is not None and abs(declared - total_marks) > MARKS_TOLERANCE:
+        warnings.append(f"declared totalMarks {declared} does not match the sum of maxMarks {total_marks}")
+        metadata["declaredTotalMarks"] = declared
+    metadata["totalMarks"] = total_marks
+    metadata["numberOfQuestions"] = len(questions)
+
+    return {"questions": questions, "metadata": metadata}, warnings
+
+
+def as_structured(value: Any) -> Dict[str, Any]:
+    """structuredData of a native or legacy (JSON string) record; {} when unusable."""
+    if isinstance(value, dict):
+        return value
+    if isinstance(value, str):
+        try:
+            return parse_structured_text(value)
+        except ValueError:
+            return {}
+    return {}
+
+
+def find_scheme(collection, exam_id: str, question_fields: Optional[Iterable[str]] = None,
+                fields: Optional[Iterable[str]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Latest scheme record of an exam with structuredData as a dict. question_fields limits
+    the per-question fields fetched (e.g. ["questionNumber", "maxMarks"]); fields adds
+    top-level fields. Legacy string records are fetched whole and parsed.
+    """
+    projection = {field: 1 for field in (fields or [])}
+    if question_fields:
+        projection["structuredData.metadata"] = 1
+        for field in question_fields:
+            projection[f"structuredData.questions.{field}"] = 1
+    else:
+        projection["structuredData"] = 1
+    projection["schemeFormat"] = 1
+
+    doc = collection.find_one({"examId": exam_id}, projection, sort=[("_id", -1)])
+    if doc is None:
+        return None
+    if doc.get("schemeFormat") != SCHEME_FORMAT_VERSION or not isinstance(doc.get("structuredData"), dict):
+        legacy = collection.find_one({"_id": doc["_id"]}, {"structuredData": 1}) or {}
+        doc["structuredData"] = as_structured(legacy.get("structuredData"))
+    return doc
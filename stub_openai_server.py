@@ -0,0 +1,177 @@
+"""
+Local stand-in for the OpenAI API, for exercising api_scheduler without a key or quota.
+
+Serves /v1/chat/completions (canned text; "=== PAGE n ===" blocks for multi-image
+requests) and /v1/embeddings (deterministic vectors), and fails a configurable share
+of requests with 429 (with Retry-After) or 5xx.
+
+    python stub_openai_server.py --port 8089 --error-rate 0.3 --latency-ms 200
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=stub python ocr_pdf.py ...
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+EMBEDDING_DIMENSIONS = 1536
+
+
+def embedding_for(text: str, dimensions: int = EMBEDDING_DIMENSIONS) -> list:
+    """Same text, same unit vector."""
+    values = []
+    counter = 0
+    while len(values) < dimensions:
+        digest = hashlib.sha256(f"{counter}:{text}".encode("utf-8")).digest()
+        values.extend(b / 127.5 - 1.0 for b in struct.unpack("32B", digest))
+        counter += 1
+    values = values[:dimensions]
+    norm = sum(v * v for v in values) ** 0.5 or 1.0
+    return [v / norm for v in values]
+
+
+class StubState:
+    def __init__(self, error_rate: float, server_error_rate: float, retry_after: float,
+                 latency_ms: int, fail_first: int):
+        self.error_rate = error_rate
+        self.server_error_rate = server_error_rate
+        self.retry_after = retry_after
+        self.latency_ms = latency_ms
+        self.fail_first = fail_first
+        self.counts = {"requests": 0, "rate_limited": 0, "server_errors": 0, "ok": 0}
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+
+    def next_outcome(self) -> str:
+        with self.lock:
+            self.counts["requests"] += 1
+            if self.counts["requests"] <= self.fail_first:
+                outcome = "rate_limited"
+            else:
+                roll = self.random.random()
+                if roll < self.error_rate:
+                    outcome = "rate_limited"
+                elif roll < self.error_rate + self.server_error_rate:
+                    outcome = "server_errors"
+                else:
+                    outcome = "ok"
+            self.counts[outcome] += 1
+            return outcome
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    state: StubState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, body: dict, headers: dict = None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            with self.state.lock:
+                self.send_json(200, dict(self.state.counts))
+            return
+        self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_json(400, {"error": {"message": "Invalid JSON body", "type": "invalid_request_error"}})
+            return
+
+        if self.state.latency_ms:
+            time.sleep(self.state.latency_ms / 1000.0)
+
+        outcome = self.state.next_outcome()
+        if outcome == "rate_limited":
+            self.send_json(429, {"error": {"message": "Rate limit reached (stub)", "type": "requests"}},
+                           {"Retry-After": str(self.state.retry_after)})
+            return
+        if outcome == "server_errors":
+            self.send_json(503, {"error": {"message": "Service unavailable (stub)", "type": "server_error"}})
+            return
+
+        if self.path.endswith("/chat/completions"):
+            self.send_json(200, self.chat_response(request))
+        elif self.path.endswith("/embeddings"):
+            self.send_json(200, self.embeddings_response(request))
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def chat_response(self, request: dict) -> dict:
+        images = 0
+        for message in request.get("messages", []):
+            if isinstance(message.get("content"), list):
+                images += sum(1 for part in message["content"] if part.get("type") == "image_url")
+        page = "Q1 stub answer text\nCONFIDENCE_SCORE: 0.9"
+        if images > 1:
+            text = "\n".join(f"=== PAGE {n} ===\n{page}" for n in range(1, images + 1))
+        elif images == 1:
+            text = page
+        else:
+            text = '{"questions": []}'
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": text}}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+    def embeddings_response(self, request: dict) -> dict:
+        inputs = request.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        return {
+            "object": "list",
+            "model": request.get("model", "stub"),
+            "data": [{"object": "embedding", "index": n, "embedding": embedding_for(text)}
+                     for n, text in enumerate(inputs)],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI API stub that injects 429s and 5xx errors.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--error-rate", type=float, default=0.2, help="Share of requests answered with 429")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--latency-ms", type=int, default=0, help="Delay before every response")
+    parser.add_argument("--fail-first", type=int, default=0, help="Answer the first N requests with 429")
+    args = parser.parse_args()
+
+    StubHandler.state = StubState(args.error_rate, args.server_error_rate, args.retry_after,
+                                  args.latency_ms, args.fail_first)
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    logger.info(f"OpenAI stub on http://{args.host}:{args.port}/v1 "
+                f"(429 rate {args.error_rate}, 503 rate {args.server_error_rate}); counts at /v1/stats")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info(f"Requests: {StubHandler.state.counts}")
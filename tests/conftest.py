@@ -0,0 +1,135 @@
+"""
+Shared fixtures. The pipeline scripts connect to MongoDB when they are imported, so
+tests that need one of them import it against an in-memory mongomock client
+(and are skipped when mongomock is not installed).
+"""
+
+import importlib.util
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+import fitz  # PyMuPDF
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# Clients are created lazily, but the SDK refuses to construct one without a key
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+
+def import_with_mongomock(module_name: str, path: str = None):
+    """Imports a module (from path, when it is not on sys.path) with MongoClient faked."""
+    mongomock = pytest.importorskip("mongomock")
+    import pymongo
+
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    client = mongomock.MongoClient()
+    original = pymongo.MongoClient
+    pymongo.MongoClient = lambda *args, **kwargs: client
+    try:
+        if path is None:
+            return __import__(module_name)
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        pymongo.MongoClient = original
+
+
+class BulkWriteResult:
+    def __init__(self, upserted_count=0, modified_count=0):
+        self.upserted_count = upserted_count
+        self.modified_count = modified_count
+
+
+def replay_bulk_write(collection):
+    """
+    bulk_write for a mongomock collection that applies UpdateOne/ReplaceOne operations
+    one at a time (mongomock's own bulk_write does not accept what pymongo 4 sends).
+    """
+    def bulk_write(operations, ordered=True):
+        result = BulkWriteResult()
+        for op in operations:
+            apply = collection.replace_one if type(op).__name__ == "ReplaceOne" else collection.update_one
+            outcome = apply(op._filter, op._doc, upsert=op._upsert)
+            result.upserted_count += 1 if outcome.upserted_id is not None else 0
+            result.modified_count += outcome.modified_count
+        return result
+    return bulk_write
+
+
+@pytest.fixture
+def mongo_writes(ocr_pdf, monkeypatch):
+    """Makes ocr_pdf's bulk writes work against mongomock."""
+    for collection in (ocr_pdf.ocr_collection, ocr_pdf.ocr_question_collection):
+        monkeypatch.setattr(collection, "bulk_write", replay_bulk_write(collection))
+
+
+@pytest.fixture(scope="session")
+def ocr_pdf():
+    return import_with_mongomock("ocr_pdf")
+
+
+@pytest.fixture(scope="session")
+def bulk_ingest(ocr_pdf):
+    return import_with_mongomock("bulk_ingest")
+
+
+@pytest.fixture(scope="session")
+def frontend_app():
+    # Loaded by path: frontend/ also holds old copies of the pipeline scripts
+    pytest.importorskip("flask")
+    return import_with_mongomock("frontend_app", os.path.join(ROOT, "frontend", "app.py"))
+
+
+@pytest.fixture(scope="session")
+def scheme_extractor():
+    return import_with_mongomock("scheme_extractor")
+
+
+@pytest.fixture(scope="session")
+def comparator():
+    # gemini_registry needs the Gemini SDK at import
+    pytest.importorskip("google.generativeai")
+    return import_with_mongomock("comparator")
+
+
+@pytest.fixture
+def stub_openai():
+    """
+    stub_openai_server on a free local port, no failures injected; tests set the
+    failure knobs on the returned StubState. The base URL is state.base_url.
+    """
+    from stub_openai_server import StubHandler, StubState
+
+    state = StubState(error_rate=0.0, server_error_rate=0.0, retry_after=0.05, latency_ms=0, fail_first=0)
+    handler = type("Handler", (StubHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    state.base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield state
+    server.shutdown()
+    server.server_close()
+    thread.join(5)
+
+
+@pytest.fixture
+def typed_pdf(tmp_path):
+    """Three typed pages, each with a text layer long enough for the fast path."""
+    path = tmp_path / "typed.pdf"
+    doc = fitz.open()
+    for n in range(1, 4):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Q{n}. The transport layer provides reliable delivery of segments", fontsize=11)
+        page.insert_text((72, 90), "between processes running on different hosts of the network.", fontsize=11)
+    doc.save(str(path))
+    doc.close()
+    return str(path)
@@ -0,0 +1,119 @@
+import threading
+import time
+
+import openai
+import pytest
+
+from api_scheduler import ApiScheduler, CircuitBreaker, CircuitOpenError
+
+
+class TransientError(Exception):
+    status_code = 503
+
+
+def open_breaker(scheduler, name="openai:test"):
+    lane = scheduler.lane(*name.split(":"))
+    lane.breaker = CircuitBreaker(threshold=1, reset_seconds=0.05)
+    lane.breaker.record_failure()
+    time.sleep(0.06)  # past reset_seconds: the next call is the half-open probe
+    return lane
+
+
+def test_callers_wait_for_the_half_open_probe_without_using_retries():
+    scheduler = ApiScheduler(max_retries=0, backoff_base=0.01)
+    lane = open_breaker(scheduler)
+    probe_started = threading.Event()
+
+    def slow_probe():
+        probe_started.set()
+        time.sleep(0.3)
+        return "probe"
+
+    probe_result = []
+    probe = threading.Thread(target=lambda: probe_result.append(scheduler.call("openai", "test", slow_probe)))
+    probe.start()
+    assert probe_started.wait(5)
+
+    # No retries left, yet these callers succeed once the probe closes the circuit
+    results = [scheduler.call("openai", "test", lambda: "waiter") for _ in range(3)]
+    probe.join()
+
+    assert probe_result == ["probe"] and results == ["waiter"] * 3
+    assert lane.breaker.state == "closed"
+    assert scheduler.snapshot()["probe_waits"] >= 1
+
+
+def test_failed_probe_reopens_the_circuit_for_waiters():
+    scheduler = ApiScheduler(max_retries=0, backoff_base=0.01)
+    lane = open_breaker(scheduler)
+    probe_started = threading.Event()
+
+    def failing_probe():
+        probe_started.set()
+        time.sleep(0.1)
+        raise TransientError("still down")
+
+    probe = threading.Thread(target=lambda: pytest.raises(TransientError, scheduler.call, "openai", "test",
+                                                          failing_probe))
+    probe.start()
+    assert probe_started.wait(5)
+    lane.breaker.reset_seconds = 60  # once re-opened, stay open
+    with pytest.raises(CircuitOpenError) as error:
+        scheduler.call("openai", "test", lambda: "never sent")
+    probe.join()
+
+    assert not error.value.probing
+    assert lane.breaker.state == "open"
+
+
+def stub_client(stub_openai):
+    # The SDK's own retries are off: retrying is the scheduler's job
+    return openai.OpenAI(base_url=stub_openai.base_url, api_key="stub", max_retries=0)
+
+
+def ask(client):
+    return client.chat.completions.create(model="test", messages=[{"role": "user", "content": "hi"}])
+
+
+def test_rate_limited_calls_are_retried_after_retry_after(stub_openai):
+    stub_openai.fail_first = 2
+    stub_openai.retry_after = 0.2
+    scheduler = ApiScheduler(max_retries=3, backoff_base=0.01)
+
+    response = scheduler.call("openai", "test", ask, stub_client(stub_openai))
+
+    assert response.choices[0].message.content
+    assert stub_openai.counts == {"requests": 3, "rate_limited": 2, "server_errors": 0, "ok": 1}
+    stats = scheduler.snapshot()
+    assert stats["retries"] == 2 and stats["transient_errors"] == 2
+    # Retry-After (0.2s) is honoured, not the much shorter exponential backoff
+    assert stats["backoff_seconds"] >= 0.4
+
+
+def test_rate_limit_error_is_raised_once_retries_are_used_up(stub_openai):
+    stub_openai.fail_first = 10
+    stub_openai.retry_after = 0.01
+    scheduler = ApiScheduler(max_retries=2, backoff_base=0.01)
+
+    with pytest.raises(openai.RateLimitError):
+        scheduler.call("openai", "test", ask, stub_client(stub_openai))
+
+    assert stub_openai.counts["requests"] == 3
+    assert scheduler.snapshot()["errors"] == 1
+
+
+def test_open_circuit_sends_no_requests(stub_openai):
+    stub_openai.server_error_rate = 1.0
+    scheduler = ApiScheduler(max_retries=1, backoff_base=0.01)
+    lane = scheduler.lane("openai", "test")
+    lane.breaker = CircuitBreaker(threshold=2, reset_seconds=60)
+    client = stub_client(stub_openai)
+
+    with pytest.raises(openai.InternalServerError):
+        scheduler.call("openai", "test", ask, client)
+    assert lane.breaker.state == "open" and scheduler.snapshot()["circuit_opened"] == 1
+
+    scheduler.max_retries = 0
+    with pytest.raises(CircuitOpenError):
+        scheduler.call("openai", "test", ask, client)
+    assert stub_openai.counts["requests"] == 2
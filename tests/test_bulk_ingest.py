@@ -0,0 +1,42 @@
+import os
+import zipfile
+
+
+def write_zip(path, members):
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return str(path)
+
+
+def test_zip_scripts_are_matched_to_the_manifest(bulk_ingest, tmp_path):
+    source = write_zip(tmp_path / "class.zip", {
+        "manifest.csv": "file,student_id\nroll_001.pdf,STU001\nroll_003.pdf,STU003\n",
+        "scans/roll_001.pdf": b"%PDF-1",
+        "scans/roll_002.pdf": b"%PDF-2",
+    })
+    dest = tmp_path / "out"
+    dest.mkdir()
+
+    jobs, skipped = bulk_ingest.collect_scripts(source, str(dest))
+
+    assert [(j["file"], j["studentId"]) for j in jobs] == [("roll_001.pdf", "STU001")]
+    assert {(s["file"], s["status"]) for s in skipped} == {("roll_003.pdf", "missing"), ("roll_002.pdf", "skipped")}
+
+
+def test_same_file_name_in_two_zip_folders_is_not_graded(bulk_ingest, tmp_path):
+    source = write_zip(tmp_path / "class.zip", {
+        "manifest.csv": "file,student_id\nroll_001.pdf,STU001\n",
+        "a/roll_001.pdf": b"%PDF-a",
+        "b/roll_001.pdf": b"%PDF-b",
+    })
+    dest = tmp_path / "out"
+    dest.mkdir()
+
+    jobs, skipped = bulk_ingest.collect_scripts(source, str(dest))
+
+    assert jobs == []
+    assert len(skipped) == 1
+    assert skipped[0]["studentId"] == "STU001"
+    assert "a/roll_001.pdf" in skipped[0]["error"] and "b/roll_001.pdf" in skipped[0]["error"]
+    assert os.listdir(dest) == []
@@ -0,0 +1,58 @@
+import math
+
+import numpy as np
+import pytest
+
+ANSWERS = {
+    ("S1", 1): [1.0, 0.0, 0.0], ("S1", 2): [0.3, 0.4, 0.0],
+    ("S2", 1): [0.0, 2.0, 2.0],
+    ("S3", 1): [-1.0, 1.0, 0.5], ("S3", 2): [0.0, 0.0, 0.0],
+}
+REFERENCES = {
+    1: {"vector": [1.0, 1.0, 0.0], "concepts": {"Q1_C1": [0.0, 0.0, 1.0], "Q1_C2": [1.0, 0.0, 0.0]}},
+    2: {"vector": [0.0, 3.0, 4.0], "concepts": {"Q2_C1": [0.0, 1.0, 0.0]}},
+}
+
+
+def cosine(a, b):
+    norms = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(x * x for x in b))
+    return sum(x * y for x, y in zip(a, b)) / norms if norms else 0.0
+
+
+def test_matrix_matches_per_answer_cosine(comparator):
+    similarities, _ = comparator.similarity_matrix(["S1", "S2", "S3"], [1, 2], ANSWERS, REFERENCES)
+
+    assert similarities.shape == (3, 2)
+    for i, sid in enumerate(["S1", "S2", "S3"]):
+        for j, qn in enumerate([1, 2]):
+            expected = cosine(ANSWERS[(sid, qn)], REFERENCES[qn]["vector"]) if (sid, qn) in ANSWERS else 0.0
+            assert similarities[i, j] == pytest.approx(expected, abs=1e-6)
+
+
+def test_matrix_matches_one_student_at_a_time(comparator):
+    student_ids, question_numbers = ["S1", "S2", "S3"], [1, 2]
+    similarities, concepts = comparator.similarity_matrix(student_ids, question_numbers, ANSWERS, REFERENCES)
+
+    for i, sid in enumerate(student_ids):
+        own = {key: vector for key, vector in ANSWERS.items() if key[0] == sid}
+        single, single_concepts = comparator.similarity_matrix([sid], question_numbers, own, REFERENCES)
+        np.testing.assert_allclose(similarities[i], single[0], atol=1e-6)
+        assert {k: v for k, v in concepts.items() if k[0] == sid} == dict(single_concepts)
+
+
+def test_concept_similarities_are_against_the_answer_of_their_question(comparator):
+    _, concepts = comparator.similarity_matrix(["S1", "S2", "S3"], [1, 2], ANSWERS, REFERENCES)
+
+    assert concepts[("S1", 1)] == [{"conceptId": "Q1_C1", "similarity": 0.0},
+                                   {"conceptId": "Q1_C2", "similarity": 1.0}]
+    assert concepts[("S1", 2)] == [{"conceptId": "Q2_C1", "similarity": 0.8}]
+    assert ("S2", 2) not in concepts
+
+
+def test_vectors_of_another_size_are_ignored(comparator):
+    answers = {("S1", 1): [1.0, 0.0, 0.0], ("S1", 2): [1.0, 0.0]}
+
+    similarities, _ = comparator.similarity_matrix(["S1"], [1, 2], answers, REFERENCES)
+
+    assert similarities[0, 1] == 0.0
+    assert similarities[0, 0] == pytest.approx(cosine([1.0, 0.0, 0.0], [1.0, 1.0, 0.0]), abs=1e-6)
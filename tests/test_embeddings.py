@@ -0,0 +1,67 @@
+import math
+
+import openai
+import pytest
+
+import embeddings
+from embeddings import approx_tokens, embed_many, pack_batches, pool_vectors, split_for_embedding
+from stub_openai_server import embedding_for
+
+
+def norm(vector):
+    return math.sqrt(sum(x * x for x in vector))
+
+
+def test_pack_batches_respects_the_input_limit():
+    assert pack_batches(["a"] * 5, max_inputs=2, max_tokens=1000) == [[0, 1], [2, 3], [4]]
+
+
+def test_pack_batches_respects_the_token_limit_and_keeps_order():
+    inputs = ["x" * 40, "x" * 40, "x" * 4, "x" * 88, "x" * 4]
+    limit = approx_tokens(inputs[0]) * 2 + approx_tokens(inputs[2])
+
+    batches = pack_batches(inputs, max_inputs=100, max_tokens=limit)
+
+    assert batches == [[0, 1, 2], [3], [4]]
+    assert all(sum(approx_tokens(inputs[i]) for i in b) <= limit for b in batches if len(b) > 1)
+
+
+def test_an_input_over_the_token_limit_gets_a_batch_of_its_own():
+    assert pack_batches(["short", "x" * 400, "short"], max_inputs=10, max_tokens=10) == [[0], [1], [2]]
+    assert pack_batches([], max_inputs=10, max_tokens=10) == []
+
+
+def test_pool_vectors_is_a_unit_length_weighted_mean():
+    pooled = pool_vectors([[1.0, 0.0], [0.0, 1.0]], [3, 1])
+
+    assert pooled == pytest.approx([3 / math.sqrt(10), 1 / math.sqrt(10)])
+    assert norm(pooled) == pytest.approx(1.0)
+
+
+def test_pool_vectors_returns_a_single_vector_as_is():
+    assert pool_vectors([[0.6, 0.8]], [5]) == [0.6, 0.8]
+
+
+def test_split_for_embedding_keeps_every_character():
+    text = "line one\n" + "word " * 60 + "x" * 50
+
+    chunks = split_for_embedding(text, max_tokens=11)
+
+    assert "".join(chunks) == text
+    assert all(approx_tokens(chunk) <= 11 for chunk in chunks)
+
+
+def test_embed_many_batches_and_retries_against_the_stub(stub_openai, monkeypatch):
+    stub_openai.fail_first = 1
+    monkeypatch.setattr(embeddings, "_client",
+                        openai.OpenAI(base_url=stub_openai.base_url, api_key="stub", max_retries=0))
+    monkeypatch.setattr(embeddings.scheduler, "backoff_base", 0.01)
+    texts = ["TCP is reliable", "", "UDP is not", "TCP is reliable", "ARP maps addresses"]
+
+    vectors = embed_many(texts, max_inputs=2, use_cache=False)
+
+    assert vectors[1] == []
+    assert vectors[0] == vectors[3] == embedding_for("TCP is reliable")
+    assert vectors[4] == embedding_for("ARP maps addresses")
+    # Three distinct texts in batches of two, plus the rate-limited first attempt
+    assert stub_openai.counts == {"requests": 3, "rate_limited": 1, "server_errors": 0, "ok": 2}
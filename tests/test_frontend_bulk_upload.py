@@ -0,0 +1,45 @@
+import io
+import json
+
+
+def upload(frontend_app, tmp_path, monkeypatch, files):
+    calls = []
+
+    def run_cli_command(script_name, args, timeout=300):
+        ids_path = args[args.index("--student-ids") + 1] if "--student-ids" in args else None
+        calls.append((script_name, args, open(ids_path).read() if ids_path else None))
+        summary = {"succeeded": 1, "failed": 0, "skipped": 0, "pagesPerSecond": 1.0}
+        return True, json.dumps(summary), ""
+
+    monkeypatch.setattr(frontend_app, "run_cli_command", run_cli_command)
+    monkeypatch.setitem(frontend_app.app.config, "UPLOAD_FOLDER", str(tmp_path))
+    data = {"exam_id": "E1", "file": (io.BytesIO(b"%PDF-bundle"), "bundle.pdf")}
+    data.update({name: (io.BytesIO(content), filename) for name, (content, filename) in files.items()})
+    response = frontend_app.app.test_client().post("/api/upload-scripts-bulk", data=data,
+                                                   content_type="multipart/form-data")
+    return response, calls
+
+
+def test_bundle_manifest_csv_is_passed_as_an_id_list(frontend_app, tmp_path, monkeypatch):
+    manifest = b"file,student_id\nroll_001.pdf,STU001\nroll_002.pdf,STU002\n"
+    response, calls = upload(frontend_app, tmp_path, monkeypatch, {"manifest": (manifest, "manifest.csv")})
+
+    assert response.status_code == 200
+    script, args, ids = calls[0]
+    assert script == "bundle_splitter.py"
+    assert ids == "STU001\nSTU002\n"
+    assert "--manifest" not in args
+
+
+def test_bundle_id_list_field(frontend_app, tmp_path, monkeypatch):
+    response, calls = upload(frontend_app, tmp_path, monkeypatch, {"student_ids": (b"STU009\n\nSTU010\n", "ids.txt")})
+
+    assert response.status_code == 200
+    assert calls[0][2] == "STU009\nSTU010\n"
+
+
+def test_bundle_manifest_without_student_column(frontend_app, tmp_path, monkeypatch):
+    response, calls = upload(frontend_app, tmp_path, monkeypatch, {"manifest": (b"file,name\na.pdf,x\n", "m.csv")})
+
+    assert response.status_code == 400
+    assert calls == []
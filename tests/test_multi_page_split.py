@@ -0,0 +1,35 @@
+def page(n, text="Q1 answer"):
+    return f"=== PAGE {n} ===\n{text} on page {n}\nCONFIDENCE_SCORE: 0.9\n"
+
+
+def test_splits_pages_in_order(ocr_pdf):
+    pages = ocr_pdf.split_multi_page_output(page(1) + page(2) + page(3), 3)
+
+    assert pages == [f"Q1 answer on page {n}\nCONFIDENCE_SCORE: 0.9" for n in (1, 2, 3)]
+
+
+def test_markers_may_carry_surrounding_whitespace(ocr_pdf):
+    text = "\n  === PAGE 1 ===  \nfirst\nCONFIDENCE_SCORE: 0.8\n\n=== PAGE 2 ===\nsecond\nCONFIDENCE_SCORE: 0.7"
+
+    assert ocr_pdf.split_multi_page_output(text, 2) == ["first\nCONFIDENCE_SCORE: 0.8",
+                                                        "second\nCONFIDENCE_SCORE: 0.7"]
+
+
+def test_ambiguous_output_is_not_split(ocr_pdf):
+    split = ocr_pdf.split_multi_page_output
+    assert split(page(1) + page(2), 3) is None              # a page missing
+    assert split(page(1) + page(2) + page(3), 2) is None    # one page too many
+    assert split(page(2) + page(1), 2) is None              # out of order
+    assert split(page(1) + page(1), 2) is None              # repeated marker
+    assert split("Here are the pages:\n" + page(1) + page(2), 2) is None
+    assert split(page(1) + "=== PAGE 2 ===\nno score line\n", 2) is None
+    assert split("Q1 answer\nCONFIDENCE_SCORE: 0.9", 1) is None
+    assert split("", 1) is None and split(None, 1) is None
+
+
+def test_marker_text_inside_a_line_is_not_a_marker(ocr_pdf):
+    text = page(1, "see === PAGE 2 === below") + page(2)
+
+    pages = ocr_pdf.split_multi_page_output(text, 2)
+
+    assert pages is not None and "see === PAGE 2 === below" in pages[0]
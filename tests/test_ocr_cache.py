@@ -0,0 +1,48 @@
+import fitz  # PyMuPDF
+
+
+def handwritten_pdf(tmp_path):
+    """Two pages with too little text for the text layer, so both need the vision model."""
+    path = tmp_path / "handwritten.pdf"
+    doc = fitz.open()
+    for text in ("Q1 TCP", "Q2 UDP"):
+        doc.new_page().insert_text((72, 120), text, fontsize=48)
+    doc.save(str(path))
+    doc.close()
+    return str(path)
+
+
+class FakeVision:
+    def __init__(self):
+        self.calls = []
+
+    def complete(self, system_message, prompt, images, labels=None):
+        self.calls.append(len(images))
+        if len(images) == 1:
+            return "single-page text\nCONFIDENCE_SCORE: 0.9"
+        return "\n".join(f"=== PAGE {n} ===\nsplit text {n}\nCONFIDENCE_SCORE: 0.8"
+                         for n in range(1, len(images) + 1))
+
+
+def test_split_pages_are_not_served_to_single_page_runs(ocr_pdf, tmp_path, mongo_writes, monkeypatch):
+    vision = FakeVision()
+    monkeypatch.setattr(ocr_pdf.ocr_backend, "complete", vision.complete)
+    pdf = handwritten_pdf(tmp_path)
+
+    ocr_pdf.extract_text_from_pdf(pdf, "E1", "S-cache", pages_per_request=2)
+    assert vision.calls == [2]
+
+    # A single-page run must not reuse the split text
+    result = ocr_pdf.extract_text_from_pdf(pdf, "E1", "S-cache", pages_per_request=1)
+    assert vision.calls == [2, 1, 1]
+    assert result["stats"]["counters"]["cache_hits"] == 0
+
+    # A multi-page run may reuse single-page text
+    ocr_pdf.extract_text_from_pdf(pdf, "E1", "S-cache", pages_per_request=2)
+    assert vision.calls == [2, 1, 1]
+
+
+def test_multi_page_cache_key_differs(ocr_pdf):
+    key = ocr_pdf.ocr_cache_key(b"page image")
+    assert ocr_pdf.multi_page_cache_key(key) != key
+    assert ocr_pdf.multi_page_cache_key(key).startswith(key)
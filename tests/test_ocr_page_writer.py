@@ -0,0 +1,55 @@
+import pytest
+
+
+class FailingCollection:
+    def bulk_write(self, operations, ordered=True):
+        raise RuntimeError("write concern error")
+
+
+def record(page_number):
+    return {"examId": "E1", "studentId": "S1", "pageNumber": page_number, "rawText": ""}
+
+
+def test_failed_flush_reports_every_buffered_page(ocr_pdf):
+    writer = ocr_pdf.OcrPageWriter(FailingCollection(), batch_size=8)
+    for page_number in range(1, 8):
+        writer.add(record(page_number))
+    with pytest.raises(RuntimeError):
+        writer.add(record(8))
+
+    assert writer.failed_pages == set(range(1, 9))
+    assert writer.pages_written == 0
+
+
+def test_final_flush_failure_fails_the_run(ocr_pdf, typed_pdf, monkeypatch):
+    def failing_bulk_write(operations, ordered=True):
+        raise RuntimeError("write concern error")
+
+    monkeypatch.setattr(ocr_pdf.ocr_collection, "bulk_write", failing_bulk_write)
+    result = ocr_pdf.extract_text_from_pdf(typed_pdf, "E1", "S-final-flush", use_cache=False)
+
+    # All three pages sit in the buffer until the final flush
+    assert result["pagesFailed"] == [1, 2, 3]
+    assert result["pagesWritten"] == 0
+
+
+class RecordingCollection:
+    def __init__(self):
+        self.batches = []
+
+    def bulk_write(self, operations, ordered=True):
+        self.batches.append(operations)
+        return type("Result", (), {"upserted_count": len(operations), "modified_count": 0})()
+
+
+def test_rewritten_pages_are_counted_once(ocr_pdf):
+    writer = ocr_pdf.OcrPageWriter(RecordingCollection(), batch_size=8)
+    for page_number in range(1, 4):
+        writer.add(record(page_number))
+    writer.flush()
+    # An escalated read replaces page 2
+    writer.add(record(2))
+    writer.flush()
+
+    assert writer.pages_written == 3
+    assert writer.pages_rewritten == 1
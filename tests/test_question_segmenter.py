@@ -0,0 +1,33 @@
+from question_segmenter import find_boundary, segment_pages
+
+
+def page(number, text):
+    return {"pageNumber": number, "rawText": text, "confidence": 0.9}
+
+
+def test_answer_text_starting_with_a_number_is_not_a_boundary():
+    pages = [page(1, "Q1. Name the layers of the OSI model\nAns: 7 layers, from physical to application\n"
+                     "Q2. What does TCP guarantee?\nAns: 3 things: ordering, delivery, integrity")]
+    spans = segment_pages(pages, valid_questions={1, 2, 7})
+    assert [s["questionNumber"] for s in spans] == [1, 2]
+    assert "7 layers" in spans[0]["answerText"]
+
+
+def test_answer_marker_with_question_number_shape():
+    for line in ("Ans Q3 the session layer", "Ans 3) the session layer", "Answer 3. the session layer",
+                 "Ans: Q.3 the session layer"):
+        assert find_boundary(line, -1, None) == 3, line
+    for line in ("Ans: 7 layers", "Answer 3 things", "Ans 7"):
+        assert find_boundary(line, -1, None) is None, line
+
+
+def test_strong_boundaries_are_checked_against_the_scheme():
+    assert find_boundary("Q3. explain", -1, {1, 2, 3}) == 3
+    assert find_boundary("Q9. explain", -1, {1, 2, 3}) is None
+    assert find_boundary("Ans 9) explain", -1, {1, 2, 3}) is None
+
+
+def test_weak_boundaries_when_only_invalid_strong_markers():
+    pages = [page(1, "Q9 stray heading\n1. first answer\n2. second answer")]
+    spans = segment_pages(pages, valid_questions={1, 2})
+    assert [s["questionNumber"] for s in spans] == [-1, 1, 2]
@@ -0,0 +1,33 @@
+import fitz  # PyMuPDF
+
+
+def script_with_blank_page(tmp_path):
+    """Q1 answer, a blank page, then more of the Q1 answer without a question marker."""
+    path = tmp_path / "script.pdf"
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "Q1. The transport layer provides reliable delivery of segments.")
+    doc.new_page()
+    doc.new_page().insert_text((72, 72), "It also provides flow control and congestion control for the hosts.")
+    doc.save(str(path))
+    doc.close()
+    return str(path)
+
+
+def question_numbers(ocr_pdf, student_id):
+    pages = ocr_pdf.ocr_collection.find({"examId": "E1", "studentId": student_id}).sort("pageNumber", 1)
+    return [p["questionNumber"] for p in pages]
+
+
+def test_resumed_run_numbers_pages_like_a_full_run(ocr_pdf, tmp_path, mongo_writes):
+    pdf = script_with_blank_page(tmp_path)
+    ocr_pdf.extract_text_from_pdf(pdf, "E1", "S-resume", use_cache=False)
+    full_run = question_numbers(ocr_pdf, "S-resume")
+    assert full_run == [1, -1, 1]
+
+    # Interrupted after the blank page
+    ocr_pdf.ocr_collection.delete_one({"examId": "E1", "studentId": "S-resume", "pageNumber": 3})
+    assert ocr_pdf.find_resume_point("E1", "S-resume", ocr_pdf.file_sha256(pdf), 3) == (2, 1)
+    result = ocr_pdf.extract_text_from_pdf(pdf, "E1", "S-resume", use_cache=False, resume=True)
+
+    assert result["resumedFromPage"] == 3
+    assert question_numbers(ocr_pdf, "S-resume") == full_run
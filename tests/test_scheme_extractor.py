@@ -0,0 +1,65 @@
+import fitz  # PyMuPDF
+
+SCHEME = {"questions": [{"questionNumber": 1, "maxMarks": 5, "questionText": "Define TCP",
+                         "referenceAnswer": "A reliable transport protocol"}]}
+
+
+def scheme_pdf(tmp_path, name, text):
+    path = tmp_path / name
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), text)
+    doc.save(str(path))
+    doc.close()
+    return str(path)
+
+
+def test_reuploading_an_older_scheme_makes_it_the_latest_again(scheme_extractor, tmp_path, monkeypatch):
+    def structure(pdf_path, *args, **kwargs):
+        raise AssertionError("identical PDFs must come from the cache")
+
+    monkeypatch.setattr(scheme_extractor, "refresh_reference_embeddings", lambda *args: (None, 0))
+    ids = {"examId": "E-rerun", "professorId": "P1", "subjectId": "S1"}
+    collection = scheme_extractor.schema_collection
+    pdf_a = scheme_pdf(tmp_path, "a.pdf", "Scheme A")
+    pdf_b = scheme_pdf(tmp_path, "b.pdf", "Scheme B")
+    for path in (pdf_a, pdf_b):
+        collection.insert_one(dict(ids, sourceHash=scheme_extractor.file_sha256(path),
+                                   promptVersion=scheme_extractor.SCHEME_PROMPT_VERSION,
+                                   rawExtractedText=path, structuredData=SCHEME))
+    monkeypatch.setattr(scheme_extractor, "extract_scheme_text", structure)
+
+    scheme_extractor.parse_and_store_scheme(pdf_a, **ids)
+
+    latest = collection.find_one({"examId": "E-rerun"}, sort=[("_id", -1)])
+    assert latest["rawExtractedText"] == pdf_a
+    assert collection.count_documents({"examId": "E-rerun"}) == 3
+
+    # Already the latest: nothing more is stored
+    scheme_extractor.parse_and_store_scheme(pdf_a, **ids)
+    assert collection.count_documents({"examId": "E-rerun"}) == 3
+
+
+def test_merged_chunks_are_ordered_and_totalled(scheme_extractor):
+    parts = [
+        {"questions": [{"questionNumber": 3, "maxMarks": 4}, {"questionNumber": "1", "maxMarks": "2.5"}],
+         "metadata": {"subject": "Networks", "totalMarks": 99}},
+        {"questions": [{"questionNumber": 2, "maxMarks": 3}, {"questionNumber": "part b", "maxMarks": 1}],
+         "metadata": {"subject": "ignored", "duration": "2h"}},
+    ]
+
+    merged = scheme_extractor.merge_structured_chunks(parts)
+
+    assert [q["questionNumber"] for q in merged["questions"]] == ["1", 2, 3, "part b"]
+    assert merged["metadata"] == {"subject": "Networks", "duration": "2h", "totalMarks": 10.5,
+                                  "numberOfQuestions": 4}
+
+
+def test_question_split_across_chunks_keeps_the_fuller_version(scheme_extractor):
+    partial = {"questionNumber": 1, "maxMarks": 5, "concepts": [{"conceptId": "C1"}]}
+    full = {"questionNumber": 1, "maxMarks": 5, "concepts": [{"conceptId": "C1"}, {"conceptId": "C2"}]}
+
+    for parts in ([{"questions": [partial]}, {"questions": [full]}],
+                  [{"questions": [full]}, {"questions": [partial]}]):
+        merged = scheme_extractor.merge_structured_chunks(parts)
+        assert merged["questions"] == [full]
+        assert merged["metadata"] == {"totalMarks": 5, "numberOfQuestions": 1}
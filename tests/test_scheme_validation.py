@@ -0,0 +1,74 @@
+import pytest
+
+from scheme_validation import SchemeValidationError, parse_structured_text, validate_scheme
+
+
+def question(number, max_marks=4, **fields):
+    return dict({"questionNumber": number, "maxMarks": max_marks, "questionText": f"Question {number}"}, **fields)
+
+
+def test_normalizes_model_output_types():
+    scheme, warnings = validate_scheme({"questions": [question(
+        "2", "5 marks",
+        concepts=[{"description": "Handshake", "keywords": "SYN", "marks": "3", "isMandatory": "yes"},
+                  {"conceptId": "C2", "marks": 2, "acceptableVariations": ["ack", None, " "]}],
+        evaluationCriteria={"mustIncludePoints": "three-way handshake", "fullMarksRequirements": None},
+        hints=None, referenceAnswer=7)]})
+
+    [q] = scheme["questions"]
+    assert warnings == []
+    assert q["questionNumber"] == 2 and q["maxMarks"] == 5 and q["referenceAnswer"] == "7"
+    assert q["concepts"][0] == {"conceptId": "Q2_C1", "description": "Handshake", "keywords": ["SYN"],
+                                "marks": 3, "isMandatory": True, "acceptableVariations": []}
+    assert q["concepts"][1]["acceptableVariations"] == ["ack"]
+    assert q["evaluationCriteria"] == {"fullMarksRequirements": "", "partialMarksConditions": "",
+                                       "commonMistakes": [], "mustIncludePoints": ["three-way handshake"]}
+    assert q["hints"] == []
+
+
+def test_totals_are_recomputed_and_a_wrong_declared_total_is_kept():
+    scheme, warnings = validate_scheme({"questions": [question(1, 4), question(2, 2.5)],
+                                        "metadata": {"totalMarks": 10, "subject": "Networks"}})
+
+    assert scheme["metadata"] == {"totalMarks": 6.5, "numberOfQuestions": 2, "declaredTotalMarks": 10,
+                                  "subject": "Networks"}
+    assert len(warnings) == 1 and "declared totalMarks 10" in warnings[0]
+
+
+def test_bad_concepts_are_warnings_not_errors():
+    scheme, warnings = validate_scheme({"questions": [question(
+        1, 4, concepts=["not an object", {"description": "Flow control", "marks": -1}])]})
+
+    assert scheme["questions"][0]["concepts"][0]["marks"] == 0
+    assert len(warnings) == 3  # dropped concept, invalid marks, marks not adding up to maxMarks
+
+
+@pytest.mark.parametrize("data, error", [
+    ({}, "scheme has no questions"),
+    ({"questions": []}, "scheme has no questions"),
+    ({"questions": ["Q1"]}, "question #1 is not an object"),
+    ({"questions": [question(1.5)]}, "question #1 has no integer questionNumber"),
+    ({"questions": [question(None)]}, "question #1 has no integer questionNumber"),
+    ({"questions": [question(1), question("1")]}, "question number 1 appears more than once"),
+    ({"questions": [question(1, -2)]}, "Q1 has invalid maxMarks"),
+    ({"questions": [question(1, "many")]}, "Q1 has invalid maxMarks"),
+    ({"questions": [question(1, True)]}, "Q1 has invalid maxMarks"),
+])
+def test_unusable_schemes_are_rejected(data, error):
+    with pytest.raises(SchemeValidationError) as raised:
+        validate_scheme(data)
+
+    assert any(e.startswith(error) for e in raised.value.errors)
+
+
+def test_every_error_is_reported_at_once():
+    with pytest.raises(SchemeValidationError) as raised:
+        validate_scheme({"questions": [question(None), question(2, -1), question(3)]})
+
+    assert len(raised.value.errors) == 2
+
+
+def test_parse_structured_text_strips_code_fences():
+    assert parse_structured_text('```json\n{"questions": []}\n```') == {"questions": []}
+    with pytest.raises(ValueError):
+        parse_structured_text("[1, 2]")
@@ -0,0 +1,33 @@
+def test_failed_segmentation_removes_stale_question_answers(ocr_pdf, typed_pdf, monkeypatch):
+    def bulk_write(operations, ordered=True):
+        return type("Result", (), {"upserted_count": len(operations), "modified_count": 0})()
+
+    def failing_segment_pages(pages, valid_questions=None):
+        raise ValueError("segmenter crashed")
+
+    student = {"examId": "E1", "studentId": "S-segment"}
+    ocr_pdf.ocr_question_collection.insert_many([
+        dict(student, questionNumber=1, answerText="answer from an older script"),
+        dict(student, questionNumber=2, answerText="answer from an older script"),
+    ])
+    monkeypatch.setattr(ocr_pdf.ocr_collection, "bulk_write", bulk_write)
+    monkeypatch.setattr(ocr_pdf, "segment_pages", failing_segment_pages)
+
+    result = ocr_pdf.extract_text_from_pdf(typed_pdf, "E1", "S-segment", use_cache=False)
+
+    assert result["segmentationError"] == "segmenter crashed"
+    assert result["questionsStored"] == 0
+    assert ocr_pdf.ocr_question_collection.count_documents(student) == 0
+
+
+def test_batch_export_segments_locally_resolved_scripts(ocr_pdf, typed_pdf, tmp_path, mongo_writes):
+    student = {"examId": "E1", "studentId": "S-batch"}
+    ocr_pdf.ocr_question_collection.insert_one(dict(student, questionNumber=9, answerText="older upload"))
+
+    result = ocr_pdf.write_batch_requests(typed_pdf, "E1", "S-batch", str(tmp_path / "batch.jsonl"),
+                                          use_cache=False)
+
+    assert result["batchRequests"] == 0
+    assert result["questionsStored"] == 3
+    stored = sorted(d["questionNumber"] for d in ocr_pdf.ocr_question_collection.find(student))
+    assert stored == [1, 2, 3]
@@ -0,0 +1,48 @@
+import fitz  # PyMuPDF
+
+from page_images import get_encoding_profile
+
+ANSWER = "Q1. The transport layer provides reliable delivery of segments between processes."
+
+
+def prepare(ocr_pdf, page):
+    return ocr_pdf.prepare_page(page, 1, get_encoding_profile("png"), ocr_pdf.OcrRunStats(), [], triage=False)
+
+
+def scanned_page(doc, layer_text):
+    """A page image covering the whole page, with the scanner's invisible OCR text on top."""
+    scan = fitz.open()
+    scan.new_page().insert_text((72, 72), "handwritten answer", fontsize=14)
+    pix = scan[0].get_pixmap(dpi=72)
+    page = doc.new_page()
+    page.insert_image(page.rect, pixmap=pix)
+    page.insert_text((72, 72), layer_text, fontsize=11, render_mode=3)
+    return page
+
+
+def test_typed_page_uses_text_layer(ocr_pdf):
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), ANSWER, fontsize=11)
+    item = prepare(ocr_pdf, doc[0])
+    assert item["result"]["source"] == "text_layer"
+    assert item["result"]["confidence"] == ocr_pdf.OCR_TEXT_LAYER_CONFIDENCE < 1.0
+
+
+def test_scanned_page_with_ocr_layer_goes_to_vision(ocr_pdf):
+    doc = fitz.open()
+    item = prepare(ocr_pdf, scanned_page(doc, ANSWER))
+    assert "result" not in item
+    assert item["image_b64"]
+
+
+def test_garbage_text_layer_goes_to_vision(ocr_pdf):
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "l1I| t#e ~~ rn¡ tHe 2a) |_| ;;; l1I| t#e ~~ rn¡ tHe", fontsize=11)
+    item = prepare(ocr_pdf, doc[0])
+    assert "result" not in item
+
+
+def test_word_ratio(ocr_pdf):
+    assert ocr_pdf.text_layer_word_ratio(ANSWER) == 1.0
+    assert ocr_pdf.text_layer_word_ratio("l1I| t#e ~~ TCP") == 0.25
+    assert ocr_pdf.text_layer_word_ratio("") == 0.0
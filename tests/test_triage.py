@@ -0,0 +1,63 @@
+import fitz  # PyMuPDF
+
+from page_images import hamming_distance, page_fingerprint, render_page
+
+
+def ruled_page(doc, words):
+    """A ruled answer sheet with a few short answers written on it."""
+    page = doc.new_page()
+    for y in range(90, 800, 24):
+        page.draw_line((50, y), (560, y), color=(0.2, 0.2, 0.4), width=1.2)
+    for (x, y), text in words:
+        page.insert_text((x, y), text, fontsize=16)
+    return page
+
+
+def ruled_doc():
+    doc = fitz.open()
+    first = [((60, 110), "1) OSI has 7 layers"), ((60, 182), "TCP is reliable")]
+    ruled_page(doc, first)
+    ruled_page(doc, [((60, 134), "2) UDP has no handshake"), ((300, 254), "no ack")])
+    ruled_page(doc, first)
+    return doc
+
+
+def test_ruled_pages_look_alike_as_thumbnails(ocr_pdf):
+    # Guards the fixture: the thumbnail checks alone cannot tell these pages apart
+    doc = ruled_doc()
+    first, second = (page_fingerprint(render_page(doc[i], ocr_pdf.OCR_TRIAGE_DPI, grayscale=True)) for i in (0, 1))
+    assert hamming_distance(first["hash"], second["hash"]) <= 10
+    assert float(abs(first["grid"] - second["grid"]).mean()) <= 1.5
+
+
+def test_ruled_pages_with_different_answers_are_kept(ocr_pdf):
+    doc = ruled_doc()
+    seen = []
+    assert ocr_pdf.triage_page(doc[0], seen) == (None, None)
+    assert ocr_pdf.triage_page(doc[1], seen) == (None, None)
+    assert [page_number for page_number, _ in seen] == [1, 2]
+
+
+def test_ink_comparison_keeps_pages_the_thumbnails_confuse(ocr_pdf, monkeypatch):
+    # With the thumbnail thresholds as loose as they used to be, the ink check still decides
+    monkeypatch.setattr(ocr_pdf, "OCR_DUPLICATE_MAX_DISTANCE", 10)
+    monkeypatch.setattr(ocr_pdf, "OCR_DUPLICATE_MAX_GRID_DIFF", 1.5)
+    doc = ruled_doc()
+    seen = []
+    ocr_pdf.triage_page(doc[0], seen)
+    assert ocr_pdf.triage_page(doc[1], seen) == (None, None)
+    assert ocr_pdf.triage_page(doc[2], seen) == ("duplicate", 1)
+
+
+def test_repeated_page_is_a_duplicate(ocr_pdf):
+    doc = ruled_doc()
+    seen = []
+    for i in range(2):
+        ocr_pdf.triage_page(doc[i], seen)
+    assert ocr_pdf.triage_page(doc[2], seen) == ("duplicate", 1)
+
+
+def test_blank_page(ocr_pdf):
+    doc = fitz.open()
+    doc.new_page()
+    assert ocr_pdf.triage_page(doc[0], []) == ("blank", None)